@@ -6,11 +6,58 @@
 # positions in-between open and close.  The postion is 
 # measured in terms of percent open, where zero is fully 
 # closed, and 100 is fully open.
+#
+# The position is worked out from a model of how the valve moves (see model): how
+# long it takes to travel the full span in each direction, how long after the relay
+# turns on it starts to move (start_latency), and how long it keeps moving after the
+# relay turns off (coast).  The model is measured by calibrate() (see
+# calibrate_valve.py) and kept in model_file.  It is also refined as the valve runs:
+# each time the valve leaves a limit switch, the time it took to start is averaged
+# in, and each time it then travels all the way to the other one, the travel time.
+# The refined model is written out within save_delay seconds of being refined, on
+# a timer thread of its own (see _refine), and when the program exits, so the
+# heartbeat never waits on the SD card.
+#
+# Moves are planned from the model.  When the valve sets off toward a target, the
+# time to turn the relay off is worked out so that the valve coasts to a stop on
+# the target (see _plan_stop), and the heartbeat next runs at that time, rather
+# than every few milliseconds.  The position is worked out when it is asked for.
+# A move too small to make (less than half the coast) isn't made, so the valve
+# never dithers about the target.
+#
+# A ramp (see ramp()) moves the flow from one position to another over a length of
+# time, following an easing curve.  The valve only runs at one speed, so a ramp is
+# made of steps of about ramp_step percent: the heartbeat moves the target one step
+# at a time, each a little ahead of the curve, so that the valve is halfway through
+# the step when the curve is.  A step is a single pulse of the relay, and a ramp
+# steeper than the valve can follow just keeps the relay on.
+#
+# The limit switches are watched by callbacks (see corehw.valve_switches).  When
+# one changes, the heartbeat runs at once, so the relay is turned off as soon as
+# the valve reaches the end.  While the valve moves, the switches are read again
+# every switch_poll_period, in case an edge was missed.
 
+import os
+import json
+import math
+import atexit
+import threading
 import corehw 
-import time
+import clock
+import scheduler
 
-full_movement_time = 5300   # milliseconds to move full span
+model_file = "valve_model.json"
+if corehw.simulated: model_file = "valve_model_sim.json"     # Keep the simulated valve's apart
+model = {"open_time": 5250.0,       # Milliseconds to open fully, once moving
+         "close_time": 5330.0,      # Milliseconds to close fully, once moving
+         "start_latency": 0.0,      # Milliseconds from the relay turning on until the valve moves
+         "coast": 0.0}              # Milliseconds the valve keeps moving after the relay turns off
+model_weight = 0.2          # Weight of each new measurement when refining the model
+model_refined = False       # Set when the model is refined, until it is saved
+save_delay = 10.0           # Seconds after the model is refined before it is saved
+save_timer = None           # The threading.Timer that saves the refined model, or None
+model_loaded = False        # Set when the model was read from model_file, rather than the defaults above
+switch_poll_period = 50     # milliseconds between reads of the limit switches while the valve is moving
 tollerance = 0.125          # Percentage of tollerance to set valve
 target_position = 0         # In percent of fully opened
 current_position = 0        # In percent of fully opened
@@ -18,10 +65,191 @@ forward_motion = False
 reverse_motion = False
 reset_mode = False          # If in Reset Mode.
 fullon_mode = False         # if in Full On Mode.
-last_time_check = 0
-last_update_time = time.monotonic_ns()
+ramp_step = 2.0             # Percent the valve moves at a time while following a ramp
+active_ramp = None          # The ramp being run: (start, end, start time in ns, length in ns, easing), or None
+next_ramp_time = None       # When the ramp next moves the target, in ns, or None
+relay_off_time = None       # When the relay is to turn off, so the valve stops on the target (in ns), or None
+replan = False              # Set when the target changes, so the heartbeat plans the move again
+last_switch_poll = 0
+switch_changed = False      # Set when a limit switch changes, so the next heartbeat runs at once
 loop_count = 0
 
+# The motion, for the position estimate (see estimate_position).
+drive = 0                   # -1, 0 or +1: which way the relays are driving the valve
+drive_time = 0              # When drive last changed, in ns
+last_drive = 0              # The drive before that, for the coast
+anchor_position = 0.0       # A known position...
+anchor_time = 0             # ...and when, in ns.  Moved on each change of drive or limit switch.
+
+# For refining the model.
+last_switches = 0           # The limit switches, as of the last heartbeat
+drive_from_limit = 0        # The limit switch (-1 or +1) the valve was at when the relay turned on, or 0
+release_time = 0            # When the valve then left that limit switch, in ns, or 0
+
+# The easing curves of a ramp: the fraction of the way from start to end, for a
+# fraction of the time.  Each must go from 0 to 1 and never go back.
+easings = {"linear": lambda u: u,
+           "ease-in": lambda u: u * u,
+           "ease-out": lambda u: 1 - (1 - u) * (1 - u),
+           "ease-in-out": lambda u: u * u * (3 - 2 * u)}
+
+def load_model(filename=None):
+    """ Reads the model from a file (model_file by default), if it is there.  Warns if
+    it isn't, since the defaults have no start latency or coast, and the flows are
+    then off by a few percent."""
+    global model_loaded
+    if filename is None: filename = model_file
+    try:
+        with open(filename) as f: data = json.load(f)
+    except FileNotFoundError:
+        print("ball_valve: WARNING: No valve model in %s.  The flows will be off by a few percent" % filename)
+        print("ball_valve: until the valve is calibrated (run calibrate_valve.py).")
+        return
+    except (OSError, ValueError) as e:
+        print("ball_valve: Unable to read %s: %s" % (filename, e))
+        return
+    for key in model:
+        if isinstance(data.get(key), (int, float)): model[key] = float(data[key])
+    model_loaded = True
+
+def save_model(filename=None):
+    """ Writes the model to a file (model_file by default).  Writes a new file, flushes
+    it to the disk and renames it, so a crash or power cut never leaves half a model."""
+    global model_refined
+    if filename is None: filename = model_file
+    tmp = filename + ".tmp"
+    model_refined = False
+    data = dict(model)
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except OSError as e:
+        model_refined = True
+        print("ball_valve: Unable to save %s: %s" % (filename, e))
+
+def save_if_refined():
+    """ Saves the model if it was refined since it was last saved.  Called by
+    save_timer, and when the program exits."""
+    global save_timer
+    save_timer = None
+    if model_refined: save_model()
+
+def _refine(key, value):
+    """ Averages a new measurement (in ms) into the model, and has it saved within
+    save_delay seconds.  Later changes ride along with the save already pending."""
+    global model_refined, save_timer
+    model[key] += model_weight * (value - model[key])
+    model_refined = True
+    if save_timer is None:
+        save_timer = threading.Timer(save_delay, save_if_refined)
+        save_timer.daemon = True
+        save_timer.start()
+
+def _rate(direction):
+    """ Percent per nanosecond, in the given direction."""
+    if direction > 0: return 100.0 / (model["open_time"] * 1_000_000)
+    return -100.0 / (model["close_time"] * 1_000_000)
+
+def estimate_position(t=None):
+    """ Returns the position that the model puts the valve at, at time t (in ns)."""
+    if t is None: t = clock.now_ns()
+    p = anchor_position
+    if drive != 0:
+        start = max(anchor_time, drive_time + int(model["start_latency"] * 1_000_000))
+        if t > start: p += _rate(drive) * (t - start)
+    elif last_drive != 0:
+        end = min(t, drive_time + int(model["coast"] * 1_000_000))
+        if end > anchor_time: p += _rate(last_drive) * (end - anchor_time)
+    if p > 100: p = 100
+    if p < 0: p = 0
+    return p
+
+def _coast_ns():
+    return int(model["coast"] * 1_000_000)
+
+def coasting(t=None):
+    """ Returns True if the relay is off but the valve is still coasting."""
+    if t is None: t = clock.now_ns()
+    return drive == 0 and last_drive != 0 and t < drive_time + _coast_ns()
+
+def _min_step(direction):
+    """ The smallest move the valve can make, in percent: the coast."""
+    return abs(_rate(direction)) * _coast_ns()
+
+def _plan_stop(t):
+    """ Returns the time to turn the relay off so that the valve, being driven
+    toward the target, coasts to a stop on it.  It's never before the valve starts
+    moving, so a move smaller than the coast overshoots by the difference."""
+    rate = abs(_rate(drive))
+    start = max(anchor_time, drive_time + int(model["start_latency"] * 1_000_000))
+    distance = abs(target_position - anchor_position) - rate * _coast_ns()
+    if distance < 0: distance = 0
+    return max(t, start + int(distance / rate))
+
+def _stop(t):
+    """ Turns the relay off."""
+    global forward_motion, reverse_motion, relay_off_time
+    _move(0, t)
+    forward_motion = False
+    reverse_motion = False
+    relay_off_time = None
+
+def _position(t, switches):
+    """ The position at t, given the limit switches."""
+    if switches > 0: return 100.0
+    if switches < 0: return 0.0
+    # Not at either end, whatever the model says.
+    p = estimate_position(t)
+    if p > 99: p = 99
+    if p < 1: p = 1
+    return p
+
+def _move(direction, t):
+    """ Drives the valve (+1 toward open, -1 toward closed, 0 to stop), and keeps
+    track of the motion for the position estimate."""
+    global drive, drive_time, last_drive, anchor_position, anchor_time, drive_from_limit, release_time
+    if direction == drive: return
+    anchor_position = estimate_position(t)
+    anchor_time = t
+    last_drive = drive
+    drive = direction
+    drive_time = t
+    switches = corehw.check_ball_valve()
+    drive_from_limit = switches if switches != 0 and switches == -direction else 0
+    release_time = 0
+    corehw.ball_valve_move(direction)
+
+def _switches_seen(switches, t):
+    """ Takes in a change of the limit switches, at time t: sets the position, and
+    refines the model."""
+    global anchor_position, anchor_time, drive_from_limit, release_time
+    if switches == 0:
+        if drive_from_limit != 0 and last_switches == drive_from_limit and drive == -drive_from_limit:
+            # Left the limit switch: the start latency.
+            release_time = t
+            _refine("start_latency", (t - drive_time) / 1_000_000)
+        return
+    anchor_position = 100.0 if switches > 0 else 0.0
+    anchor_time = t
+    if release_time != 0 and drive == switches:
+        # Travelled from one limit switch to the other.
+        _refine("open_time" if switches > 0 else "close_time", (t - release_time) / 1_000_000)
+    drive_from_limit = 0
+    release_time = 0
+
+def _switch_changed(state, t):
+    """ Called by corehw when a limit switch changes, from gpiozero's thread."""
+    global switch_changed
+    switch_changed = True
+    scheduler.wake("ball_valve")
+
+corehw.on_valve_switch = _switch_changed
+load_model()
+atexit.register(save_if_refined)
+
 def print_status():
     """ Prints the status of the ball valve, for debugging."""
     switches = corehw.check_ball_valve()
@@ -30,13 +258,41 @@ def print_status():
 def set_position(target):
     """ Sets the target position, in percent, of the ball valve.  Non-blocking. Use get_current_positon()
     to determine when the operation is complete."""
-    global target_position
+    global target_position, replan, active_ramp
+    active_ramp = None
     target_position = target
+    replan = True
+    scheduler.wake("ball_valve")
+
+def ramp(end, duration=None, start=None, easing="linear", rate=None):
+    """ Ramps the flow from start (by default, the current target) to end, in percent,
+    over duration milliseconds, or at rate percent per second.  easing is one of the
+    names in easings.  Non-blocking: use ramping() to determine when it is done.  A
+    ramp is ended by a new one, or by setting the position."""
+    global active_ramp, next_ramp_time
+    if start is None: start = target_position
+    start = min(max(start, 0), 100)
+    end = min(max(end, 0), 100)
+    if duration is None:
+        if rate is None or rate <= 0: duration = 0
+        else: duration = abs(end - start) / rate * 1000
+    if duration <= 0 or start == end:
+        if end >= 100: reset_to_fullon()
+        elif end <= 0: reset_to_zero()
+        else: set_position(end)
+        return
+    set_position(start)
+    active_ramp = (start, end, clock.now_ns(), int(duration * 1_000_000), easings.get(easing, easings["linear"]))
+    next_ramp_time = None
+    scheduler.wake("ball_valve")
+
+def ramping():
+    """ Returns True if a ramp is running."""
+    return active_ramp is not None
 
 def get_current_position():
     """ Returns the current position, in percent."""
-    global current_position
-    return current_position
+    return _position(clock.now_ns(), corehw.check_ball_valve())
 
 def get_current_target():
     """ Returns the target position, in percent. """
@@ -44,11 +300,11 @@ def get_current_target():
     return target_position
 
 def in_motion():
-    """ Returns True if ball valve is in motion."""
+    """ Returns True if ball valve is in motion: driven, or still coasting."""
     global forward_motion, reverse_motion
     if forward_motion: return True 
     if reverse_motion: return True
-    return False
+    return coasting()
 
 def is_fullon():
     """ Returns True if ball valve is fully open."""
@@ -65,104 +321,216 @@ def is_closed():
 def reset_to_zero():
     """ Shuts Ball Valve to zero to start things off.  Non-blocking. Use is_closed() to
     determine when this operation is finished."""
-    global reset_mode, fullon_mode, last_update_time, reverse_motion, forward_motion, target_position
+    global reset_mode, fullon_mode, reverse_motion, forward_motion, target_position, active_ramp, relay_off_time
+    active_ramp = None
+    relay_off_time = None
     reset_mode = True
     fullon_mode = False
-    last_update_time = time.monotonic_ns()
     reverse_motion = True
     forward_motion = False
     target_position = 0
-    corehw.ball_valve_move(-1)
+    _move(-1, clock.now_ns())
+    scheduler.wake("ball_valve")
 
 def reset_to_fullon():
     """ Opens up Ball Valve fully, regardless of timing. Non-blocking. Use is_fullon() to 
     determine when this operation is finished."""
-    global reset_mode, fullon_mode, last_update_time, reverse_motion, forward_motion, target_position
+    global reset_mode, fullon_mode, reverse_motion, forward_motion, target_position, active_ramp, relay_off_time
+    active_ramp = None
+    relay_off_time = None
     reset_mode = False
     fullon_mode = True
-    last_update_time = time.monotonic_ns()
     reverse_motion = False
     forward_motion = True
     target_position = 100
-    corehw.ball_valve_move(1)
-
-def heartbeat():
-    """ Call this at least once every 5 milliseconds to set valve."""
-    global reset_mode, fullon_mode, last_update_time, reverse_motion, forward_motion, target_position, current_position
-    global last_time_check, loop_count
-    t = time.monotonic_ns()
-    elp = (t - last_time_check) / 1_000_000
-    if elp < 2: return       # Check at most once every 2 milliseconds
+    _move(1, clock.now_ns())
+    scheduler.wake("ball_valve")
+
+def _ramp_levels(r):
+    """ Returns the size of the steps of a ramp, and the number of them."""
+    span = abs(r[1] - r[0])
+    n = max(1, round(span / ramp_step))
+    return span / n, n
+
+def _ramp_position(r, t):
+    """ Returns where the curve of a ramp is at time t (in ns)."""
+    start, end, t0, length, ease = r
+    if t >= t0 + length: return end
+    if t <= t0: return start
+    return start + (end - start) * ease((t - t0) / length)
+
+def _ramp_time(r, p):
+    """ Returns the time (in ns) that the curve of a ramp gets to position p."""
+    start, end, t0, length, ease = r
+    f = (p - start) / (end - start)
+    lo, hi = 0.0, 1.0
+    for i in range(40):
+        mid = (lo + hi) / 2
+        if ease(mid) < f: lo = mid
+        else: hi = mid
+    return t0 + math.ceil(hi * length) + 1
+
+def _run_ramp(t):
+    """ Moves the target along the ramp, a step at a time.  Returns when it next
+    needs to, or None once the ramp is over."""
+    global active_ramp, target_position, replan
+    r = active_ramp
+    start, end, t0, length, ease = r
+    if t >= t0 + length:
+        active_ramp = None
+        if end >= 100: reset_to_fullon()
+        elif end <= 0: reset_to_zero()
+        elif target_position != end:
+            target_position = end
+            replan = True
+        return None
+    direction = 1 if end > start else -1
+    step, n = _ramp_levels(r)
+    # Lead the curve by the time the valve takes to start, and to make half a step.
+    lead = int(model["start_latency"] * 1_000_000 + step / 2 / abs(_rate(direction)))
+    k = math.floor(abs(_ramp_position(r, t + lead) - start) / step + 0.5)
+    if k > n: k = n
+    level = start + direction * k * step
+    if k == n: level = end
+    if level != target_position:
+        target_position = level
+        replan = True
+    if k == n: return t0 + length
+    return max(t + 1, _ramp_time(r, start + direction * (k + 0.5) * step) - lead)
+
+def heartbeat(t=None):
+    """ Runs the valve: starts and stops its moves, and watches the limit switches.
+    Returns the time (in ns) that it next needs to be called, or None if the valve
+    is at rest."""
+    global reset_mode, fullon_mode, reverse_motion, forward_motion, target_position, current_position
+    global loop_count, last_switch_poll, switch_changed, last_switches, relay_off_time, replan
+    global next_ramp_time
+    if t is None: t = clock.now_ns()
+    next_ramp_time = None
+    if active_ramp is not None: next_ramp_time = _run_ramp(t)
+    if drive != 0 and t - last_switch_poll >= switch_poll_period * 1_000_000:
+        last_switch_poll = t
+        corehw.refresh_ball_valve_switches()
+    switch_changed = False
+    switches, switch_time = corehw.valve_switches
+    if switches != last_switches:
+        _switches_seen(switches, switch_time)
+        last_switches = switches
     # loop_count += 1 
     # if loop_count % 500 == 0: print_status()
-    last_time_check = t 
-    if forward_motion:
-        elp = (t - last_update_time) / 1_000_000.0
-        delta = elp / full_movement_time
-        current_position += delta*100
-        if current_position > 99: current_position = 99 
-        if corehw.check_ball_valve() > 0:
-            current_position = 100 
-            corehw.ball_valve_move(0)
-            forward_motion = False 
-            reverse_motion = False
-    if reverse_motion:
-        elp = (t - last_update_time) / 1_000_000.0
-        delta = elp / full_movement_time
-        current_position -= (delta*100) 
-        if current_position < 1: current_position = 1
-        if corehw.check_ball_valve() < 0:
-            current_position = 0 
-            corehw.ball_valve_move(0)
-            forward_motion = False 
-            reverse_motion = False
-    last_update_time = t 
+    current_position = _position(t, switches)
+    if (forward_motion and switches > 0) or (reverse_motion and switches < 0): _stop(t)
     if reset_mode:
-        if corehw.check_ball_valve() == -1:
-            current_position = 0
+        if switches == -1:
             target_position = 0
-            reverse_motion = False
-            forward_motion = False
             reset_mode = False
             fullon_mode = False
-            last_update_time = t 
-            corehw.ball_valve_move(0)
-        return
+            _stop(t)
+        return _next_check(t)
     if fullon_mode:
-        if corehw.check_ball_valve() == 1:
-            current_position = 100
+        if switches == 1:
             target_position = 100
-            reverse_motion = False
-            forward_motion = False
             reset_mode = False
             fullon_mode = False
-            last_update_time = t 
-            corehw.ball_valve_move(0)
-        return
-    if corehw.check_ball_valve() != 0:
-        if corehw.check_ball_valve() < 0: 
-            current_position = 0 
-            last_update_time = t 
-        if corehw.check_ball_valve() > 0:
-            current_position = 100
-            last_update_time = t 
+            _stop(t)
+        return _next_check(t)
+    if replan:
+        replan = False
+        relay_off_time = None
+    if drive != 0:
+        if relay_off_time is None:
+            # The target changed on the way.  Carry on if it is still ahead, else stop.
+            if (target_position - current_position) * drive > tollerance: relay_off_time = _plan_stop(t)
+            else: _stop(t)
+        if relay_off_time is not None and t >= relay_off_time: _stop(t)
+        if drive != 0 or coasting(t): return _next_check(t)
+    elif coasting(t): return _next_check(t)
+    # At rest.  Head toward the target, if it's far enough away to move to.
     positional_error = target_position - current_position
-    positional_error_abs = positional_error
-    if positional_error_abs < 0: positional_error_abs = -1.0 * positional_error_abs
-    if positional_error_abs < tollerance:
+    direction = 1 if positional_error > 0 else -1
+    if abs(positional_error) < max(tollerance, _min_step(direction) / 2): return _next_check(t)
+    _move(direction, t)
+    forward_motion = direction > 0
+    reverse_motion = direction < 0
+    relay_off_time = _plan_stop(t)
+    return _next_check(t)
+
+def _wait_for_switches(state, timeout=15.0):
+    """ Waits for the limit switches to show state.  Returns the time (in ns) they
+    changed to it, or None after timeout seconds."""
+    t_end = clock.now_ns() + int(timeout * 1_000_000_000)
+    while clock.now_ns() < t_end:
+        switches, t = corehw.valve_switches
+        if switches == state: return t
+        clock.sleep(0.001)
+    return None
+
+def calibrate(pulse=1000):
+    """ Measures the model, by moving the valve, and saves it.  Takes about half a
+    minute, and blocks: only call this with the conductor not running.  Runs the
+    valve from closed to open and back, timing when it leaves each limit switch
+    (the start latency) and reaches the other (the travel time).  Then opens it
+    for pulse ms and times how long it takes to close from there, which gives the
+    coast.  Returns the model, or None if a limit switch was never reached."""
+    global anchor_position, anchor_time, drive, last_drive, drive_time, last_switches
+    global current_position, target_position, forward_motion, reverse_motion, reset_mode, fullon_mode
+    global model_loaded
+    corehw.ball_valve_move(-1)
+    ok = _wait_for_switches(-1) is not None
+    corehw.ball_valve_move(0)
+    clock.sleep(0.5)
+    m = {}
+    for direction, start, end, key in ((1, -1, 1, "open_time"), (-1, 1, -1, "close_time")):
+        if not ok: break
+        t0 = clock.now_ns()
+        corehw.ball_valve_move(direction)
+        t_left = _wait_for_switches(0)
+        t_end = _wait_for_switches(end)
         corehw.ball_valve_move(0)
-        forward_motion = False
-        reverse_motion = False
-        return
-    # Head toward the target
-    if positional_error > 0:
+        clock.sleep(0.5)
+        if t_left is None or t_end is None:
+            ok = False
+            break
+        m[key] = (t_end - t_left) / 1_000_000
+        m.setdefault("latencies", []).append((t_left - t0) / 1_000_000)
+    if ok:
+        latency = sum(m["latencies"]) / len(m["latencies"])
         corehw.ball_valve_move(1)
-        forward_motion = True
-        reverse_motion = False 
-    else:
+        clock.sleep(pulse / 1000.0)
+        corehw.ball_valve_move(0)
+        clock.sleep(0.5)
+        t0 = clock.now_ns()
         corehw.ball_valve_move(-1)
-        forward_motion = False
-        reverse_motion = True
+        t_end = _wait_for_switches(-1)
+        corehw.ball_valve_move(0)
+        if t_end is None: ok = False
+    # The valve is closed (or lost), and at rest.
+    drive = last_drive = 0
+    drive_time = anchor_time = clock.now_ns()
+    anchor_position = current_position = target_position = 0.0
+    last_switches = corehw.check_ball_valve()
+    forward_motion = reverse_motion = reset_mode = fullon_mode = False
+    if not ok: return None
+    position = ((t_end - t0) / 1_000_000 - latency) / m["close_time"] * 100
+    model["open_time"] = m["open_time"]
+    model["close_time"] = m["close_time"]
+    model["start_latency"] = latency
+    model["coast"] = max(0.0, position / 100 * m["open_time"] - pulse + latency)
+    save_model()
+    model_loaded = True
+    return model
+
+def _next_check(t):
+    """ Returns when the heartbeat next needs to run: the planned relay off, the
+    next read of the limit switches, the end of the coast, or the next step of a
+    ramp.  None if at rest."""
+    times = []
+    if next_ramp_time is not None: times.append(next_ramp_time)
+    if relay_off_time is not None: times.append(relay_off_time)
+    if drive != 0: times.append(last_switch_poll + switch_poll_period * 1_000_000)
+    if coasting(t): times.append(drive_time + _coast_ns() + 1)
+    if len(times) == 0: return None
+    return min(times)
 
     
     
@@ -170,4 +538,3 @@ def heartbeat():
     
 
         
-
@@ -0,0 +1,73 @@
+# bench_spouts.py -- Measures how long it takes to switch a spout pattern, and the
+# skew between the first and the last spout of the pattern, for both ways of
+# writing the spouts (see corehw.set_spouts).
+# dlb, Oct 2026
+#
+# Usage:  python bench_spouts.py [repeats]
+#
+# This really switches the spout solenoids, but only for a few microseconds at a
+# time, which is too short for them to open.  Even so, shut the master valve
+# before running it on the pad.
+#
+# For the gpiozero devices, the skew is the time from the first spout write to the
+# last one.  A bank write changes every spout with one register write, so its skew
+# is zero; its latency is the time for that one write.
+
+import sys
+import time
+import corehw
+
+patterns = ("center", "minor_row_1", "major_row_2", "corners", "diagonal_1", "outside_box", "all")
+
+def _mask(name):
+    if name == "all": return corehw.all_spouts_mask
+    return corehw.pattern_mask(name)
+
+def time_devices(mask, repeats):
+    """ Returns (latency, skew), in microseconds, writing the pattern with the gpiozero devices."""
+    devices = [w for i, w in enumerate(corehw.waterspouts) if mask & (1 << i)]
+    latency = 0
+    skew = 0
+    for r in range(repeats):
+        t0 = time.perf_counter_ns()
+        t_first = 0
+        for w in devices:
+            w.on()
+            if t_first == 0: t_first = time.perf_counter_ns()
+        t1 = time.perf_counter_ns()
+        for w in devices: w.off()
+        latency += t1 - t0
+        skew += t1 - t_first
+    return latency / repeats / 1000, skew / repeats / 1000
+
+def time_bank(mask, repeats):
+    """ Returns (latency, skew), in microseconds, writing the pattern with one bank write."""
+    latency = 0
+    for r in range(repeats):
+        t0 = time.perf_counter_ns()
+        corehw.write_spouts_bank(mask, 0)
+        t1 = time.perf_counter_ns()
+        corehw.write_spouts_bank(0, mask)
+        latency += t1 - t0
+    return latency / repeats / 1000, 0.0
+
+def main():
+    repeats = 200
+    if len(sys.argv) > 1: repeats = int(sys.argv[1])
+    corehw.all_off()
+    if corehw.spout_bank is None:
+        print("Bank writes are not available (is pigpiod running?).  Timing gpiozero only.")
+    print("%-14s %7s %14s %11s %14s %11s" % ("Pattern", "Spouts", "gpiozero (us)", "skew (us)", "bank (us)", "skew (us)"))
+    for name in patterns:
+        mask = _mask(name)
+        n = bin(mask).count("1")
+        dev_lat, dev_skew = time_devices(mask, repeats)
+        if corehw.spout_bank is not None:
+            bank_lat, bank_skew = time_bank(mask, repeats)
+            print("%-14s %7d %14.1f %11.1f %14.1f %11.1f" % (name, n, dev_lat, dev_skew, bank_lat, bank_skew))
+        else:
+            print("%-14s %7d %14.1f %11.1f %14s %11s" % (name, n, dev_lat, dev_skew, "-", "-"))
+    corehw.all_off()
+
+if __name__ == '__main__':
+    main()
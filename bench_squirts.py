@@ -0,0 +1,152 @@
+# bench_squirts.py -- Measures how accurately the shipped scripts switch the spouts,
+# running them through the conductor on the simulated hardware (see hw_sim.py).
+# dlb, Oct 2026
+#
+# Usage:  python bench_squirts.py [--timeline] [--spin us] [seconds_per_program] [program_name ...]
+#
+# Each program is played for the given time (20 seconds by default), and every
+# spout change and the end of every pause is traced (see wsp_proc.set_trace).  The
+# traced changes are matched with the spout edges recorded by hw_sim, and for each
+# program this prints, in milliseconds:
+#
+#   start    -- How late the spouts turned on, from when the statement was due.
+#   end      -- How late a squirt turned its spouts off, from when it was due.
+#   duration -- The error in how long each squirt's spouts were on.
+#   pause    -- How far each pause overshot.
+#
+# each as p50 / p99 / max, and the CPU time used (by the whole process) per minute
+# of the program.  Real time is used, so a run takes as long as it says.  With
+# --timeline, the programs are played from rendered timelines (see wsp_timeline.py)
+# where they can be; the squirts then show up as plain on and off events, so the
+# end and duration columns are empty.  --spin sets wsp_timeline.spin_time, so the
+# timelines are played by spinning that many microseconds before each event.
+#
+# The conductor's timing is turned on for the run, and at the end it prints how late
+# the loop woke up for its deadlines, and how long each task took to run, in us.
+
+import os
+import sys
+import bisect
+import time
+
+os.environ["SPLASH_HW"] = "sim"
+
+import hw_sim
+import corehw
+import wsp_proc
+import wsp_timeline
+import conductor
+import histogram
+
+match_window = 50_000_000     # An edge must come within this many ns of its trace to match
+
+events = []                   # Of (event, due, t, mask), from the trace
+use_timeline = False          # Set by --timeline
+
+def _trace(event, due, t, mask):
+    events.append((event, due, t, mask))
+
+def _edges_by_pin(edges):
+    """ Returns pin -> (times, values) of the edges, in time order."""
+    by_pin = {}
+    for t, pin, value in edges:
+        if pin not in by_pin: by_pin[pin] = ([], [])
+        by_pin[pin][0].append(t)
+        by_pin[pin][1].append(value)
+    return by_pin
+
+def _find_edge(by_pin, pin, value, t):
+    """ Returns the time of the first edge of the pin to the value at or after t, or None."""
+    if pin not in by_pin: return None
+    times, values = by_pin[pin]
+    i = bisect.bisect_left(times, t)
+    while i < len(times) and times[i] - t <= match_window:
+        if values[i] == value: return times[i]
+        i += 1
+    return None
+
+def _spouts(mask):
+    return [i for i in range(len(corehw.waterspouts)) if mask & (1 << i)]
+
+def analyze(edges):
+    """ Matches the traced events with the edges.  Returns the histograms, and the
+    number of changes that had no edge because the spout was already in that state."""
+    by_pin = _edges_by_pin(edges)
+    h = {"start": histogram.Histogram(), "end": histogram.Histogram(),
+         "duration": histogram.Histogram(), "pause": histogram.Histogram()}
+    unchanged = 0
+    squirt_on = {}            # Spout -> (edge time, t of the squirt statement)
+    for event, due, t, mask in events:
+        if event == "pause":
+            h["pause"].record(t - due)
+            continue
+        value = 1 if event in ("on", "squirt") else 0
+        for i in _spouts(mask):
+            edge = _find_edge(by_pin, corehw.waterspouts[i].pin, value, t)
+            if edge is None:
+                unchanged += 1
+                continue
+            if value == 1:
+                h["start"].record(edge - due)
+                if event == "squirt": squirt_on[i] = (edge, t)
+                else: squirt_on.pop(i, None)
+                continue
+            if event != "squirt_end": continue
+            h["end"].record(edge - due)
+            if i in squirt_on:
+                on_edge, on_t = squirt_on.pop(i)
+                h["duration"].record(abs((edge - on_edge) - (due - on_t)))
+    return h, unchanged
+
+def _ms(summary, key):
+    return summary[key] / 1000.0
+
+def run_program(name, seconds):
+    """ Plays one program and prints its numbers."""
+    conductor.command("stop")
+    time.sleep(0.5)
+    del events[:]
+    hw_sim.edge_log.clear()
+    cpu0 = time.process_time()
+    t0 = time.monotonic()
+    conductor.command("play", {"program": name, "timeline": use_timeline})
+    time.sleep(seconds)
+    elapsed = time.monotonic() - t0
+    cpu = time.process_time() - cpu0
+    conductor.command("stop")
+    time.sleep(0.1)
+    h, unchanged = analyze(list(hw_sim.edge_log))
+    columns = []
+    for key in ("start", "end", "duration", "pause"):
+        s = h[key].summary()
+        columns.append("%5d %6.2f/%6.2f/%6.2f" % (s["count"], _ms(s, "p50_us"), _ms(s, "p99_us"), _ms(s, "max_us")))
+    print("%-16s %s %7d %8.2f" % (name[:16], " ".join(columns), unchanged, cpu / elapsed * 60.0))
+
+def main():
+    global use_timeline
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] == "--timeline":
+        use_timeline = True
+        args = args[1:]
+    if len(args) > 1 and args[0] == "--spin":
+        wsp_timeline.spin_time = int(float(args[1]) * 1000)
+        args = args[2:]
+    seconds = 20.0
+    names = None
+    if len(args) > 0: seconds = float(args[0])
+    if len(args) > 1: names = args[1:]
+    conductor.init()
+    if names is None: names = wsp_proc.get_program_names()
+    wsp_proc.set_trace(_trace)
+    print("Times in ms, as count p50/p99/max.  %g seconds per program." % seconds)
+    header = ["%-26s" % k for k in ("start", "end", "duration", "pause")]
+    print("%-16s %s %7s %8s" % ("Program", " ".join(header), "no-edge", "cpu s/min"))
+    conductor.set_timing(True)
+    for name in names: run_program(name, seconds)
+    wsp_proc.set_trace(None)
+    print("\nLoop timing in us, as p50/p99/max:")
+    for name, s in conductor.get_timing().items():
+        print("%-16s %8.1f/%8.1f/%8.1f" % (name, s["p50_us"], s["p99_us"], s["max_us"]))
+
+if __name__ == '__main__':
+    main()
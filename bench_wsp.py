@@ -0,0 +1,124 @@
+# bench_wsp.py -- Compares the speed of the compiled WSP interpreter with the
+# original word-list interpreter (wsp_legacy.py).
+# dlb, Oct 2026
+#
+# Usage:  python bench_wsp.py [seconds_per_script]
+#
+# Each script in the wsp_scripts folder is run through both interpreters.  The
+# clock handed to the interpreters jumps 20 seconds on every call, so pauses,
+# squirts and flow changes finish right away and the numbers measure the cost of
+# the interpreter alone.  The hardware output functions are replaced with no-ops
+# while the benchmark runs, so it is safe to run on the pad: no water flows and
+# the ball valve does not move.
+#
+# It then checks for drift: a loop of a squirt, a pause and a few statements that
+# don't wait is run in simulated time, and each time round should take just as long
+# as the squirt and the pause.  It is run waking up right on time, and again waking
+# up drift_lateness late for every statement, as the loop on the pad can; the
+# lateness must not add up from one time round to the next.  It prints how much
+# longer each time round takes, and exits with status 1 if that is more than
+# drift_limit.
+
+import sys
+import time
+import random
+import corehw
+import wsp_proc as proc
+import wsp_legacy as legacy
+import wsp_timeline as timeline
+
+clock_step = 20_000_000_000     # Nanoseconds that the clock advances per statement
+batch = 1000                    # Steps to run between looks at the real clock
+
+drift_script = ['name "drift"', 'label top', 'set *x 0', 'inc *x 1', 'random *i 0 13',
+                'squirt *i 100', 'pause 50', 'goto top']
+drift_ideal = 150_000_000       # The squirt and the pause of drift_script, in ns
+drift_limit = 1_000             # Most drift per loop, in ns, that passes
+drift_lateness = 500_000        # How late each step is run in the second drift check, in ns
+
+def _no_op(*args):
+    pass
+
+def quiet_hardware():
+    """ Replaces the hardware output functions with no-ops."""
+    corehw.all_off = _no_op
+    corehw.turn_mask_on = _no_op
+    corehw.turn_mask_off = _no_op
+    corehw.turn_pattern_on = _no_op
+    corehw.turn_pattern_off = _no_op
+    corehw.ball_valve_move = _no_op
+
+def run_compiled(prg, seconds):
+    """ Runs the program with the compiled interpreter. Returns statements per second."""
+    random.seed(1)
+    proc.abort_program()
+    t = 0
+    count = 0
+    t_end = time.perf_counter() + seconds
+    t0 = time.perf_counter()
+    while time.perf_counter() < t_end:
+        if proc.get_current_program() is None: proc.start_program(prg["program_name"])
+        for i in range(batch):
+            t += clock_step
+            count += proc.step(t)
+    return count / (time.perf_counter() - t0)
+
+def run_legacy(prg, seconds):
+    """ Runs the program with the original interpreter. Returns statements per second."""
+    random.seed(1)
+    legacy.current_program = None
+    t = 0
+    count = 0
+    t_end = time.perf_counter() + seconds
+    t0 = time.perf_counter()
+    while time.perf_counter() < t_end:
+        if legacy.current_program is None: legacy.start_program(prg)
+        for i in range(batch):
+            t += clock_step
+            legacy.step(t)
+        count += batch
+    return count / (time.perf_counter() - t0)
+
+def check_drift(loops=100, lateness=0):
+    """ Runs drift_script for the number of loops in simulated time, running each
+    step lateness ns after it was due.  Returns how much longer than drift_ideal
+    each time round the loop took, in ns."""
+    tr = proc.Track("drift", proc.parse_program("drift", drift_script))
+    tr.out = timeline._RecordingOutput()
+    tr.live = False
+    tr.rng = random.Random(1)
+    tr.args = [corehw.duration, corehw.period]
+    starts = []
+    while len(starts) <= loops:
+        due = proc.next_step_time(tr)
+        if due is None: break
+        t = due + lateness
+        tr.lasttime_check = t
+        tr.due_time = due
+        tr.out.t = t
+        proc.step_track(tr, t)
+        for event in tr.out.events:
+            if event[1] != 0: starts.append(event[0])
+        tr.out.events = []
+    return (starts[-1] - starts[0]) / (len(starts) - 1) - drift_ideal
+
+def main():
+    seconds = 2.0
+    if len(sys.argv) > 1: seconds = float(sys.argv[1])
+    quiet_hardware()
+    proc.read_programs()
+    print("%-20s %14s %14s %8s" % ("Program", "Legacy st/s", "Compiled st/s", "Speedup"))
+    for prg in proc.programs:
+        old = run_legacy(prg, seconds)
+        new = run_compiled(prg, seconds)
+        print("%-20s %14.0f %14.0f %7.2fx" % (prg["program_name"], old, new, new / old))
+    ok = True
+    for lateness in (0, drift_lateness):
+        drift = check_drift(lateness=lateness)
+        print("Drift per loop, waking %d us late: %.0f ns -- %s" % (lateness // 1000, drift,
+              "ok" if abs(drift) <= drift_limit else "TOO MUCH"))
+        if abs(drift) > drift_limit: ok = False
+    if not ok: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
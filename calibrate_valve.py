@@ -0,0 +1,31 @@
+# calibrate_valve.py -- Measures how the ball valve moves, and saves the model.
+# dlb, Oct 2026
+#
+# Usage:  python calibrate_valve.py
+#
+# Runs ball_valve.calibrate(): the valve is closed, opened fully, closed fully, and
+# opened and closed a little, which takes about half a minute.  The model (travel
+# times, start latency and coast, in ms) is saved to ball_valve.model_file, and is
+# used from then on; the valve also keeps refining it as it runs.  Stop the web
+# site (and so the conductor) first: this drives the valve directly.
+#
+# With SPLASH_HW=sim it calibrates the simulated valve, on a virtual clock, in a
+# moment.
+
+import time
+import clock
+import corehw
+import ball_valve
+
+def main():
+    if corehw.simulated: clock.use_virtual(time.monotonic_ns())
+    print("Old model: %s" % ball_valve.model)
+    m = ball_valve.calibrate()
+    if m is None:
+        print("A limit switch was never reached.  Nothing was saved.")
+        return
+    for key, value in m.items(): print("%-14s %9.1f ms" % (key, value))
+    print("Saved to %s." % ball_valve.model_file)
+
+if __name__ == '__main__':
+    main()
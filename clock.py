@@ -0,0 +1,84 @@
+# clock.py -- The time, for the parts of the splash pad that keep time.
+# dlb, Oct 2026
+
+# Normally this is just time.monotonic_ns().  For fast-forward simulation (see
+# sim_run.py) the clock is made virtual: it stands still until it is moved forward,
+# and the simulation moves it straight to the next deadline instead of waiting.
+#
+# The players, the ball valve, the LEDs and the simulated hardware (hw_sim.py) all
+# take the time from here.  The PSI sampler and the timing histograms use the real
+# clock, since they deal with real threads and real serial ports.
+#
+# call_at() lets the simulated hardware act on its own at a given time, as the real
+# hardware does (a limit switch closing, say).  With the real clock it uses a timer
+# thread; with a virtual one, the call is made when the clock is moved past it.
+
+import time
+import heapq
+import threading
+
+virtual_time = None            # The virtual time in ns, or None when using the real clock
+timers = []                    # Heap of (t, count, fn), the calls waiting for the virtual clock
+timer_count = 0                # Breaks ties in timers
+
+def now_ns():
+    """ Returns the current time, in nanoseconds."""
+    if virtual_time is None: return time.monotonic_ns()
+    return virtual_time
+
+def is_virtual():
+    return virtual_time is not None
+
+def use_virtual(t=0):
+    """ Switches to a virtual clock that starts at t (in ns)."""
+    global virtual_time, timers
+    virtual_time = t
+    timers = []
+
+def use_real():
+    """ Switches back to the real clock."""
+    global virtual_time, timers
+    virtual_time = None
+    timers = []
+
+def advance_to(t):
+    """ Moves the virtual clock forward to t, making the calls of call_at() that come
+    due on the way, each at its own time.  It never goes backward."""
+    global virtual_time
+    while len(timers) > 0 and timers[0][0] <= t:
+        due, n, fn = heapq.heappop(timers)
+        if due > virtual_time: virtual_time = due
+        fn()
+    if t > virtual_time: virtual_time = t
+
+def sleep(seconds):
+    """ Sleeps.  With a virtual clock it just moves the clock forward."""
+    if virtual_time is None:
+        time.sleep(seconds)
+        return
+    advance_to(virtual_time + int(seconds * 1_000_000_000))
+
+def call_at(t, fn):
+    """ Calls fn() at time t (in ns): from a timer thread with the real clock, or
+    from advance_to() with a virtual one."""
+    global timer_count
+    if virtual_time is None:
+        timer = threading.Timer(max(0, t - time.monotonic_ns()) / 1e9, fn)
+        timer.daemon = True
+        timer.start()
+        return
+    timer_count += 1
+    heapq.heappush(timers, (t, timer_count, fn))
+
+def next_timer():
+    """ Returns the time of the next call waiting for the virtual clock, or None."""
+    if len(timers) == 0: return None
+    return timers[0][0]
+
+def wait_until(t):
+    """ Waits, without sleeping, until time t.  Spins on the real clock; with a
+    virtual clock it just moves the clock forward."""
+    if virtual_time is not None:
+        advance_to(t)
+        return
+    while time.monotonic_ns() < t: pass
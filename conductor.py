@@ -4,53 +4,104 @@
 # Possible commands:
 #
 #   off          -- Shuts down all spouts. Stops the playing of a program
-#   play         -- Plays a program. params: program name 
+#   play         -- Plays a program. params: program name, and timeline (True to play
+#                   it from a timeline rendered in advance, if it can be -- see wsp_timeline.py)
+#   play_track   -- Plays a program on a track, alongside any others.  params: program, track
+#   stop_track   -- Stops the program on a track.  params: track
 #   flow         -- Sets the flow to a percentage 0-100
+#   ramp_flow    -- Ramps the flow smoothly to a percentage.  params: position, and
+#                   duration (ms) or rate (percent per second), and optionally start
+#                   (percent) and easing (see ball_valve.easings)
 #   spout        -- Turns a spout on for a period of time. params: spount number, duration.
 #   blink        -- Blinks the status light. params: color, rate, duty
 #   pattern      -- Turns a pattern of spouts on for a period of time. params:
 #                   pattern name, duration.
+#   timing       -- Turns the timing of the loop and its tasks on or off, and/or clears
+#                   it.  params: enabled, reset.  It is off to start with; while it
+#                   is on, get_status includes it.
+#   reload       -- Reloads the scripts that changed on disk (see wsp_cache.py).  The
+#                   folder is also checked every few seconds without being asked.
+#
+# Commands are queued in order (see command()).  A few commands are coalesced with the
+# command at the end of the queue: repeated "higher" or "lower" clicks are summed, a 
+# newer "set_flow", "ramp_flow" or "flow_increment" replaces an older one, and "stop"
+# discards everything that is still waiting.  The queue is bounded; when it is full new
+# commands are dropped.  The counts are reported in the status under "commands".
 #
 # Note: the background task is a daemon which means it will die when the program
 # exits.  Therefore, the caller is responsible for turning off the waterspounts 
 # before exiting.
 #
-# The backgound task runs in a loop.  Each iteration of the loop occurs every millisecond.
-# The 
+# The backgound task runs in a loop.  Each subsystem (the LEDs, the ball valve, the
+# players, and the status update) is a task of the scheduler, and reports when it next
+# needs to run.  The loop sleeps until the earliest of those deadlines, or until a 
+# command arrives.  See scheduler.py.
 #
 
 
 import corehw
 import threading
 import time
+import clock
 import copy 
+import collections
+import types
 import pad_leds
 import ball_valve
 import wsp_proc as proc
+import wsp_timeline as timeline
+import wsp_cache
 import spout_player as player
+import scheduler
+import psi_sampler
+import histogram
 cmd_lock = threading.Lock()
-status_lock = threading.Lock()
 conductor_inited = False
 
-pending_cmd = ""
-pending_cmd_waiting = False
-pending_cmd_args = None
+cmd_queue = collections.deque()    # Of (cmd, args), oldest first.  Protected by cmd_lock.
+max_queued_cmds = 32
+cmd_counts = {"enqueued": 0, "coalesced": 0, "dropped": 0, "executed": 0}
 loop_count = 0
-pad_status = { }
+# The status is published as an immutable snapshot: a tuple of (seq, status), where
+# status is a read-only view of a dict that is never changed once published.  Each
+# update builds a new dict and swaps the tuple in with one assignment, so neither
+# the loop nor the readers ever wait on each other.  seq goes up by one only when
+# something in the status changed, so a reader can skip its work if seq is the same
+# as last time.  So that it doesn't change on every update, the snapshot leaves out
+# what changes with every PSI sample (its time and the counts -- get_status adds
+# them when it is read), and the PSI readings only count as changed when they move
+# by psi_resolution or more.
+status_snapshot = (0, types.MappingProxyType({}))
+psi_resolution = 0.1  # PSI
 
 flow_increment = 2.5  # Percentage of flow change
+status_period = 50    # Milliseconds between status updates
+wake_lateness = histogram.Histogram()   # How late the loop wakes up for a deadline
+
+def _abort_programs():
+    """ Stops the WSP programs, whether live or played from a timeline."""
+    timeline.stop()
+    proc.abort_program()
 
 def _execute_cmd(cmd, args={}):
     global flow_increment
     if cmd == "stop":
-        proc.abort_program()
+        _abort_programs()
         player.abort_program() 
         corehw.all_off()
         pad_leds.set_flow_activity(False)
         pad_leds.set_sequence_activity(1000, 0)
         return
+    if cmd == "play_track":         # Plays a program on a track, alongside the others. params: program, track
+        if "program" not in args or "track" not in args: return
+        pad_leds.set_flow_activity(True)
+        proc.start_program(args["program"], args["track"])
+        return
+    if cmd == "stop_track":         # Stops the program on one track. params: track
+        if "track" in args: proc.stop_track(args["track"])
+        return
     if cmd == "play":               # Plays the given program.
-        proc.abort_program()
+        _abort_programs()
         player.abort_program()
         corehw.all_off()
         pad_leds.set_flow_activity(False)
@@ -58,15 +109,20 @@ def _execute_cmd(cmd, args={}):
         if "program" not in args: return 
         pad_leds.set_flow_activity(True)
         pad_leds.set_sequence_activity(500, 50)
+        if args.get("timeline", False) and timeline.start(args["program"]): return
         proc.start_program(args["program"])
         return
     if cmd == "one_shot":           # Fires one spout
-        proc.abort_program()
+        _abort_programs()
         prog_args = copy.deepcopy(args)
         if "spout" not in prog_args: return 
         if "duration" not in args: prog_args["duration"] = corehw.duration
         player.set_program("one_shot", prog_args)
         return
+    if cmd == "ring":           # Runs each spout briefly in turn. params: on, off (ms)
+        _abort_programs()
+        player.set_program("ring", args)
+        return
     if cmd == "reset":          # resets the flow
         ball_valve.reset_to_zero()
         return
@@ -75,14 +131,19 @@ def _execute_cmd(cmd, args={}):
         if args["position"] >= 100: ball_valve.reset_to_fullon()
         else: ball_valve.set_position(args["position"])
         return
-    if cmd == "higher":         # Sets the flow up
-        new_targ = ball_valve.get_current_target() + flow_increment
+    if cmd == "ramp_flow":      # Ramps the flow to a given percentage, over a duration or at a rate
+        if "position" not in args: return
+        ball_valve.ramp(args["position"], args.get("duration"), args.get("start"),
+                        args.get("easing", "linear"), args.get("rate"))
+        return
+    if cmd == "higher":         # Sets the flow up, by flow_increment times the number of steps
+        new_targ = ball_valve.get_current_target() + flow_increment * args.get("steps", 1)
         if new_targ < 0: new_targ = 0
         if new_targ > 100: new_targ = 100
         ball_valve.set_position(new_targ)
         return
-    if cmd == "lower":          # Sets the flow down
-        new_targ = ball_valve.get_current_target() - flow_increment
+    if cmd == "lower":          # Sets the flow down, by flow_increment times the number of steps
+        new_targ = ball_valve.get_current_target() - flow_increment * args.get("steps", 1)
         if new_targ < 0: new_targ = 0
         if new_targ > 100: new_targ = 100
         ball_valve.set_position(new_targ)
@@ -91,68 +152,95 @@ def _execute_cmd(cmd, args={}):
         if "flow_increment" not in args: return
         flow_increment = args["flow_increment"]
         return
+    if cmd == "timing":         # Turns the timing histograms on or off, and/or clears them
+        if "enabled" in args: set_timing(args["enabled"])
+        if args.get("reset", False): reset_timing()
+        return
+    if cmd == "reload":         # Reloads the scripts that changed.  Running programs carry on.
+        wsp_cache.reload()
+        return
 
-def _update_status():
-    global status_dict
-    psi = corehw.get_psi()
-    if psi is None: psi = (-1, -1)
+def _update_status(t):
+    """ Updates the status.  Runs as a task of the scheduler."""
+    psi = psi_sampler.latest()
+    if psi is None: psi = (t, -1, -1)
     bs = corehw.check_ball_valve()
     full_open, full_close = False, False
     if bs > 0: full_open = True 
     if bs < 0: full_close = True
     flow_percent = ball_valve.get_current_position()
-    status_lock.acquire()
-    pad_status["psi_input"] = psi[0]
-    pad_status["psi_output"] = psi[1]
-    pad_status["flow_percent"] = flow_percent 
-    pad_status["flow_fully_opened"] = full_open
-    pad_status["flow_fully_closed"] = full_close
-    pad_status["duration"] = corehw.duration 
-    pad_status["period"] = corehw.period
-    status_lock.release()
+    global status_snapshot
+    s = {}
+    s["psi_input"] = psi[1]
+    s["psi_output"] = psi[2]
+    s["flow_percent"] = flow_percent 
+    s["flow_fully_opened"] = full_open
+    s["flow_fully_closed"] = full_close
+    s["flow_calibrated"] = ball_valve.model_loaded
+    s["duration"] = corehw.duration 
+    s["period"] = corehw.period
+    s["commands"] = types.MappingProxyType(get_command_counts())
+    s["program"] = proc.get_current_program()
+    s["line"] = proc.get_current_line()
+    if s["program"] is None and timeline.get_current_program() is not None:
+        s["program"] = timeline.get_current_program()
+        s["line"] = timeline.get_current_line()
+    s["tracks"] = proc.get_tracks()
+    s["spouts"] = corehw.get_spout_state()
+    seq, last = status_snapshot
+    if _status_changed(s, last): status_snapshot = (seq + 1, types.MappingProxyType(s))
+    return t + status_period * 1_000_000
+
+def _status_changed(s, last):
+    """ Returns True if a new status differs from the last one published, apart from
+    noise in the PSI readings."""
+    if s.keys() != last.keys(): return True
+    for name, v in s.items():
+        if name == "psi_input" or name == "psi_output":
+            if abs(v - last[name]) >= psi_resolution: return True
+        elif v != last[name]: return True
+    return False
 
 def _conduct():
-    """ Do actual work.  Should be called once per millisecond.  """
-    global pending_cmd, pending_cmd_waiting, pending_cmd_args
+    """ Do actual work: run a new command, if any, and then all the tasks that are due.
+    Returns the time (in ns) of the next deadline, or None. """
     global loop_count 
     loop_count += 1 
-    # Do we have a new command?  Check once every 10 ms
-    if loop_count % 10 == 0:
-        newcmd = "" 
-        newcmd_args = None
+    scheduler.begin_pass()
+    t = clock.now_ns()
+    if len(cmd_queue) > 0:
         cmd_lock.acquire()
-        if pending_cmd_waiting:
-            newcmd = pending_cmd
-            newcmd_args = pending_cmd_args
-            pending_cmd = ""
-            pending_cmd_args = None
-            pending_cmd_waiting = False
+        cmds = list(cmd_queue)
+        cmd_queue.clear()
+        cmd_counts["executed"] += len(cmds)
         cmd_lock.release()
-        if newcmd != "": _execute_cmd(newcmd, newcmd_args)
-        _update_status()
-    pad_leds.heartbeat()
-    ball_valve.heartbeat() 
-    player.heartbeat()
-    proc.heartbeat()
+        for cmd, args in cmds:
+            _execute_cmd(cmd, args)
+        scheduler.wake()
+    return scheduler.run_due(t)
 
 def _run_conductor():
     """ The main entry point for the background task. """
     global conductor_inited
-    loop_start_time = time.monotonic_ns() 
+    scheduler.add_task("pad_leds", pad_leds.heartbeat)
+    scheduler.add_task("ball_valve", ball_valve.heartbeat)
+    scheduler.add_task("spout_player", player.heartbeat)
+    scheduler.add_task("wsp_proc", proc.heartbeat)
+    scheduler.add_task("wsp_timeline", timeline.heartbeat)
+    scheduler.add_task("status", _update_status)
+    psi_sampler.start()
     pad_leds.set_run_period(1000, 25)
     ball_valve.reset_to_zero()
-    proc.read_programs()
+    wsp_cache.load_programs()
+    scheduler.add_task("wsp_cache", wsp_cache.heartbeat)
+    wsp_cache.start()
     conductor_inited = True
     while True:
-        # Try to keep the loop on a 1 microsecond cadance.
-        current_time = time.monotonic_ns() 
-        elp = (current_time - loop_start_time) / 1_000_000.0  # elp in milliseconds
-        if elp < 1.0:
-            # Need to sleep (and yield) for remainder. 
-            time_to_sleep = (1.0 - elp) / 1000.0  
-            time.sleep(time_to_sleep)
-        loop_start_time = time.monotonic_ns()
-        _conduct()
+        next_deadline = _conduct()
+        scheduler.sleep_until(next_deadline)
+        if scheduler.timing_enabled and next_deadline is not None:
+            lateness = clock.now_ns() - next_deadline
+            if lateness >= 0: wake_lateness.record(lateness)
 
 ## -------------------------------------------------------------------------------
 ## Public Interface Functions 
@@ -165,28 +253,100 @@ def init():
         if conductor_inited == True: return 
         time.sleep(0.100)
 
+def _coalesce(cmd, args):
+    """ Tries to merge the command into the one at the end of the queue.  Returns 
+    True if it was merged.  Must be called with cmd_lock held."""
+    if cmd == "stop":
+        # Nothing that is waiting matters anymore.
+        cmd_counts["coalesced"] += len(cmd_queue)
+        cmd_queue.clear()
+        return False
+    if len(cmd_queue) == 0: return False
+    last_cmd, last_args = cmd_queue[-1]
+    if last_cmd != cmd: return False
+    if cmd == "higher" or cmd == "lower":
+        last_args["steps"] = last_args.get("steps", 1) + args.get("steps", 1)
+        return True
+    if cmd == "set_flow" or cmd == "ramp_flow" or cmd == "flow_increment":
+        cmd_queue[-1] = (cmd, args)
+        return True
+    return False
+
 def command(cmd, args={}):
     """ Issues a command to the splash pad. cmd is the name of the command and
-    args is a dict of arguments for the cmd."""
-    global pending_cmd, pending_cmd_waiting, pending_cmd_args
+    args is a dict of arguments for the cmd.  Returns False if the command was 
+    dropped because too many commands are waiting."""
+    args = copy.deepcopy(args)
+    cmd_lock.acquire()
+    if _coalesce(cmd, args):
+        cmd_counts["coalesced"] += 1
+    elif len(cmd_queue) >= max_queued_cmds:
+        cmd_counts["dropped"] += 1
+        cmd_lock.release()
+        return False
+    else:
+        cmd_queue.append((cmd, args))
+        cmd_counts["enqueued"] += 1
+    cmd_lock.release()
+    scheduler.notify()
+    return True
+
+def get_command_counts():
+    """ Returns a dictionary with the number of commands that have been enqueued,
+    coalesced, dropped and executed."""
     cmd_lock.acquire()
-    pending_cmd = cmd  
-    pending_cmd_args = copy.deepcopy(args)
-    pending_cmd_waiting = True 
+    counts = dict(cmd_counts)
+    counts["waiting"] = len(cmd_queue)
     cmd_lock.release()
+    return counts
 
 def update_arguments(args):
     """ Updates the arguments to a currently running command. """
     player.update_arguments(args)
+    proc.refresh()
+    timeline.arguments_changed()
+
+def get_snapshot():
+    """ Returns the current status snapshot, (seq, status).  status is read only, and
+    so are the mappings in it.  See _update_status for a list of parameters."""
+    return status_snapshot
 
 def get_status():
-    """ Returns a dictionary of parameters that describes the state of the pad. 
-    See _update_status for a list of parameters."""
-    status_lock.acquire()
-    s = copy.deepcopy(pad_status)
-    status_lock.release()
+    """ Returns a dictionary of parameters that describes the state of the pad, 
+    which the caller may change.  See _update_status for a list of parameters.  
+    Also includes psi_time, the time of the newest PSI reading, psi_age_ms, its age,
+    psi_counts (see psi_sampler.get_counts), and the timing if it is enabled."""
+    seq, snapshot = status_snapshot
+    s = {}
+    for name, v in snapshot.items():
+        if isinstance(v, types.MappingProxyType): v = dict(v)
+        s[name] = v
+    t = time.monotonic_ns()
+    psi = psi_sampler.latest()
+    if psi is None: psi = (t, -1, -1)
+    s["psi_time"] = psi[0]
+    s["psi_age_ms"] = (t - psi[0]) / 1_000_000
+    s["psi_counts"] = psi_sampler.get_counts()
+    if scheduler.timing_enabled: s["timing"] = get_timing()
     return s 
 
+def set_timing(enabled):
+    """ Turns the timing of the loop and its tasks on or off. """
+    scheduler.timing_enabled = enabled
+
+def reset_timing():
+    """ Clears the timing histograms. """
+    wake_lateness.reset()
+    for h in scheduler.task_times.values(): h.reset()
+
+def get_timing():
+    """ Returns the p50, p99 and max (in microseconds) of how late the loop wakes 
+    for a deadline ("lateness"), and of how long each task takes to run. """
+    timing = {"lateness": wake_lateness.summary()}
+    for name, h in list(scheduler.task_times.items()):
+        timing[name] = h.summary()
+    return timing
+
 
 
 
@@ -4,15 +4,29 @@
 #
 # Please see the "Splash Pad Documentation" Power Point for more
 # information
+#
+# Set the environment variable SPLASH_HW=sim to run with simulated hardware
+# (see hw_sim.py) instead of the real vault.
 
-import gpiozero
-import serial
+import os
 import time
+import threading
+import clock
+import spout_registry as spouts
+simulated = os.environ.get("SPLASH_HW", "") == "sim"
+if simulated:
+    import hw_sim as gpiozero
+    import hw_sim as serial
+    pigpio = None
+else:
+    import gpiozero
+    import serial
+    try:
+        import pigpio
+    except ImportError:
+        pigpio = None
 
-spout_names = ("a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m", "n",
-            "gate", "center", "corners", "inside_corners", "major_row_1", "major_row_2", "major_row_3",
-            "minor_row_1", "minor_row_2", "major_column_1", "major_column_2", "major_column_3",
-            "minor_column_1", "minor_column2", "diagonal_1", "diagonal_2", "outside_box", "inside_box")
+spout_names = spouts.pattern_names    # The pattern names, in pattern number order
 
 duration =  150   # Global value for duration
 period   = 1000   # Global value for period
@@ -29,134 +43,126 @@ run_led = gpiozero.LED(status_led_gpios[0], active_high=True, initial_value=Fals
 activity_led_red = gpiozero.LED(status_led_gpios[1], active_high=True, initial_value=False)
 activity_led_green = gpiozero.LED(status_led_gpios[2], active_high=True, initial_value=False)
 psi_port = serial.Serial("/dev/ttyAMA0", baudrate=921600, timeout=0.0005)
-ball_closed_switch = gpiozero.DigitalInputDevice(ball_valve_sensor_gpios[0], pull_up=True)
-ball_open_switch = gpiozero.DigitalInputDevice(ball_valve_sensor_gpios[1], pull_up=True)
+switch_bounce_time = 0.005   # Seconds.  gpiozero ignores limit switch edges closer together than this.
+ball_closed_switch = gpiozero.DigitalInputDevice(ball_valve_sensor_gpios[0], pull_up=True, bounce_time=switch_bounce_time)
+ball_open_switch = gpiozero.DigitalInputDevice(ball_valve_sensor_gpios[1], pull_up=True, bounce_time=switch_bounce_time)
 ball_valve_relay1 = gpiozero.DigitalOutputDevice(ball_valve_gpios[0], active_high=False, initial_value=False)
 ball_valve_relay2 = gpiozero.DigitalOutputDevice(ball_valve_gpios[1], active_high=False, initial_value=False)
 for iopin in waterspout_gpios:
     s = gpiozero.DigitalOutputDevice(iopin, active_high=False, initial_value=False)
     waterspouts.append(s)
+if simulated:
+    gpiozero.valve.connect(ball_valve_relay1, ball_valve_relay2, ball_closed_switch, ball_open_switch)
+    psi_port.spouts = waterspouts
 
-# Define Patterns
-# The layout of the water spouts is as follows:
-#
-#  A(0)      B(1)       C(2)
-#       D(3)       E(4)
-#  F(5)      G(6)       H(7)
-#       I(8)       J(9)
-#  K(10)     L(11)      M(12)
-#
-# And N(13) are the 5 spouts at the gate.
-
-ws_gate = [13]
-ws_center = [6]
-ws_corners = [0, 2, 10, 12]
-ws_inside_corners = [3, 4, 8, 9]
-ws_major_row_1 = [0, 1, 2]
-ws_major_row_2 = [5, 6, 7]
-ws_major_row_3 = [10, 11, 12]
-ws_minor_row_1 = [3, 4]
-ws_minor_row_2 = [8, 9]
-ws_major_column_1 = [0, 5, 10]
-ws_major_column_2 = [1, 6, 11]
-ws_major_column_3 = [2, 7, 12]
-ws_minor_column_1 = [3, 8]
-ws_minor_column_2 = [4, 9]
-ws_diagonal_1 = [0, 3, 6, 9, 12]
-ws_diagonal_2 = [2, 4, 6, 8, 10]
-ws_outside_box = [0, 1, 2, 5, 7, 10, 11, 12]
-ws_inside_box = [3, 4, 8, 9]
-
-ws_major_rows = [ws_major_row_1, ws_major_row_2, ws_major_row_3]
-ws_minor_rows = [ws_minor_row_1, ws_minor_row_2]
-ws_all_rows   = [ws_major_row_1, ws_minor_row_1, ws_major_row_2, ws_minor_row_2, ws_major_row_3]
-ws_major_columns = [ws_major_column_1, ws_major_column_2, ws_major_column_3]
-ws_minor_columns = [ws_minor_column_1, ws_minor_column_2]
-ws_all_columns = [ws_major_column_1, ws_minor_column_1, ws_major_column_2, ws_minor_column_2, ws_major_column_3]
-ws_all_diagonals = [ws_diagonal_1, ws_diagonal_2]
+# The ball valve's limit switches are read when they change: gpiozero calls
+# _valve_switches_changed() on every edge, from its own thread, and the result is
+# kept in valve_switches.  check_ball_valve() returns it without touching the GPIO.
+# Since a debounced edge can be missed, refresh_ball_valve_switches() reads the
+# pins again; the ball valve does that now and then while it moves.
+valve_switches = (0, 0)      # (state, time in ns that it changed).  State is as check_ball_valve().
+on_valve_switch = None       # If set, called as on_valve_switch(state, t) on each change, from gpiozero's thread
+_switch_lock = threading.Lock()
+
+# The waterspouts can be written one at a time through the gpiozero devices above, 
+# or all at once through the GPIO set/clear registers, which needs the pigpio daemon
+# (sudo pigpiod).  The register ("bank") writes change every spout in a pattern at 
+# the same instant.  If pigpio is not available, the gpiozero devices are used.
+use_bank_writes = True           # Set False to always use the gpiozero devices
+all_spouts_mask = (1 << len(waterspout_gpios)) - 1
+spout_state = 0                  # Bit n is set when waterspout n is on
+spout_bank = None                # The pigpio connection, when bank writes are in use
+_gpio_masks = {}                 # Cache of spout mask -> GPIO register mask
+
+def _open_spout_bank():
+    """ Connects to the pigpio daemon for bank writes.  Returns None if that's not possible."""
+    if not use_bank_writes: return None
+    if simulated: return gpiozero.Bank(waterspouts)
+    if pigpio is None: return None
+    pi = pigpio.pi()
+    if not pi.connected: return None
+    for iopin in waterspout_gpios: pi.set_mode(iopin, pigpio.OUTPUT)
+    return pi
+
+spout_bank = _open_spout_bank()
+
+# The spouts and their groups are named in spout_registry.py.
 
 def translate_spout_name(name):
+    """ Returns the spout numbers of a spout or group name, or of a spout number, as
+    a list.  Unknown names give an empty list."""
     if type(name) is int:
-        if name >= 0 and name <= 13: return [name]
+        if name >= 0 and name < spouts.spout_count: return [name]
         return [] 
     if type(name) is not str: return []
-    name = name.lower() 
-    if name == "a": return [0]
-    if name == "b": return [1]
-    if name == "c": return [2]
-    if name == "d": return [3]
-    if name == "e": return [4]
-    if name == "f": return [5]
-    if name == "g": return [6]
-    if name == "h": return [7]
-    if name == "i": return [8]
-    if name == "j": return [9]
-    if name == "k": return [10]
-    if name == "l": return [11]
-    if name == "m": return [12]
-    if name == "n": return [13]
-    if name == "gate": return ws_gate
-    if name == "center": return ws_center
-    if name == "corners": return ws_corners
-    if name == "inside_corners": return ws_inside_corners
-    if name == "major_row_1": return ws_major_row_1
-    if name == "major_row_2": return ws_major_row_2
-    if name == "major_row_3": return ws_major_row_3
-    if name == "minor_row_1": return ws_minor_row_1
-    if name == "minor_row_2": return ws_minor_row_2
-    if name == "major_column_1": return ws_major_column_1
-    if name == "major_column_2": return ws_major_column_2
-    if name == "major_column_3": return ws_major_column_3
-    if name == "minor_column_1": return ws_minor_column_1
-    if name == "minor_column_2": return ws_minor_column_2
-    if name == "diagonal_1": return ws_diagonal_1
-    if name == "diagonal_2": return ws_diagonal_2
-    if name == "outside_box": return ws_outside_box
-    if name == "inside_box": return ws_inside_box
-    return []
+    return list(spouts.spouts(name.lower()))
+
+def pattern_mask(arg):
+    """ Returns the pattern as a bitmask, where bit n is set if waterspout n is in
+    the pattern.  Accepts the same arguments as turn_pattern_on(). Unknown patterns
+    give a mask of zero."""
+    if type(arg) is int: return spouts.pattern_mask(arg)
+    if type(arg) is str: return spouts.mask(arg.lower())
+    if type(arg) is not list: return 0
+    mask = 0
+    for spout in arg:
+        if type(spout) is int and spout >= 0 and spout < spouts.spout_count: mask |= 1 << spout
+    return mask
+
+def gpio_mask(mask):
+    """ Converts a spout mask into a mask of GPIO numbers, for the register bank."""
+    gmask = _gpio_masks.get(mask)
+    if gmask is None:
+        gmask = 0
+        for i, iopin in enumerate(waterspout_gpios):
+            if mask & (1 << i): gmask |= 1 << iopin
+        _gpio_masks[mask] = gmask
+    return gmask
+
+def write_spouts_bank(on_mask, off_mask):
+    """ Writes the spouts with the GPIO set/clear registers. The spouts are active low."""
+    if off_mask: spout_bank.set_bank_1(gpio_mask(off_mask))
+    if on_mask: spout_bank.clear_bank_1(gpio_mask(on_mask))
+
+def write_spouts_devices(on_mask, off_mask):
+    """ Writes the spouts one at a time with the gpiozero devices."""
+    for i, w in enumerate(waterspouts):
+        bit = 1 << i
+        if on_mask & bit: w.on()
+        elif off_mask & bit: w.off()
+
+def set_spouts(on_mask, off_mask=0):
+    """ Turns on the spouts in on_mask and turns off the spouts in off_mask, as one write
+    if bank writes are in use.  A spout in both masks ends up on."""
+    global spout_state
+    spout_state = (spout_state & ~off_mask) | on_mask
+    if spout_bank is not None: write_spouts_bank(on_mask, off_mask)
+    else: write_spouts_devices(on_mask, off_mask)
+
+def get_spout_state():
+    """ Returns a mask of the spouts that are on. See pattern_mask()."""
+    return spout_state
 
 def all_off():
     """ Turn all waterspouts off."""
-    for w in waterspouts:
-        w.off()
+    set_spouts(0, all_spouts_mask)
+
+def turn_mask_on(mask):
+    """ Turns on the waterspouts whose bits are set in the mask. See pattern_mask()."""
+    set_spouts(mask, 0)
+
+def turn_mask_off(mask):
+    """ Turns off the waterspouts whose bits are set in the mask. See pattern_mask()."""
+    set_spouts(0, mask)
 
 def turn_pattern_on(arg):
-    """ Turns the waterspouts in the given pattern on."""
-    pattern = ""
-    if type(arg) is int:
-        if arg >=0 and arg < len(spout_names): 
-            pattern = spout_names[arg]
-        else: return
-    if type(arg) is str:
-        pattern = arg
-    if type(arg) is list: 
-        for i in arg:
-            if type(i) is int:
-                if i >= 0 and i <= 13: waterspouts[i].on()
-        return 
-    spouts = translate_spout_name(pattern)
-    for spout in spouts:
-        if spout < 0 or spout > 13: continue
-        waterspouts[spout].on()
+    """ Turns the waterspouts in the given pattern on. The pattern can be a name, a
+    pattern number (an index into spout_names), or a list of spout numbers."""
+    set_spouts(pattern_mask(arg), 0)
 
 def turn_pattern_off(arg):
     """ Turns the waterspouts in the given pattern off."""
-    pattern = ""
-    if type(arg) is int:
-        if arg >=0 and arg < len(spout_names): 
-            pattern = spout_names[arg]
-        else: return
-    if type(arg) is str:
-        pattern = arg
-    if type(arg) is list: 
-        for i in arg:
-            if type(i) is int:
-                if i >= 0 and i <= 13: waterspouts[i].off()
-        return 
-    spouts = translate_spout_name(pattern)
-    for spout in spouts:
-        if spout < 0 or spout > 13: continue
-        waterspouts[spout].off()
+    set_spouts(0, pattern_mask(arg))
 
 def fire_pattern(pattern, period=0.025):
     """ Fires all the spounts in the pattern for the given period (in seconds)."""
@@ -181,14 +187,40 @@ def ball_valve_move(direction):
         ball_valve_relay1.off()
         ball_valve_relay2.on() 
 
-def check_ball_valve():
-    """ Returns -1 if fully closed, +1 if fully opened, or zero if between opened and closed."""
+def read_ball_valve_switches():
+    """ Reads the limit switches.  Returns -1 if fully closed, +1 if fully opened, or
+    zero if between opened and closed."""
     s1 = ball_open_switch.value
     s2 = ball_closed_switch.value
     if s1 == True: return 1
     if s2 == True: return -1
     return 0
 
+def refresh_ball_valve_switches():
+    """ Reads the limit switches, and updates valve_switches if they have changed.
+    Returns the state, as check_ball_valve()."""
+    global valve_switches
+    with _switch_lock:
+        state = read_ball_valve_switches()
+        if state == valve_switches[0]: return state
+        t = clock.now_ns()
+        valve_switches = (state, t)
+    if on_valve_switch is not None: on_valve_switch(state, t)
+    return state
+
+def _valve_switches_changed():
+    refresh_ball_valve_switches()
+
+def check_ball_valve():
+    """ Returns -1 if fully closed, +1 if fully opened, or zero if between opened and
+    closed, as last seen by the limit switches' callbacks."""
+    return valve_switches[0]
+
+for _switch in (ball_closed_switch, ball_open_switch):
+    _switch.when_activated = _valve_switches_changed
+    _switch.when_deactivated = _valve_switches_changed
+valve_switches = (read_ball_valve_switches(), clock.now_ns())
+
 def time_ball_movement():
     """ Use this for developement.  Results: about 5.25 seconds to open, and 5.33 to close."""
     ball_valve_move(-1)
@@ -264,10 +296,10 @@ def get_psi():
         
 
 def ring(t1=0.05, t2=0.20):
-    for s in waterspouts:
-        s.on()
+    for i in range(len(waterspouts)):
+        turn_mask_on(1 << i)
         time.sleep(t1)
-        s.off()
+        turn_mask_off(1 << i)
         time.sleep(t2)
 
 
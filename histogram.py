@@ -0,0 +1,73 @@
+# histogram.py -- Fixed-bucket histograms of times, for timing the conductor.
+# dlb, Oct 2026
+
+# The buckets are spaced logarithmically: four to each doubling of the time, from
+# one microsecond up to about 70 minutes.  Recording a time is a few integer
+# operations and one array increment, so it can be done on every pass of the loop.
+# Percentiles are reported as the top of the bucket they fall in (but never more
+# than the maximum), so they err on the high side by at most a quarter of a
+# doubling.  The maximum is exact.
+
+import array
+
+sub_buckets = 4                   # Buckets per doubling
+num_buckets = 32 * sub_buckets
+
+def _bucket(us):
+    """ Returns the bucket for a time in microseconds."""
+    if us < sub_buckets: return us
+    octave = us.bit_length() - 1                          # us is in [2**octave, 2**(octave+1))
+    mantissa = (us >> (octave - 2)) & (sub_buckets - 1)   # Which quarter of that range
+    return octave * sub_buckets + mantissa - 4
+
+def _bucket_top(b):
+    """ Returns the top of a bucket, in microseconds."""
+    if b < sub_buckets: return b + 1
+    octave = (b + 4) // sub_buckets
+    mantissa = (b + 4) % sub_buckets
+    return (1 << octave) + (mantissa + 1) * (1 << (octave - 2))
+
+class Histogram:
+    """ A histogram of times.  Times are recorded in nanoseconds and reported in
+    microseconds."""
+
+    def __init__(self):
+        self.counts = array.array("Q", [0] * num_buckets)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        """ Records a time, in nanoseconds.  Negative times are counted as zero."""
+        if ns < 0: ns = 0
+        us = ns // 1000
+        b = _bucket(us)
+        if b >= num_buckets: b = num_buckets - 1
+        self.counts[b] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max: self.max = ns
+
+    def percentile(self, p):
+        """ Returns the time, in microseconds, below which p percent of the times fall."""
+        if self.count == 0: return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for b in range(num_buckets):
+            seen += self.counts[b]
+            if seen >= target: return min(float(_bucket_top(b)), self.max / 1000.0)
+        return self.max / 1000.0
+
+    def summary(self):
+        """ Returns a dictionary with the count, mean, p50, p99 and max, in microseconds."""
+        mean = 0.0
+        if self.count > 0: mean = self.total / self.count / 1000.0
+        return {"count": self.count, "mean_us": round(mean, 1), "p50_us": self.percentile(50),
+                "p99_us": self.percentile(99), "max_us": round(self.max / 1000.0, 1)}
+
+    def reset(self):
+        """ Clears the histogram."""
+        for b in range(num_buckets): self.counts[b] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
@@ -0,0 +1,335 @@
+# hw_sim.py -- Simulated hardware for the splash pad, so the software can run off the Pi.
+# dlb, Oct 2026
+
+# Set the environment variable SPLASH_HW=sim to use this instead of the real hardware.
+# corehw then builds its devices from the classes here, which stand in for the
+# gpiozero devices and the serial port:
+#
+#   DigitalOutputDevice, LED -- Record every change, with its time, in edge_log.  A
+#                               blinking LED records only that it started blinking.
+#   DigitalInputDevice       -- Reads its value from a function (the valve's limit switches),
+#                               and calls when_activated/when_deactivated on a change.
+#   Bank                     -- Stands in for the pigpio set/clear register writes.
+#   Serial                   -- Answers like the Pico that reads the PSI sensors, in all
+#                               the protocols of psi_protocol.py.
+#
+# The ball valve is modeled by the Valve class.  The relays drive it, it moves at the
+# measured rates of the real valve (about 5.3 seconds for the full span), it starts
+# a little late and coasts a little after the relay turns off, and it drives the open
+# and closed limit switches.
+
+import collections
+import random
+import threading
+import time
+import clock
+import psi_protocol
+
+edge_log = collections.deque(maxlen=200_000)    # Of (time_ns, gpio, value), for every output change
+
+class SerialException(Exception):
+    """ Stands in for serial.SerialException."""
+    pass
+
+class DigitalOutputDevice:
+    """ Stands in for gpiozero.DigitalOutputDevice.  value is the logical state: 1 is on,
+    whether the pin is active high or low."""
+
+    def __init__(self, pin, active_high=True, initial_value=False):
+        self.pin = pin
+        self.active_high = active_high
+        self.value = 0
+        self.on_change = None         # Called with the new value after each change
+        if initial_value: self.on()
+
+    def _set(self, value, t=None):
+        if value == self.value: return
+        if t is None: t = clock.now_ns()
+        self.value = value
+        edge_log.append((t, self.pin, value))
+        if self.on_change is not None: self.on_change(value)
+
+    def on(self):
+        self._set(1)
+
+    def off(self):
+        self._set(0)
+
+    def close(self):
+        pass
+
+class LED(DigitalOutputDevice):
+    """ Stands in for gpiozero.LED.  blink() turns the LED on and keeps its times in
+    blinking, rather than toggling it from a thread: the simulated clock may be
+    virtual, and nothing reads the LEDs back."""
+
+    def __init__(self, pin, active_high=True, initial_value=False):
+        self.blinking = None          # (on_time, off_time) in seconds while blinking, or None
+        super().__init__(pin, active_high, initial_value)
+
+    def blink(self, on_time=1, off_time=1, n=None, background=True):
+        self._set(1)
+        self.blinking = (on_time, off_time)
+
+    def on(self):
+        self.blinking = None
+        self._set(1)
+
+    def off(self):
+        self.blinking = None
+        self._set(0)
+
+class DigitalInputDevice:
+    """ Stands in for gpiozero.DigitalInputDevice.  The value comes from source, a
+    function that returns True when the input is active.  Whatever drives the source
+    calls check() when it may have changed, which calls when_activated or
+    when_deactivated, as gpiozero does on an edge.  There is no bounce to ignore."""
+
+    def __init__(self, pin, pull_up=False, bounce_time=None):
+        self.pin = pin
+        self.pull_up = pull_up
+        self.bounce_time = bounce_time
+        self.source = None
+        self.when_activated = None
+        self.when_deactivated = None
+        self.last_value = None
+
+    def check(self):
+        value = self.value
+        if value == self.last_value: return
+        first = self.last_value is None
+        self.last_value = value
+        if first: return
+        fn = self.when_activated if value else self.when_deactivated
+        if fn is not None: fn()
+
+    @property
+    def value(self):
+        if self.source is None: return 0
+        return 1 if self.source() else 0
+
+    def close(self):
+        pass
+
+class Bank:
+    """ Stands in for the pigpio connection used for bank writes.  Every GPIO in a write
+    changes at the same time.  The outputs are active low, like the real spouts."""
+
+    def __init__(self, devices):
+        self.devices = {}
+        for d in devices: self.devices[d.pin] = d
+
+    def _write(self, gmask, level):
+        t = clock.now_ns()
+        for pin, d in self.devices.items():
+            if gmask & (1 << pin):
+                if d.active_high: d._set(level, t)
+                else: d._set(1 - level, t)
+
+    def set_bank_1(self, gmask):
+        self._write(gmask, 1)
+
+    def clear_bank_1(self, gmask):
+        self._write(gmask, 0)
+
+class Valve:
+    """ A model of the ball valve.  Position is in percent open."""
+
+    open_time = 5250          # Milliseconds to open fully, once moving
+    close_time = 5330         # Milliseconds to close fully, once moving
+    start_delay = 40          # Milliseconds from relay on until the valve moves
+    coast = 25                # Milliseconds the valve keeps moving after the relay turns off
+
+    def __init__(self, position=50.0):
+        self.lock = threading.Lock()
+        self.position = position
+        self.drive = 0                # -1, 0 or +1, from the relays
+        self.last_drive = 0           # The drive before the last change, for coasting
+        self.changed_at = clock.now_ns()
+        self.updated_at = self.changed_at
+        self.relay_open = None
+        self.relay_close = None
+        self.switches = ()
+
+    def connect(self, relay_open, relay_close, closed_switch, open_switch):
+        """ Wires the valve to the relays and the limit switches."""
+        self.relay_open = relay_open
+        self.relay_close = relay_close
+        relay_open.on_change = self._relays_changed
+        relay_close.on_change = self._relays_changed
+        closed_switch.source = self.is_closed
+        open_switch.source = self.is_open
+        self.switches = (closed_switch, open_switch)
+        self.check_switches()
+
+    def check_switches(self):
+        """ Has the limit switches call their callbacks if they have changed."""
+        for s in self.switches: s.check()
+
+    def _switch_times(self, t):
+        """ Returns the times after a relay change at t when a limit switch may change:
+        when the valve starts to move, when it would reach the end it is heading
+        for, and when it stops coasting."""
+        times = []
+        if self.drive != 0:
+            start = max(t, self.changed_at + self.start_delay * 1_000_000)
+            if self.drive > 0: span = 100.0 - self.position
+            else: span = self.position
+            times.append(start + 1)
+            times.append(start + int(span / abs(self._rate(self.drive))) + 1_000)
+        elif self.last_drive != 0:
+            times.append(self.changed_at + self.coast * 1_000_000 + 1)
+        return times
+
+    def _rate(self, direction):
+        """ Percent per nanosecond in the given direction."""
+        if direction > 0: return 100.0 / (self.open_time * 1_000_000)
+        return -100.0 / (self.close_time * 1_000_000)
+
+    def _move(self, direction, t0, t1):
+        """ Moves the valve in a direction for the part of [t0, t1) that has passed."""
+        if t1 <= t0 or direction == 0: return
+        self.position += self._rate(direction) * (t1 - t0)
+        if self.position > 100.0: self.position = 100.0
+        if self.position < 0.0: self.position = 0.0
+
+    def update(self, t=None):
+        """ Brings the position up to time t."""
+        if t is None: t = clock.now_ns()
+        if t <= self.updated_at: return
+        t0 = self.updated_at
+        if self.drive != 0:
+            self._move(self.drive, max(t0, self.changed_at + self.start_delay * 1_000_000), t)
+        elif self.last_drive != 0:
+            self._move(self.last_drive, t0, min(t, self.changed_at + self.coast * 1_000_000))
+        self.updated_at = t
+
+    def _relays_changed(self, value):
+        t = clock.now_ns()
+        with self.lock:
+            self.update(t)
+            drive = self.relay_open.value - self.relay_close.value
+            if drive == self.drive: return
+            self.last_drive = self.drive
+            self.drive = drive
+            self.changed_at = t
+            times = self._switch_times(t)
+        for when in times: clock.call_at(when, self.check_switches)
+
+    def get_position(self):
+        with self.lock:
+            self.update()
+            return self.position
+
+    def is_open(self):
+        return self.get_position() >= 100.0
+
+    def is_closed(self):
+        return self.get_position() <= 0.0
+
+valve = Valve()
+
+class Serial:
+    """ Stands in for serial.Serial, connected to a simulated Pico.  The readings follow
+    the valve and the spouts: the input pressure is steady, and the output pressure
+    rises with the valve and falls as more spouts are open."""
+
+    input_psi = 55.0
+    stream_rate = 200             # Frames per second while streaming
+
+    def __init__(self, port=None, baudrate=9600, timeout=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.rx = bytearray()
+        self.lock = threading.Condition()
+        self.seq = 0
+        self.streaming = False
+        self.next_frame = 0
+        self.spouts = []              # Set by corehw, to see how many spouts are open
+
+    def _reading(self):
+        """ Returns the raw (input, output) readings."""
+        open_spouts = 0
+        for s in self.spouts: open_spouts += s.value
+        psi_in = self.input_psi + random.uniform(-0.5, 0.5)
+        psi_out = psi_in * valve.get_position() / 100.0 * (1.0 - 0.03 * open_spouts)
+        raw_in = int(psi_in / 100.0 * 65536)
+        raw_out = int(max(psi_out, 0.0) / 100.0 * 65536)
+        return min(raw_in, 65535), min(raw_out, 65535)
+
+    def _frame(self):
+        self.seq = (self.seq + 1) & 0xFF
+        raw_in, raw_out = self._reading()
+        return psi_protocol.encode_frame(self.seq, raw_in, raw_out)
+
+    def _stream(self):
+        """ Adds the frames that are due while streaming."""
+        if not self.streaming: return
+        t = time.monotonic()
+        while t >= self.next_frame:
+            self.rx += self._frame()
+            self.next_frame += 1.0 / self.stream_rate
+
+    def write(self, data):
+        with self.lock:
+            for c in bytes(data):
+                cmd = bytes([c])
+                if cmd == psi_protocol.CMD_ASCII: self.rx += psi_protocol.encode_ascii(*self._reading())
+                elif cmd == psi_protocol.CMD_BINARY: self.rx += self._frame()
+                elif cmd == psi_protocol.CMD_STREAM_START:
+                    self.streaming = True
+                    self.next_frame = time.monotonic()
+                elif cmd == psi_protocol.CMD_STREAM_STOP: self.streaming = False
+            self.lock.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self._stream()
+            return len(self.rx)
+
+    def _take(self, n):
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def read(self, size=1):
+        """ Reads up to size bytes, waiting up to timeout for the first one."""
+        deadline = None
+        if self.timeout is not None: deadline = time.monotonic() + self.timeout
+        with self.lock:
+            while True:
+                self._stream()
+                if len(self.rx) > 0: return self._take(size)
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0: return b""
+                if self.streaming:
+                    to_frame = self.next_frame - time.monotonic()
+                    if wait is None or to_frame < wait: wait = max(to_frame, 0)
+                self.lock.wait(wait)
+
+    def read_all(self):
+        with self.lock:
+            self._stream()
+            return self._take(len(self.rx))
+
+    def read_until(self, expected=b"\n", size=None):
+        data = bytearray()
+        while size is None or len(data) < size:
+            c = self.read(1)
+            if len(c) == 0: break
+            data += c
+            if data.endswith(expected): break
+        return bytes(data)
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self._stream()
+            self.rx.clear()
+
+    def close(self):
+        pass
@@ -18,13 +18,17 @@
 #   Red -- Means water is flowing in at least one channel
 #   Green/Red Blink -- Means a sequence is being played, with some water flowing
 #   
+# The blinking is handed to the LED itself where it can be: gpiozero's LED.blink()
+# toggles the pin from its own background thread, so the conductor's loop does
+# nothing for the LEDs between changes of pattern.  If blink isn't available, or
+# use_blink_offload is False, heartbeat() toggles the LEDs in software as before.
 
 import corehw
-import time
+import clock
+import scheduler
 
-last_time_check = time.monotonic_ns()
-last_time_runled = time.monotonic_ns()
-last_time_sequenceled = time.monotonic_ns()
+last_time_runled = clock.now_ns()
+last_time_sequenceled = clock.now_ns()
 run_period = 2000
 run_duty = 0
 run_on = False
@@ -32,20 +36,39 @@ flow_enabled = False
 sequence_period = 2000
 sequence_duty = 0
 sequence_on = False 
+use_blink_offload = True     # Set False to always blink the LEDs from heartbeat()
+run_offloaded = None         # (period, duty) handed to the run LED, or None if heartbeat blinks it
+sequence_offloaded = None    # Likewise for the sequence LED
 
+def _offload(led, period, duty):
+    """ Hands a blink pattern to the LED.  Returns the (period, duty) handed over, or
+    None if the LED must be blinked in software.  A duty of the whole period is
+    just on."""
+    if not use_blink_offload or duty <= 0: return None
+    if duty >= period:
+        led.on()
+        return (period, duty)
+    if not hasattr(led, "blink"): return None
+    led.blink(on_time=duty / 1000.0, off_time=(period - duty) / 1000.0, background=True)
+    return (period, duty)
 
 def set_run_period(period_ms, duty):
     """ Sets the period and duty cycle of the Power Indicator LED."""
-    global run_period, run_duty, run_on 
+    global run_period, run_duty, run_on, last_time_runled, run_offloaded
+    new_duty = period_ms * duty / 100
+    if run_offloaded is not None and run_offloaded == (period_ms, new_duty): return
     run_period = period_ms 
-    run_duty = period_ms * duty / 100
-    last_time_runled = time.monotonic_ns() 
-    if run_duty > 0: 
+    run_duty = new_duty
+    last_time_runled = clock.now_ns() 
+    run_offloaded = _offload(corehw.run_led, run_period, run_duty)
+    if run_offloaded is not None: run_on = True
+    elif run_duty > 0: 
         corehw.run_led.on()
         run_on = True
     else: 
         corehw.run_led.off()
-        run_off = True
+        run_on = False
+    scheduler.wake("pad_leds")
 
 def set_flow_activity(active):
     """ Sets the flow activity LED to on or off."""
@@ -57,41 +80,55 @@ def set_flow_activity(active):
 def set_sequence_activity(period_ms, duty):
     """ Sets the sequence activity. """
     global sequence_period, sequence_duty, sequence_on
-    global last_time_sequenceled
+    global last_time_sequenceled, sequence_offloaded
+    new_duty = period_ms * duty / 100
+    if sequence_offloaded is not None and sequence_offloaded == (period_ms, new_duty): return
     sequence_period = period_ms
-    sequence_duty = period_ms * duty / 100    
-    last_time_sequenceled = time.monotonic_ns()
-    if sequence_duty > 0: 
+    sequence_duty = new_duty
+    last_time_sequenceled = clock.now_ns()
+    sequence_offloaded = _offload(corehw.activity_led_green, sequence_period, sequence_duty)
+    if sequence_offloaded is not None: sequence_on = True
+    elif sequence_duty > 0: 
         corehw.activity_led_green.on() 
         sequence_on = True
     else: 
         corehw.activity_led_green.off()
         sequence_on = False
+    scheduler.wake("pad_leds")
 
-def heartbeat():
-    """ Keeps the LEDs blinking at the proper rate."""
-    global last_time_check, last_time_runled, last_time_sequenceled
+def _next_toggle(last_time, period, duty, on):
+    """ Returns the time (in ns) of the next change of a blinking LED."""
+    if on and duty < period: return last_time + int(duty * 1_000_000)
+    return last_time + int(period * 1_000_000)
+
+def heartbeat(t=None):
+    """ Keeps the LEDs blinking at the proper rate. Returns the time (in ns) that
+    it next needs to be called, or None if no LED is blinking."""
+    global last_time_runled, last_time_sequenceled
     global run_period, run_duty, run_on
     global sequence_on, sequence_duty, sequence_on
-    t = time.monotonic_ns()
-    if t - last_time_check < 2_000_000: return
-    last_time_check = t
-    if run_duty > 0:
+    if t is None: t = clock.now_ns()
+    next_time = None
+    if run_duty > 0 and run_offloaded is None:
         run_elp = (t - last_time_runled) / 1_000_000
-        if run_elp > run_period:
+        if run_elp >= run_period:
             last_time_runled = t 
             corehw.run_led.on() 
             run_on = True
-        elif run_elp > run_duty and run_on:
+        elif run_elp >= run_duty and run_on:
             corehw.run_led.off()
             run_on = False 
-    if sequence_duty > 0:
+        next_time = _next_toggle(last_time_runled, run_period, run_duty, run_on)
+    if sequence_duty > 0 and sequence_offloaded is None:
         seq_elp = (t - last_time_sequenceled) / 1_000_000
-        if seq_elp > sequence_period:
+        if seq_elp >= sequence_period:
             last_time_sequenceled = t 
             corehw.activity_led_green.on()
             sequence_on = True 
-        elif seq_elp > sequence_duty and sequence_on:
+        elif seq_elp >= sequence_duty and sequence_on:
             corehw.activity_led_green.off()
             sequence_on = False
+        seq_next = _next_toggle(last_time_sequenceled, sequence_period, sequence_duty, sequence_on)
+        if next_time is None or seq_next < next_time: next_time = seq_next
+    return next_time
 
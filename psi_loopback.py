@@ -0,0 +1,113 @@
+# psi_loopback.py -- Tests the PSI sampler and protocols against a stand-in for the Pico.
+# dlb, Oct 2026
+#
+# Usage:  python psi_loopback.py [seconds_per_mode]
+#
+# A pseudo terminal (pty) takes the place of the serial line.  A thread on one end
+# plays the part of the Pico: it answers "?" and "B", and streams frames after "S",
+# just as described in psi_protocol.py.  Every so often it damages a frame or sends
+# junk, to exercise the parsers' error handling.  The sampler runs on the other end,
+# in each protocol mode in turn, and the readings it stores are checked.
+#
+# The fake Pico sends readings where input + output is always 65535, so any reading
+# that doesn't add up was garbled and got through.  Runs off the Pi, but needs pyserial.
+
+import os
+import sys
+import select
+import threading
+import time
+
+# Use the simulated GPIOs unless told otherwise, so this runs off the Pi.
+os.environ.setdefault("SPLASH_HW", "sim")
+
+import serial
+import psi_protocol
+import psi_sampler
+import corehw
+
+stream_rate = 500          # Frames per second while streaming
+damage_every = 37          # Damage one answer in this many
+
+class FakePico:
+    """ Plays the part of the Pico on the master side of a pty."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.count = 0
+        self.streaming = False
+        self.running = True
+        self.thread = threading.Thread(name="fake_pico", daemon=True, target=self.run)
+        self.thread.start()
+
+    def next_reading(self):
+        self.count += 1
+        raw_input = (self.count * 7919) % 65536
+        return self.count & 0xFF, raw_input, 65535 - raw_input
+
+    def send(self, data):
+        if self.count % damage_every == 0:
+            # Flip a bit in the middle of the answer, and add some junk.
+            data = bytearray(data)
+            data[len(data) // 2] ^= 0x10
+            data = bytes(data) + b"\x00\xA5"
+        os.write(self.fd, data)
+
+    def run(self):
+        next_frame = time.monotonic()
+        while self.running:
+            timeout = 0.05
+            if self.streaming: timeout = max(0, next_frame - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if ready:
+                for c in os.read(self.fd, 64):
+                    cmd = bytes([c])
+                    if cmd == psi_protocol.CMD_ASCII:
+                        seq, a, b = self.next_reading()
+                        self.send(psi_protocol.encode_ascii(a, b))
+                    elif cmd == psi_protocol.CMD_BINARY:
+                        self.send(psi_protocol.encode_frame(*self.next_reading()))
+                    elif cmd == psi_protocol.CMD_STREAM_START:
+                        self.streaming = True
+                        next_frame = time.monotonic()
+                    elif cmd == psi_protocol.CMD_STREAM_STOP:
+                        self.streaming = False
+            if self.streaming and time.monotonic() >= next_frame:
+                self.send(psi_protocol.encode_frame(*self.next_reading()))
+                next_frame += 1.0 / stream_rate
+
+def check_mode(mode, port, seconds):
+    """ Runs the sampler in one mode.  Returns True if all is well."""
+    psi_sampler.protocol = mode
+    first = psi_sampler.sample_count
+    first_timeouts = psi_sampler.timeout_count
+    psi_sampler.start(port)
+    time.sleep(seconds)
+    psi_sampler.stop()
+    counts = psi_sampler.get_counts()
+    n = psi_sampler.sample_count - first
+    bad = 0
+    for t, psi_input, psi_output in psi_sampler.window(n):
+        raw_input = round(psi_input / corehw.input_psi_conversion_factor)
+        raw_output = round(psi_output / corehw.output_psi_conversion_factor)
+        if raw_input + raw_output != 65535: bad += 1
+    print("%-7s  readings=%6d  (%7.1f/s)  errors=%4d  timeouts=%4d  lost=%4d  bad=%d" %
+          (mode, n, n / seconds, counts["errors"], counts["timeouts"] - first_timeouts, counts["lost"], bad))
+    return n > 0 and bad == 0
+
+def main():
+    seconds = 2.0
+    if len(sys.argv) > 1: seconds = float(sys.argv[1])
+    master, slave = os.openpty()
+    pico = FakePico(master)
+    port = serial.Serial(os.ttyname(slave), baudrate=921600)
+    ok = True
+    for mode in ("ascii", "binary", "stream"):
+        if not check_mode(mode, port, seconds): ok = False
+    pico.running = False
+    if ok: print("PASS")
+    else: print("FAIL")
+    return ok
+
+if __name__ == '__main__':
+    if not main(): sys.exit(1)
@@ -0,0 +1,197 @@
+# psi_protocol.py -- The serial protocol between the Pi and the Pico that reads the PSI sensors.
+# dlb, Oct 2026
+
+# The Pi sends one byte commands:
+#
+#   ?   -- Answer with one ASCII reading: b"NNNNN,NNNNN\n".  This is the original protocol.
+#   B   -- Answer with one binary frame (see below).
+#   S   -- Start streaming: send binary frames continuously, without being asked.
+#   X   -- Stop streaming.
+#
+# A binary frame is 7 bytes:
+#
+#   0     sync byte, 0xA5
+#   1     sequence number, 0-255, one more than the previous frame
+#   2-3   input reading, unsigned 16 bits, little endian
+#   4-5   output reading, unsigned 16 bits, little endian
+#   6     CRC-8 (polynomial 0x07, initial value 0) of bytes 1 through 5
+#
+# The parsers below are fed whatever bytes arrive from the port, in pieces of any
+# size.  They keep the bytes in one fixed bytearray, look at each new byte once, and
+# call on_reading(seq, raw_input, raw_output) for every good reading.  The ASCII
+# parser passes -1 for seq.
+
+SYNC = 0xA5
+FRAME_SIZE = 7
+ASCII_SIZE = 12
+
+CMD_ASCII = b"?"
+CMD_BINARY = b"B"
+CMD_STREAM_START = b"S"
+CMD_STREAM_STOP = b"X"
+
+def _make_crc_table():
+    table = []
+    for i in range(256):
+        c = i
+        for k in range(8):
+            if c & 0x80: c = ((c << 1) ^ 0x07) & 0xFF
+            else: c = (c << 1) & 0xFF
+        table.append(c)
+    return bytes(table)
+
+crc_table = _make_crc_table()
+
+def crc8(data, start=0, end=None):
+    """ Returns the CRC-8 of data[start:end]."""
+    if end is None: end = len(data)
+    c = 0
+    for i in range(start, end):
+        c = crc_table[c ^ data[i]]
+    return c
+
+def encode_frame(seq, raw_input, raw_output):
+    """ Returns the binary frame for a reading."""
+    frame = bytearray(FRAME_SIZE)
+    frame[0] = SYNC
+    frame[1] = seq & 0xFF
+    frame[2] = raw_input & 0xFF
+    frame[3] = (raw_input >> 8) & 0xFF
+    frame[4] = raw_output & 0xFF
+    frame[5] = (raw_output >> 8) & 0xFF
+    frame[6] = crc8(frame, 1, 6)
+    return bytes(frame)
+
+def encode_ascii(raw_input, raw_output):
+    """ Returns the ASCII answer for a reading."""
+    return b"%05d,%05d\n" % (raw_input, raw_output)
+
+def parse_ascii(line):
+    """ Parses an answer of the form b"NNNNN,NNNNN\\n".  Returns the two raw readings,
+    or None if the answer is garbled."""
+    if len(line) != ASCII_SIZE: return None
+    return _parse_ascii_at(line, 0)
+
+def _parse_ascii_at(buf, i):
+    """ Parses the ASCII reading that starts at buf[i].  Returns None if garbled."""
+    if buf[i + 5] != 0x2C or buf[i + 11] != 0x0A: return None
+    a = 0
+    b = 0
+    for k in range(5):
+        da = buf[i + k] - 0x30
+        db = buf[i + 6 + k] - 0x30
+        if da < 0 or da > 9 or db < 0 or db > 9: return None
+        a = 10 * a + da
+        b = 10 * b + db
+    return a, b
+
+class _Parser:
+    """ The buffer handling shared by both parsers."""
+
+    def __init__(self, on_reading, capacity=256):
+        self.on_reading = on_reading
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0          # First byte not yet used up
+        self.end = 0            # End of the bytes received
+        self.readings = 0       # Good readings
+        self.errors = 0         # Bad CRCs or garbled lines
+        self.skipped = 0        # Bytes thrown away while looking for the start of a reading
+
+    def feed(self, data):
+        """ Adds bytes received from the port, and reports any readings they complete."""
+        data = memoryview(data)
+        n = len(data)
+        pos = 0
+        while pos < n:
+            if self.end == self.capacity: self._compact()
+            k = n - pos
+            if k > self.capacity - self.end: k = self.capacity - self.end
+            self.view[self.end:self.end + k] = data[pos:pos + k]
+            self.end += k
+            pos += k
+            self._scan()
+
+    def _compact(self):
+        """ Moves the unused bytes to the front of the buffer."""
+        n = self.end - self.start
+        if n > 0: self.view[0:n] = self.view[self.start:self.end]
+        self._moved(self.start)
+        self.start = 0
+        self.end = n
+
+    def _moved(self, offset):
+        pass
+
+    def reset(self):
+        """ Throws away any partial reading."""
+        self._moved(self.end)
+        self.start = 0
+        self.end = 0
+
+class FrameParser(_Parser):
+    """ Parses binary frames."""
+
+    def __init__(self, on_reading, capacity=256):
+        _Parser.__init__(self, on_reading, capacity)
+        self.last_seq = -1
+        self.seq_gaps = 0       # Frames that were lost, judging by the sequence numbers
+
+    def _scan(self):
+        buf = self.buf
+        i = self.start
+        end = self.end
+        while end - i >= FRAME_SIZE:
+            if buf[i] != SYNC:
+                i += 1
+                self.skipped += 1
+                continue
+            if crc8(buf, i + 1, i + 6) != buf[i + 6]:
+                # A sync byte in the data, or a damaged frame.  Look again one byte on.
+                self.errors += 1
+                i += 1
+                continue
+            seq = buf[i + 1]
+            if self.last_seq >= 0 and seq != (self.last_seq + 1) & 0xFF:
+                self.seq_gaps += (seq - self.last_seq - 1) & 0xFF
+            self.last_seq = seq
+            self.readings += 1
+            self.on_reading(seq, buf[i + 2] | (buf[i + 3] << 8), buf[i + 4] | (buf[i + 5] << 8))
+            i += FRAME_SIZE
+        self.start = i
+
+class AsciiParser(_Parser):
+    """ Parses ASCII readings, b"NNNNN,NNNNN\\n"."""
+
+    def __init__(self, on_reading, capacity=256):
+        _Parser.__init__(self, on_reading, capacity)
+        self.scan_pos = 0       # Where to look for the next newline
+
+    def _moved(self, offset):
+        self.scan_pos -= offset
+        if self.scan_pos < 0: self.scan_pos = 0
+
+    def _scan(self):
+        buf = self.buf
+        while True:
+            nl = buf.find(b"\n", self.scan_pos, self.end)
+            if nl < 0:
+                self.scan_pos = self.end
+                if self.end - self.start > ASCII_SIZE:
+                    # No newline where one should be.  Keep only the tail.
+                    self.skipped += self.end - ASCII_SIZE - self.start
+                    self.start = self.end - ASCII_SIZE
+                return
+            line_start = nl + 1 - ASCII_SIZE
+            if line_start < self.start:
+                reading = None
+            else:
+                self.skipped += line_start - self.start
+                reading = _parse_ascii_at(buf, line_start)
+            if reading is None: self.errors += 1
+            else:
+                self.readings += 1
+                self.on_reading(-1, reading[0], reading[1])
+            self.start = nl + 1
+            self.scan_pos = nl + 1
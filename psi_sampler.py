@@ -0,0 +1,162 @@
+# psi_sampler.py -- Reads the PSI sensors in the background.
+# dlb, Oct 2026
+
+# The two PSI readings (before and after the ball valve) come from the Pi Pico over
+# the serial port (see corehw.get_psi).  Reading the port blocks, so it is done here,
+# in its own thread, and never in the conductor's loop.  Each reading is stored with
+# its time in a fixed size ring buffer made of arrays, so no memory is allocated per
+# sample.
+#
+# There is one writer (the sampler thread) and any number of readers.  Readers do not
+# take a lock: the writer fills in a slot before it bumps sample_count, and a reader
+# checks sample_count again after copying, throwing away any slot that the writer
+# may have reused in the meantime.
+#
+# The sampler speaks any of the protocols in psi_protocol.py, chosen by the protocol
+# setting: "ascii" asks for each reading with "?" (works with every Pico), "binary" 
+# asks for each reading with "B", and "stream" has the Pico send binary frames 
+# continuously without being asked.
+#
+# Once started, the sampler owns corehw.psi_port.  Don't call corehw.get_psi() while
+# it is running.
+
+import array
+import threading
+import time
+import corehw
+import psi_protocol
+
+protocol = "ascii"             # "ascii", "binary" or "stream".  See above.
+sample_period = 0.020          # Seconds between readings, when asking for them
+response_timeout = 0.010       # Seconds to wait for the Pico to answer
+stream_timeout = 0.100         # Seconds of silence while streaming before counting a timeout
+ring_size = 1024               # Number of readings kept
+
+ring_time = array.array("q", [0] * ring_size)         # monotonic_ns of each reading
+ring_psi_input = array.array("d", [0.0] * ring_size)
+ring_psi_output = array.array("d", [0.0] * ring_size)
+sample_count = 0               # Total number of readings stored.  The newest is at (sample_count - 1) % ring_size
+error_count = 0                # Serial errors
+timeout_count = 0              # No answer in time
+running = False
+sampler_thread = None
+parser = None                  # The psi_protocol parser in use
+
+def _store(t, psi_input, psi_output):
+    """ Stores a reading in the ring.  Only the sampler thread calls this."""
+    global sample_count
+    i = sample_count % ring_size
+    ring_time[i] = t
+    ring_psi_input[i] = psi_input
+    ring_psi_output[i] = psi_output
+    sample_count += 1
+
+def _on_reading(seq, raw_input, raw_output):
+    """ Called by the parser for each good reading."""
+    _store(time.monotonic_ns(), raw_input * corehw.input_psi_conversion_factor, 
+           raw_output * corehw.output_psi_conversion_factor)
+
+def _request(port, cmd):
+    """ Asks the Pico for one reading, and waits for it."""
+    global timeout_count
+    readings = parser.readings
+    port.write(cmd)
+    deadline = time.monotonic() + response_timeout
+    while parser.readings == readings:
+        if time.monotonic() > deadline:
+            timeout_count += 1
+            parser.reset()
+            return
+        data = port.read(port.in_waiting or 1)
+        if len(data) > 0: parser.feed(data)
+
+def _run_requests(port, cmd):
+    """ Asks for readings every sample_period, until stopped."""
+    global error_count
+    port.timeout = response_timeout
+    next_time = time.monotonic()
+    while running:
+        try:
+            _request(port, cmd)
+        except corehw.serial.SerialException:
+            error_count += 1
+        next_time += sample_period
+        delay = next_time - time.monotonic()
+        if delay > 0: time.sleep(delay)
+        else: next_time = time.monotonic()
+
+def _run_stream(port):
+    """ Reads the frames that the Pico streams, until stopped."""
+    global error_count, timeout_count
+    port.timeout = stream_timeout
+    port.write(psi_protocol.CMD_STREAM_START)
+    while running:
+        try:
+            data = port.read(port.in_waiting or 1)
+            if len(data) > 0: parser.feed(data)
+            else: timeout_count += 1
+        except corehw.serial.SerialException:
+            error_count += 1
+            time.sleep(stream_timeout)
+    port.write(psi_protocol.CMD_STREAM_STOP)
+
+def _run_sampler(port):
+    """ The main entry point of the sampler thread."""
+    if protocol == "stream": _run_stream(port)
+    elif protocol == "binary": _run_requests(port, psi_protocol.CMD_BINARY)
+    else: _run_requests(port, psi_protocol.CMD_ASCII)
+
+## -------------------------------------------------------------------------------
+## Public Interface Functions
+
+def start(port=None):
+    """ Starts the sampler thread, if it isn't already running.  Uses corehw.psi_port
+    unless another port is given."""
+    global running, sampler_thread, parser
+    if running: return
+    if port is None: port = corehw.psi_port
+    if protocol == "ascii": parser = psi_protocol.AsciiParser(_on_reading)
+    else: parser = psi_protocol.FrameParser(_on_reading)
+    running = True
+    sampler_thread = threading.Thread(name="psi_sampler", daemon=True, target=_run_sampler, args=(port,))
+    sampler_thread.start()
+
+def stop():
+    """ Stops the sampler thread, and waits for it to finish."""
+    global running
+    running = False
+    if sampler_thread is not None: sampler_thread.join()
+
+def latest():
+    """ Returns the newest reading as (time_ns, psi_input, psi_output), or None if there
+    are no readings.  Never blocks."""
+    while True:
+        n = sample_count
+        if n == 0: return None
+        i = (n - 1) % ring_size
+        sample = (ring_time[i], ring_psi_input[i], ring_psi_output[i])
+        if sample_count - n < ring_size - 1: return sample
+
+def window(count):
+    """ Returns up to count of the newest readings, oldest first, as a list of
+    (time_ns, psi_input, psi_output).  Never blocks."""
+    n = sample_count
+    if count > n: count = n
+    if count > ring_size: count = ring_size
+    samples = []
+    for k in range(n - count, n):
+        i = k % ring_size
+        samples.append((ring_time[i], ring_psi_input[i], ring_psi_output[i]))
+    # Throw away any readings that were overwritten while copying.
+    overwritten = sample_count - ring_size - (n - count) + 1
+    if overwritten > 0: samples = samples[overwritten:]
+    return samples
+
+def get_counts():
+    """ Returns a dictionary with the number of readings, errors and timeouts. Errors
+    include garbled readings and bad CRCs; lost frames are counted while streaming."""
+    counts = {"samples": sample_count, "errors": error_count, "timeouts": timeout_count, "lost": 0}
+    if parser is not None:
+        counts["errors"] += parser.errors
+        if protocol != "ascii": counts["lost"] = parser.seq_gaps
+    return counts
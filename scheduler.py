@@ -0,0 +1,95 @@
+# scheduler.py -- Deadline scheduler for the conductor's background task.
+# dlb, Oct 2026
+
+# The conductor runs a handful of tasks (the LEDs, the ball valve, the players).
+# Each task is a heartbeat function that takes the current time in nanoseconds
+# and returns the time (also in ns) at which it next needs to run, or None if it
+# has nothing to do until something changes.  The conductor sleeps until the
+# earliest deadline instead of polling every task every millisecond.
+#
+# Code that changes the state of a task from the outside (for example, giving
+# the ball valve a new target) calls wake() with the name of the task so that it
+# is run on the next pass.  wake() and notify() are safe to call from any thread.
+
+import heapq
+import threading
+import time
+import histogram
+
+tasks = {}                 # Task name -> heartbeat function
+task_deadlines = {}        # Task name -> current deadline, or None
+deadline_heap = []         # Heap of (deadline, name).  Entries that no longer match task_deadlines are stale.
+woken = set()              # Names of tasks that must run on the next pass
+wake_lock = threading.Lock()
+wake_event = threading.Event()
+max_sleep = 1.0            # Longest time to sleep, in seconds, even if no task has a deadline
+timing_enabled = False     # Time each run of each task.  Off unless asked for (see conductor.set_timing)
+task_times = {}            # Task name -> histogram of how long each run took
+
+def add_task(name, heartbeat):
+    """ Adds a task.  The task is run on the first pass."""
+    tasks[name] = heartbeat
+    task_deadlines[name] = 0
+    task_times[name] = histogram.Histogram()
+    heapq.heappush(deadline_heap, (0, name))
+
+def wake(name=None):
+    """ Marks a task (or all tasks, if name is None) to be run on the next pass,
+    and wakes the loop."""
+    with wake_lock:
+        if name is None: woken.update(tasks)
+        else: woken.add(name)
+    wake_event.set()
+
+def notify():
+    """ Wakes the loop without running any task, for example because a command
+    has arrived."""
+    wake_event.set()
+
+def _run_task(name, t):
+    """ Runs one task and records its next deadline."""
+    if timing_enabled:
+        t0 = time.monotonic_ns()
+        deadline = tasks[name](t)
+        task_times[name].record(time.monotonic_ns() - t0)
+    else:
+        deadline = tasks[name](t)
+    if deadline is not None and deadline <= t: deadline = t + 1
+    task_deadlines[name] = deadline
+    if deadline is not None: heapq.heappush(deadline_heap, (deadline, name))
+
+def next_deadline():
+    """ Returns the earliest deadline of all the tasks, or None."""
+    while len(deadline_heap) > 0:
+        deadline, name = deadline_heap[0]
+        if task_deadlines[name] == deadline: return deadline
+        heapq.heappop(deadline_heap)
+    return None
+
+def begin_pass():
+    """ Must be called at the start of each pass of the loop, before looking for
+    work, so that wakes that arrive during the pass are not lost."""
+    wake_event.clear()
+
+def run_due(t):
+    """ Runs every task that was woken or whose deadline has arrived.  Returns the
+    earliest deadline afterward, or None."""
+    if len(woken) > 0:
+        with wake_lock:
+            names = list(woken)
+            woken.clear()
+        for name in names:
+            if name in tasks: _run_task(name, t)
+    while len(deadline_heap) > 0 and deadline_heap[0][0] <= t:
+        deadline, name = heapq.heappop(deadline_heap)
+        if task_deadlines[name] != deadline: continue
+        _run_task(name, t)
+    return next_deadline()
+
+def sleep_until(deadline):
+    """ Sleeps until the deadline (in ns), or until wake() or notify() is called."""
+    timeout = max_sleep
+    if deadline is not None:
+        timeout = (deadline - time.monotonic_ns()) / 1_000_000_000
+        if timeout > max_sleep: timeout = max_sleep
+    if timeout > 0: wake_event.wait(timeout)
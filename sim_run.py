@@ -0,0 +1,191 @@
+# sim_run.py -- Runs a WSP program in fast-forward on the simulated hardware.
+# dlb, Oct 2026
+#
+# Usage:  python sim_run.py [--timeline] [--check] [--seed N] [--trace file.csv] program_name [minutes]
+#
+# The clock is virtual (see clock.py), and moves straight to the next deadline of
+# the scheduler's tasks instead of waiting for it, so an hour of a show takes a
+# second or so.  The ball valve and the spouts are the simulated ones of hw_sim.py,
+# and the valve moves at its real rate in virtual time.
+#
+# Prints a summary: how many times each spout turned on, how long the spouts were on
+# in total, and the valve movements.  With --trace, every output change is written
+# to a CSV file of time (ms), device and value, which can be compared between two
+# versions of the interpreter.  --seed seeds the random statement (the default is
+# 1, so runs repeat), and --timeline plays the program from a timeline rendered in
+# advance (see wsp_timeline.py) instead of interpreting it.
+#
+# --check renders the program's timeline (wsp_timeline.render) as well, and checks
+# that it turns the spouts on and off in the same order as the run did.  The times
+# aren't compared, since the timeline leaves out how long the valve takes to move.
+#
+# Unlike the conductor, this runs in one thread: there is no PSI sampler, no web
+# site, and no LEDs.
+
+import os
+import sys
+import collections
+import random
+import time
+
+os.environ["SPLASH_HW"] = "sim"
+
+import clock
+import hw_sim
+import corehw
+import scheduler
+import ball_valve
+import wsp_proc as proc
+import wsp_timeline as timeline
+
+def device_names():
+    """ Returns gpio -> name, for the outputs."""
+    names = {corehw.ball_valve_relay1.pin: "valve_open", corehw.ball_valve_relay2.pin: "valve_close"}
+    for i, w in enumerate(corehw.waterspouts): names[w.pin] = "spout_" + chr(ord("A") + i)
+    return names
+
+def _next_deadline(t):
+    """ Runs the tasks that are due.  Returns the time that something next needs to
+    happen -- a task's deadline, or a change of the simulated hardware -- or None."""
+    scheduler.begin_pass()
+    deadline = scheduler.run_due(t)
+    hw = clock.next_timer()
+    if deadline is None or (hw is not None and hw < deadline): return hw
+    return deadline
+
+def run(prog_name, minutes, use_timeline=False, seed=1):
+    """ Runs the program for the given number of minutes of virtual time, or until it
+    ends.  Returns the time (in ns) it ran for, and the output changes, as a list of
+    (time_ns, gpio, value) with the times from the start of the program."""
+    hw_sim.edge_log = collections.deque()
+    # Start the virtual clock at the real time, so that the times the modules took
+    # when they were loaded are in its past.
+    clock.use_virtual(time.monotonic_ns())
+    random.seed(seed)
+    scheduler.add_task("ball_valve", ball_valve.heartbeat)
+    scheduler.add_task("wsp_proc", proc.heartbeat)
+    scheduler.add_task("wsp_timeline", timeline.heartbeat)
+    scheduler.timing_enabled = False
+    # Home the valve, as the conductor does at startup.
+    ball_valve.reset_to_zero()
+    t = clock.now_ns()
+    while ball_valve.in_motion():
+        deadline = _next_deadline(t)
+        if deadline is None: break
+        clock.advance_to(deadline)
+        t = clock.now_ns()
+    t0 = clock.now_ns()
+    if not use_timeline or not timeline.start(prog_name, seed):
+        proc.start_program(prog_name)
+    t_end = t0 + int(minutes * 60 * 1_000_000_000)
+    t = t0
+    while t < t_end:
+        deadline = _next_deadline(t)
+        if deadline is None: break            # Ended, or holding with nothing moving
+        clock.advance_to(deadline)
+        t = clock.now_ns()
+    return t - t0, [(e[0] - t0, e[1], e[2]) for e in hw_sim.edge_log if e[0] >= t0]
+
+def summarize(edges, elapsed):
+    """ Prints the number of times each output turned on, and its total time on."""
+    names = device_names()
+    on_count = {}
+    on_time = {}
+    on_since = {}
+    for t, pin, value in edges:
+        if pin not in names: continue
+        name = names[pin]
+        if value == 1:
+            on_count[name] = on_count.get(name, 0) + 1
+            on_since[name] = t
+        elif name in on_since:
+            on_time[name] = on_time.get(name, 0) + t - on_since.pop(name)
+    for name, t in on_since.items(): on_time[name] = on_time.get(name, 0) + elapsed - t
+    print("%-12s %8s %12s" % ("Output", "Times on", "Total on (s)"))
+    for name in sorted(on_count):
+        print("%-12s %8d %12.3f" % (name, on_count[name], on_time.get(name, 0) / 1e9))
+
+def spout_states(times, masks):
+    """ Returns the list of (time, state) that the spouts go through from all off,
+    given the times and the (on, off) masks of the changes.  Changes at the same
+    time are taken together."""
+    states = []
+    state = 0
+    for i in range(len(times)):
+        on, off = masks[i]
+        state = (state & ~off) | on
+        if len(states) > 0 and states[-1][0] == times[i]: states[-1] = (times[i], state)
+        else: states.append((times[i], state))
+    result = []
+    last = 0                              # The spouts start off
+    for t, state in states:
+        if state != last: result.append((t, state))
+        last = state
+    return result
+
+def check_timeline(prog_name, edges, minutes, seed):
+    """ Renders the program and compares the spout states of its timeline with those
+    of the edges of a live run.  Returns True if they match."""
+    bits = {w.pin: 1 << i for i, w in enumerate(corehw.waterspouts)}
+    live = [e for e in edges if e[1] in bits]
+    live = spout_states([e[0] for e in live],
+                        [(bits[e[1]], 0) if e[2] else (0, bits[e[1]]) for e in live])
+    tl = timeline.render(proc.find_program(prog_name), seed, minutes * 60)
+    rendered = spout_states(tl["time"], list(zip(tl["on"], tl["off"])))
+    n = min(len(live), len(rendered))
+    for i in range(n):
+        if live[i][1] != rendered[i][1]:
+            print("Timeline differs at spout change %d: live %s at %.3f s, rendered %s at %.3f s." %
+                  (i + 1, format(live[i][1], "b"), live[i][0] / 1e9, format(rendered[i][1], "b"), rendered[i][0] / 1e9))
+            return False
+    print("Timeline matches the run for %d spout changes (%d live, %d rendered, rendering ended: %s)." %
+          (n, len(live), len(rendered), tl["end"]))
+    return True
+
+def write_trace(filename, edges):
+    names = device_names()
+    with open(filename, "w") as f:
+        f.write("time_ms,device,value\n")
+        for t, pin, value in edges:
+            if pin in names: f.write("%.3f,%s,%d\n" % (t / 1e6, names[pin], value))
+
+def main():
+    args = sys.argv[1:]
+    use_timeline = False
+    check = False
+    seed = 1
+    trace_file = None
+    while len(args) > 0 and args[0].startswith("--"):
+        if args[0] == "--timeline": use_timeline = True
+        elif args[0] == "--check": check = True
+        elif args[0] == "--seed":
+            seed = int(args[1])
+            args = args[1:]
+        elif args[0] == "--trace":
+            trace_file = args[1]
+            args = args[1:]
+        args = args[1:]
+    if len(args) < 1:
+        print("Usage:  python sim_run.py [--timeline] [--check] [--seed N] [--trace file.csv] program_name [minutes]")
+        return
+    minutes = 60.0
+    if len(args) > 1: minutes = float(args[1])
+    proc.read_programs()
+    if proc.find_program(args[0]) is None:
+        print("No program named %s.  The programs are: %s" % (args[0], ", ".join(proc.get_program_names())))
+        return
+    t_start = time.perf_counter()
+    elapsed, edges = run(args[0], minutes, use_timeline, seed)
+    wall = time.perf_counter() - t_start
+    print("Simulated %.1f minutes of %s in %.2f seconds (%d output changes)." % (elapsed / 60e9, args[0], wall, len(edges)))
+    summarize(edges, elapsed)
+    if trace_file is not None:
+        write_trace(trace_file, edges)
+    if check:
+        if not timeline.renderable(proc.find_program(args[0])):
+            print("%s reads *flow, so it can't be rendered." % args[0])
+        elif not check_timeline(args[0], edges, minutes, seed):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,12 @@
 # implemented in wsp_proc.py.  It is kept for the need of "one_shot".
 
 import corehw
-import time 
+import spout_registry as spouts
+import clock
 import copy
 import random
 import pad_leds
+import scheduler
 
 current_program = "" 
 current_args = {} 
@@ -26,18 +28,18 @@ def program_random():
         if "duration" not in current_args: current_args["duration"] = 50
         if "period" not in current_args: current_args["period"] = 1000
         corehw.all_off()
-        last_update_time = time.monotonic_ns()
+        last_update_time = clock.now_ns()
         pad_leds.set_flow_activity(True)
         pad_leds.set_sequence_activity(250, 50)
         return 
-    t = time.monotonic_ns() 
+    t = clock.now_ns() 
     elp = (t - last_update_time) / 1_000_000.0 
     if elp > current_args["duration"]:
         corehw.all_off()
     if elp > current_args["period"]:
         corehw.all_off()
         num = random.randrange(0, 13)
-        corehw.turn_pattern_on(num)
+        corehw.turn_mask_on(spouts.pattern_mask(num))
         last_update_time = t
 
 def program_one_shot():
@@ -49,34 +51,71 @@ def program_one_shot():
             current_program = ""
             return
         if "duration" not in current_args: current_args["duration"] = 25
-        last_update_time = time.monotonic_ns()
-        temp_args["pattern"] = corehw.translate_spout_name(current_args["spout"])
-        corehw.turn_pattern_on(temp_args["pattern"])
+        last_update_time = clock.now_ns()
+        temp_args["pattern"] = corehw.pattern_mask(corehw.translate_spout_name(current_args["spout"]))
+        corehw.turn_mask_on(temp_args["pattern"])
         pad_leds.set_flow_activity(True)
         pad_leds.set_sequence_activity(1000, 0)
         return
-    t = time.monotonic_ns() 
+    t = clock.now_ns() 
     elp = (t - last_update_time) / 1_000_000.0
     if elp > current_args["duration"]:
-        corehw.turn_pattern_off(temp_args["pattern"])
+        corehw.turn_mask_off(temp_args["pattern"])
         pad_leds.set_flow_activity(False)
         pad_leds.set_sequence_activity(1000, 0)
         current_program = ""
         return
 
+def program_ring():
+    """ Turns each spout on and off in turn, once around the pad.  The arguments are
+    "on" and "off", the milliseconds each spout is on and then off.  Returns the 
+    time (in ns) of the next change."""
+    global current_program, current_args, last_update_time, inital_cycle, temp_args
+    if inital_cycle:
+        inital_cycle = False
+        if "on" not in current_args: current_args["on"] = 25
+        if "off" not in current_args: current_args["off"] = 75
+        temp_args["ring_spout"] = 0
+        temp_args["ring_on"] = True
+        last_update_time = clock.now_ns()
+        corehw.turn_mask_on(1)
+        return last_update_time + int(current_args["on"] * 1_000_000)
+    t = clock.now_ns()
+    i = temp_args["ring_spout"]
+    if temp_args["ring_on"]:
+        if t - last_update_time < current_args["on"] * 1_000_000:
+            return last_update_time + int(current_args["on"] * 1_000_000)
+        corehw.turn_mask_off(1 << i)
+        temp_args["ring_on"] = False
+        last_update_time = t
+        return t + int(current_args["off"] * 1_000_000)
+    if t - last_update_time < current_args["off"] * 1_000_000:
+        return last_update_time + int(current_args["off"] * 1_000_000)
+    i += 1
+    if i >= len(corehw.waterspouts):
+        current_program = ""
+        return None
+    temp_args["ring_spout"] = i
+    temp_args["ring_on"] = True
+    last_update_time = t
+    corehw.turn_mask_on(1 << i)
+    return t + int(current_args["on"] * 1_000_000)
+
 def set_program(prog, args):
     """ Sets the program to play.  Only one program can play at a time."""
     global current_program, last_update_time, current_args, inital_cycle 
     current_program = prog
     current_args = copy.deepcopy(args)
     corehw.all_off() 
-    last_update_time = time.monotonic_ns()
+    last_update_time = clock.now_ns()
     inital_cycle = True
+    scheduler.wake("spout_player")
 
 def update_arguments(args):
     """ Updates the arguments of a running program. """
     for key in args:
         if key in current_args: current_args[key] = args[key]
+    scheduler.wake("spout_player")
 
 def abort_program():
     """ Shuts down the current program. """
@@ -86,16 +125,27 @@ def abort_program():
     pad_leds.set_sequence_activity(1000, 0)
     corehw.all_off() 
 
-def heartbeat():
-    """ Plays the spout program. Call at least every 5 milliseconds."""
+def heartbeat(t=None):
+    """ Plays the spout program. Returns the time (in ns) that it next needs to be
+    called, or None if no program is playing."""
     global last_time_check, current_program
-    t = time.monotonic_ns()
+    if t is None: t = clock.now_ns()
     elp = (t - last_time_check) / 1_000_000
-    if elp < 2: return       # Check at most once every 2 milliseconds
+    if elp < 2:              # Check at most once every 2 milliseconds
+        if current_program == "": return None
+        return last_time_check + 2_000_000
     last_time_check = t
     # Send control to whichever program is playing.
-    if current_program == "one_shot": program_one_shot() 
-    if current_program == "random": program_random()
+    if current_program == "one_shot": 
+        program_one_shot() 
+        if current_program == "one_shot":
+            return last_update_time + int(current_args["duration"] * 1_000_000) + 1
+    if current_program == "random": 
+        program_random()
+        return t + 2_000_000
+    if current_program == "ring":
+        return program_ring()
+    return None
 
     
 
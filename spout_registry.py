@@ -0,0 +1,158 @@
+# spout_registry.py -- The names of the water spouts and of the groups of them.
+# dlb, Oct 2026
+
+# The layout of the water spouts is as follows:
+#
+#  A(0)      B(1)       C(2)
+#       D(3)       E(4)
+#  F(5)      G(6)       H(7)
+#       I(8)       J(9)
+#  K(10)     L(11)      M(12)
+#
+# And N(13) are the 5 spouts at the gate.
+#
+# Every way of naming spouts -- a letter, a group name, a pattern number (an index
+# into pattern_names), or a spout number as text -- is worked out once, here, into
+# a bitmask (bit n set if spout n is in it) and a tuple of spout numbers.  Looking
+# one up is then a single dictionary get: see mask() and spouts().
+#
+# More groups can be defined in the file group_file, a JSON object of group name to
+# a list of members, each a letter, a spout number, or the name of a group defined
+# before it.  For example:
+#
+#     {"top_corners": ["a", "c"], "big_x": ["diagonal_1", "diagonal_2"]}
+#
+# The user's groups can be used by name, in scripts and in the conductor's commands,
+# but don't get pattern numbers, so the numbers stay the same from pad to pad.
+
+import json
+
+spout_count = 14
+letters = "abcdefghijklmn"
+
+# The groups, in pattern number order after the single spouts.
+groups = {
+    "gate": (13,),
+    "center": (6,),
+    "corners": (0, 2, 10, 12),
+    "inside_corners": (3, 4, 8, 9),
+    "major_row_1": (0, 1, 2),
+    "major_row_2": (5, 6, 7),
+    "major_row_3": (10, 11, 12),
+    "minor_row_1": (3, 4),
+    "minor_row_2": (8, 9),
+    "major_column_1": (0, 5, 10),
+    "major_column_2": (1, 6, 11),
+    "major_column_3": (2, 7, 12),
+    "minor_column_1": (3, 8),
+    "minor_column_2": (4, 9),
+    "diagonal_1": (0, 3, 6, 9, 12),
+    "diagonal_2": (2, 4, 6, 8, 10),
+    "outside_box": (0, 1, 2, 5, 7, 10, 11, 12),
+    "inside_box": (3, 4, 8, 9),
+}
+
+# Older names that are still understood.
+aliases = {"minor_column2": "minor_column_2"}
+
+# The pattern numbers: 0-13 are the single spouts, then the groups above.
+pattern_names = tuple(letters) + tuple(groups)
+
+group_file = "spout_groups.json"
+
+_masks = {}                    # Name, pattern number, or spout number as text -> mask
+_spouts = {}                   # Same keys -> tuple of spout numbers
+_pattern_masks = ()            # Pattern number -> mask
+
+def _mask_of(spouts):
+    m = 0
+    for i in spouts: m |= 1 << i
+    return m
+
+def _build(user_groups):
+    """ Builds the lookup tables, and swaps them in whole, so that a lookup from
+    another thread never sees them half built."""
+    global _masks, _spouts, _pattern_masks
+    masks = {}
+    spout_tuples = {}
+    def add(key, spouts):
+        spouts = tuple(sorted(set(spouts)))
+        masks[key] = _mask_of(spouts)
+        spout_tuples[key] = spouts
+    for i in range(spout_count):
+        add(letters[i], (i,))
+        add(str(i), (i,))
+    for name, spouts in groups.items(): add(name, spouts)
+    for name, target in aliases.items(): add(name, spout_tuples[target])
+    for name, spouts in user_groups.items():
+        if name not in masks: add(name, spouts)
+    for i, name in enumerate(pattern_names): add(i, spout_tuples[name])
+    _spouts = spout_tuples
+    _masks = masks
+    _pattern_masks = tuple(masks[i] for i in range(len(pattern_names)))
+
+def _parse_groups(data):
+    """ Resolves the members of the user's groups to spout numbers.  Returns name ->
+    tuple of spout numbers, leaving out (and printing) the groups that are wrong."""
+    user_groups = {}
+    if not isinstance(data, dict):
+        print("spouts: %s must hold an object of group name to members." % group_file)
+        return user_groups
+    for name, members in data.items():
+        name = str(name).lower()
+        if name in _masks or name.isdigit():
+            print("spouts: Group %s is already a spout name, and is ignored." % name)
+            continue
+        if not isinstance(members, list):
+            print("spouts: Group %s must be a list of spouts, and is ignored." % name)
+            continue
+        spouts = []
+        for m in members:
+            m = str(m).lower()
+            if m in _spouts: spouts.extend(_spouts[m])
+            elif m in user_groups: spouts.extend(user_groups[m])
+            else:
+                print("spouts: Unknown spout %s in group %s." % (m, name))
+        user_groups[name] = tuple(spouts)
+    return user_groups
+
+def load_groups(filename=None):
+    """ Reads the user's groups from a file (group_file by default), replacing any
+    read before.  A missing file means there are none.  Returns the number read."""
+    if filename is None: filename = group_file
+    _build({})
+    try:
+        with open(filename) as f: data = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        print("spouts: Unable to read %s: %s" % (filename, e))
+        return 0
+    user_groups = _parse_groups(data)
+    _build(user_groups)
+    return len(user_groups)
+
+def mask(name):
+    """ Returns the bitmask of a spout or group: a name (in lower case), a pattern
+    number, or a spout number as text.  Unknown names give zero."""
+    return _masks.get(name, 0)
+
+def spouts(name):
+    """ Returns the spout numbers of a spout or group, as a tuple.  Takes the same
+    names as mask().  Unknown names give an empty tuple."""
+    return _spouts.get(name, ())
+
+def pattern_mask(n):
+    """ Returns the bitmask of a pattern number, or zero if there is no such pattern."""
+    if n < 0 or n >= len(_pattern_masks): return 0
+    return _pattern_masks[n]
+
+def is_name(name):
+    """ Returns True if name is a spout or group name that mask() knows."""
+    return name in _masks
+
+def group_names():
+    """ Returns the names of all the groups, the user's included."""
+    return [k for k in _masks if type(k) is str and len(k) > 1 and not k.isdigit()]
+
+load_groups()
@@ -0,0 +1,177 @@
+# status_stream.py -- Pushes the pad's status to any number of web clients.
+# dlb, Oct 2026
+
+# One producer thread reads the conductor's status every stream_period (skipping it
+# if the status snapshot's seq hasn't moved), and works out which of the fields
+# shown to the user have changed since the last time.  The
+# changes (a "delta") are turned into one message, and the same message is put on
+# the queue of every subscriber.  So the status is read and encoded once per period,
+# however many phones are watching.
+#
+# A subscriber first gets the full status, then only the deltas.  Nothing is sent
+# in a period in which nothing changed.  Each subscriber's queue is bounded: if a
+# client falls behind and its queue fills up, the queue is emptied and the full
+# status is sent again, so the client is never left with a partial picture.
+#
+# The messages are formatted as Server-Sent Events (see events()).  The browser side
+# is an EventSource that merges each message into what it already has.
+#
+# Subscribers can be threads (subscribe() and events(), for Flask) or asyncio tasks
+# (subscribe_async() and async_events(), for website_async.py).  An asyncio queue is
+# only touched from its own event loop, so the producer hands messages over with
+# call_soon_threadsafe.
+
+import asyncio
+import json
+import queue
+import threading
+import time
+import conductor
+
+stream_period = 0.250          # Seconds between status reads
+max_backlog = 16               # Messages waiting for a subscriber before it is resynced
+keepalive_period = 15.0        # Seconds of quiet before sending a comment to keep the connection up
+max_subscribers = 64           # More clients than this are turned away
+
+# The status fields that are streamed, and how many decimal places they are rounded
+# to (None for fields that are not numbers).  Rounding keeps noise in the readings
+# from making a delta every period.
+fields = {"psi_input": 1, "psi_output": 1, "flow_percent": 0, "flow_fully_opened": None,
+          "flow_fully_closed": None, "program": None, "line": None, "spouts": None,
+          "duration": None, "period": None}
+
+subscribers = []               # Of _Subscriber or _AsyncSubscriber, one per client
+subscribers_lock = threading.Lock()
+current = {}                   # The full status, as last sent
+current_seq = -1               # The seq of the conductor's status snapshot it came from
+producer_thread = None
+
+def _read_status(status):
+    """ Returns the streamed fields of a conductor status snapshot."""
+    s = {}
+    for name, places in fields.items():
+        v = status.get(name)
+        if places is not None and v is not None: v = round(v, places)
+        s[name] = v
+    return s
+
+def _message(data):
+    return "data: %s\n\n" % json.dumps(data, separators=(",", ":"))
+
+class _Subscriber:
+    """ A client served by a thread."""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=max_backlog)
+
+    def send(self, message):
+        """ Puts a message on the queue.  If the queue is full, resyncs instead."""
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            while not self.queue.empty():
+                try: self.queue.get_nowait()
+                except queue.Empty: break
+            self.queue.put_nowait(_message(current))
+
+class _AsyncSubscriber:
+    """ A client served by an asyncio event loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_backlog)
+
+    def send(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            pass                      # The loop has closed; the subscriber is on its way out
+
+    def _put(self, message):
+        """ Runs in the event loop.  Puts a message on the queue, or resyncs if it is full."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not self.queue.empty(): self.queue.get_nowait()
+            self.queue.put_nowait(_message(current))
+
+def _produce():
+    """ Reads the status and sends the deltas, for as long as the program runs."""
+    global current, current_seq
+    while True:
+        time.sleep(stream_period)
+        if len(subscribers) == 0: continue
+        seq, status = conductor.get_snapshot()
+        if seq == current_seq: continue
+        current_seq = seq
+        s = _read_status(status)
+        delta = {}
+        for name, v in s.items():
+            if current.get(name, delta) != v: delta[name] = v
+        if len(delta) == 0: continue
+        message = _message(delta)
+        with subscribers_lock:
+            current = s
+            for sub in subscribers: sub.send(message)
+
+def set_period(ms):
+    """ Sets the time between status reads, in milliseconds."""
+    global stream_period
+    if ms < 20: ms = 20
+    stream_period = ms / 1000.0
+
+def _add(sub):
+    """ Adds a subscriber, and starts the producer if it isn't running.  Returns the
+    subscriber, or None if there are too many."""
+    global producer_thread, current, current_seq
+    with subscribers_lock:
+        if len(subscribers) >= max_subscribers: return None
+        if len(subscribers) == 0:
+            current_seq, status = conductor.get_snapshot()
+            current = _read_status(status)
+        sub.queue.put_nowait(_message(current))
+        subscribers.append(sub)
+        if producer_thread is None:
+            producer_thread = threading.Thread(name="status_stream", daemon=True, target=_produce)
+            producer_thread.start()
+    return sub
+
+def subscribe():
+    """ Adds a subscriber that is served by a thread (see events()).  Its queue 
+    already holds the full status.  Returns None if there are too many subscribers."""
+    return _add(_Subscriber())
+
+def subscribe_async():
+    """ Like subscribe(), for a subscriber served by the running event loop (see 
+    async_events())."""
+    return _add(_AsyncSubscriber(asyncio.get_running_loop()))
+
+def unsubscribe(sub):
+    """ Removes a subscriber."""
+    with subscribers_lock:
+        if sub in subscribers: subscribers.remove(sub)
+
+def events(sub):
+    """ Yields the messages for a subscriber, as Server-Sent Events, until the client
+    goes away.  Unsubscribes when done."""
+    try:
+        yield "retry: 2000\n\n"
+        while True:
+            try:
+                yield sub.queue.get(timeout=keepalive_period)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+    finally:
+        unsubscribe(sub)
+
+async def async_events(sub):
+    """ The same as events(), for an asyncio subscriber."""
+    try:
+        yield "retry: 2000\n\n"
+        while True:
+            try:
+                yield await asyncio.wait_for(sub.queue.get(), keepalive_period)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        unsubscribe(sub)
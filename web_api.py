@@ -0,0 +1,112 @@
+# web_api.py -- The actions behind the buttons on the web page.
+# dlb, Oct 2026
+
+# The web page sends an action (a button press) with the selected program and pad.
+# do_action() carries it out by queuing a command for the conductor, and returns
+# at once with a small dictionary for the page.  Nothing here renders HTML, so the
+# same actions can be used by any front end.
+
+import corehw
+import conductor
+import wsp_proc as proc
+
+period_inc = 100
+duration_inc = 20
+
+prog_list = []                 # The program names, in the order shown on the page
+programs_version = None        # wsp_proc.programs_version when prog_list was loaded
+
+def load_programs(names):
+    """ Sets the list of programs that the page can select from."""
+    global prog_list, programs_version
+    prog_list = list(names)
+    programs_version = proc.programs_version
+
+def _sync_programs():
+    """ Reloads prog_list if the scripts have been reloaded since (see wsp_cache.py)."""
+    if programs_version is not None and programs_version != proc.programs_version:
+        load_programs(proc.get_program_names())
+
+def find_program(prog):
+    """ Returns the program name for a selection, which is either "p_N" (the Nth
+    program in prog_list) or a program name.  Returns "" if there is no such program."""
+    if prog is None: return ""
+    _sync_programs()
+    if prog in prog_list: return prog
+    if len(prog) > 2 and prog[0:2] == "p_":
+        try:
+            iprog = int(prog[2:])
+        except ValueError:
+            iprog = -1
+        if iprog >= 0 and iprog < len(prog_list): return prog_list[iprog]
+    return ""
+
+def _clamp(v, low, high):
+    if v < low: return low
+    if v > high: return high
+    return v
+
+def _set_period(period):
+    corehw.period = _clamp(period, 100, 10000)
+    conductor.update_arguments({"period": corehw.period})
+
+def _set_duration(duration):
+    corehw.duration = _clamp(duration, 20, 10000)
+    conductor.update_arguments({"duration": corehw.duration})
+
+def do_action(action, prog="", padnum=-1):
+    """ Carries out an action from the web page.  prog is the selected program (see
+    find_program) and padnum the pad for "one_shot".  Returns a dictionary with "ok"
+    (False if the action is unknown or its command was dropped), and the period and
+    duration, which some actions change."""
+    prog = find_program(prog)
+    ok = True
+    if action == "stop":
+        ok = conductor.command("stop")
+    elif action == "one_shot":
+        if padnum >= 0 and padnum <= 13:
+            ok = conductor.command("one_shot", {"spout": padnum, "duration": corehw.duration})
+        else: ok = False
+    elif action == "reset":
+        ok = conductor.command("reset")
+    elif action == "speed_down":
+        _set_period(corehw.period + period_inc)
+    elif action == "speed_up":
+        _set_period(corehw.period - period_inc)
+    elif action == "flow_down":
+        ok = conductor.command("lower")
+    elif action == "flow_up":
+        ok = conductor.command("higher")
+    elif action == "jump_up":
+        _set_duration(corehw.duration + duration_inc)
+    elif action == "jump_down":
+        _set_duration(corehw.duration - duration_inc)
+    elif action == "ring":
+        ok = conductor.command("ring", {"on": 25, "off": 75})
+    elif action == "play":
+        ok = conductor.command("play", {"program": prog})
+    elif action == "reload":
+        ok = conductor.command("reload")
+    elif action == "normal":
+        ok = conductor.command("set_flow", {"position": 20})
+        corehw.period = 800
+        corehw.duration = 100
+        conductor.update_arguments({"period": corehw.period, "duration": corehw.duration})
+    elif action == "agressive":
+        ok = conductor.command("set_flow", {"position": 40})
+        corehw.period = 400
+        corehw.duration = 200
+        conductor.update_arguments({"period": corehw.period, "duration": corehw.duration})
+    else: ok = False
+    return {"ok": ok, "action": action, "period": corehw.period, "duration": corehw.duration}
+
+def get_status():
+    """ Returns the status for the page: the conductor's status without the timing."""
+    s = conductor.get_status()
+    s.pop("timing", None)
+    return s
+
+def get_programs():
+    """ Returns the programs that can be selected, and the one that is running."""
+    _sync_programs()
+    return {"programs": prog_list, "running": proc.get_current_program()}
@@ -0,0 +1,112 @@
+# website_async.py -- The splash pad's web site, served from one asyncio event loop.
+# dlb, Oct 2026
+#
+# Usage:  python website_async.py [port]
+#
+# This serves the same pages and API as website.py, with aiohttp instead of Flask's
+# development server.  Every client, including the ones watching /stream, is served
+# by the one event loop, so a slow phone costs a little memory rather than a thread.
+#
+# No handler blocks: the actions only queue commands for the conductor (see
+# web_api.py), which does all the hardware work and the waiting in its own thread,
+# and reading the status is a quick copy.  Request bodies are limited to
+# max_request_size, and each /stream client has a bounded queue (see status_stream.py).
+
+import sys
+import aiohttp.web as web
+import jinja2
+import conductor
+import corehw
+import wsp_proc as proc
+import status_stream
+import web_api
+
+max_request_size = 16 * 1024        # Bytes.  The page only ever posts a few small fields.
+
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"), autoescape=True)
+
+def _render(name, **params):
+    return web.Response(text=templates.get_template(name).render(**params), content_type="text/html")
+
+def _padnum(pad):
+    try:
+        return int(pad)
+    except (TypeError, ValueError):
+        return -1
+
+async def _json_body(request):
+    """ Returns the posted JSON object, or {} if there isn't one."""
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    if not isinstance(data, dict): return {}
+    return data
+
+async def index(request):
+    prog = web_api.find_program(request.query.get("program"))
+    if request.method == "POST":
+        # Older pages post their actions here.  Newer ones use /api/command.
+        data = await _json_body(request)
+        prog = web_api.find_program(data.get("program"))
+        web_api.do_action(data.get("action", ""), prog, _padnum(data.get("pad", "-1")))
+    p = conductor.get_status()
+    flow = "%3.0f%%" % p["flow_percent"]
+    if p["flow_fully_opened"]: flow = "Opened"
+    if p["flow_fully_closed"]: flow = "Closed"
+    return _render("index.html", psi1="%5.1f" % p["psi_input"], psi2="%5.1f" % p["psi_output"],
+                   flow=flow, speed=corehw.period, jump=corehw.duration,
+                   progs=web_api.prog_list, selected_prog=prog)
+
+async def api_command(request):
+    data = await _json_body(request)
+    return web.json_response(web_api.do_action(data.get("action", ""), data.get("program"), _padnum(data.get("pad", -1))))
+
+async def api_status(request):
+    return web.json_response(web_api.get_status())
+
+async def api_programs(request):
+    return web.json_response(web_api.get_programs())
+
+async def play(request):
+    web_api.do_action("ring")
+    return _render("play.html")
+
+async def status(request):
+    return _render("status.html", **conductor.get_status())
+
+async def stream(request):
+    sub = status_stream.subscribe_async()
+    if sub is None: return web.Response(status=503, text="Too many clients")
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream",
+                                           "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    try:
+        async for message in status_stream.async_events(sub):
+            await response.write(message.encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        status_stream.unsubscribe(sub)
+    return response
+
+def make_app():
+    app = web.Application(client_max_size=max_request_size)
+    app.router.add_route("GET", "/", index)
+    app.router.add_route("POST", "/", index)
+    app.router.add_post("/api/command", api_command)
+    app.router.add_get("/api/status", api_status)
+    app.router.add_get("/api/programs", api_programs)
+    app.router.add_get("/play", play)
+    app.router.add_get("/status", status)
+    app.router.add_get("/stream", stream)
+    app.router.add_static("/static/", "static")
+    return app
+
+if __name__ == '__main__':
+    port = 5000
+    if len(sys.argv) > 1: port = int(sys.argv[1])
+    conductor.init()
+    web_api.load_programs(proc.get_program_names())
+    print("Number of programs in wsp_script folder: %d" % len(web_api.prog_list))
+    web.run_app(make_app(), host="0.0.0.0", port=port)
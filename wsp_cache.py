@@ -0,0 +1,155 @@
+# wsp_cache.py -- Keeps the compiled WSP programs in a cache on disk, and reloads
+# the scripts that change.
+# dlb, Oct 2026
+
+# Each script in the script folder is cached by its file name, with its modified
+# time, size and SHA-1, and the program map that wsp_proc compiled from it.  The
+# cache is pickled to cache_file, so at startup only the scripts that changed since
+# the last run are parsed.
+#
+# While the pad runs, a thread of its own (see start()) looks at the folder every
+# poll_period ms (just a stat of each file).  A script whose time or size changed is
+# read and hashed, and is only parsed again if its contents really changed.  The
+# reading, compiling and saving of the cache all happen on that thread, so editing a
+# script never holds up the conductor's loop.  When anything changed, the thread
+# posts the new table of programs and wakes the "wsp_cache" task, whose heartbeat
+# just swaps it in, in one step (see wsp_proc.set_programs).  A program that is
+# already running keeps the map it started with, so an edit never interrupts a
+# show; the next play of that program uses the new version.  The conductor's
+# "reload" command has the thread scan at once.
+#
+# The cache is thrown away if wsp_proc.py, corehw.py, spout_registry.py or the
+# user's spout groups have changed, since the compiled code depends on them.
+
+import os
+import pickle
+import hashlib
+import threading
+import wsp_proc as proc
+import spout_registry
+import scheduler
+
+cache_file = "wsp_cache.pickle"
+poll_period = 2000             # Milliseconds between looks at the script folder
+
+entries = {}                   # File name -> (mtime_ns, size, sha1, program map).  Only the watcher thread
+                               # changes it, once it has started.
+posted = (0, None)             # (count, table of programs), the newest table made by the watcher thread
+applied = 0                    # The count of the last posted table that heartbeat swapped in
+scan_now = threading.Event()   # Set to have the watcher thread scan at once
+watcher_thread = None
+
+def _compiler_key():
+    """ Returns a hash of the source of the modules that compile the programs."""
+    h = hashlib.sha1()
+    for m in (proc, proc.corehw, spout_registry):
+        with open(m.__file__, "rb") as f: h.update(f.read())
+    h.update(repr(sorted((n, spout_registry.mask(n)) for n in spout_registry.group_names())).encode())
+    return h.hexdigest()
+
+def _load_cache():
+    """ Reads the cache file into entries, if it is there and still good."""
+    global entries
+    try:
+        with open(cache_file, "rb") as f: key, cached = pickle.load(f)
+    except Exception:
+        return
+    if key == _compiler_key(): entries = cached
+
+def _save_cache():
+    """ Writes entries to the cache file.  Writes a new file and renames it, so a
+    crash never leaves half a cache."""
+    tmp = cache_file + ".tmp"
+    try:
+        with open(tmp, "wb") as f: pickle.dump((_compiler_key(), entries), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        print("wsp: Unable to save the program cache: %s" % e)
+
+def _read_script(filename, st):
+    """ Returns the cache entry for a script, reusing the old one if the file is the
+    same.  Returns None if the script can't be read, or isn't a script."""
+    old = entries.get(filename)
+    if old is not None and old[0] == st.st_mtime_ns and old[1] == st.st_size: return old
+    fparts = filename.split(".")
+    if len(fparts) != 2 or fparts[1].lower() != "wsp": return None
+    try:
+        with open(os.path.join(proc.scrip_folder, filename), "rb") as f: data = f.read()
+    except OSError:
+        return None
+    sha1 = hashlib.sha1(data).hexdigest()
+    if old is not None and old[2] == sha1: return (st.st_mtime_ns, st.st_size, sha1, old[3])
+    print("wsp: Compiling %s" % filename)
+    lines = data.decode("utf-8", errors="replace").splitlines(keepends=True)
+    return (st.st_mtime_ns, st.st_size, sha1, proc.parse_program(fparts[0], lines))
+
+def scan():
+    """ Brings the cache up to date with the script folder.  Returns True if any
+    script was added, changed or removed."""
+    global entries
+    try:
+        files = sorted(os.scandir(proc.scrip_folder), key=lambda e: e.name)
+    except OSError:
+        return False
+    new_entries = {}
+    for e in files:
+        try:
+            st = e.stat()
+        except OSError:
+            continue
+        entry = _read_script(e.name, st)
+        if entry is not None: new_entries[e.name] = entry
+    changed = False
+    if new_entries.keys() != entries.keys(): changed = True
+    else:
+        for name, entry in new_entries.items():
+            if entry[3] is not entries[name][3]: changed = True
+    stat_changed = changed or any(new_entries[n][:3] != entries[n][:3] for n in new_entries)
+    entries = new_entries
+    if stat_changed: _save_cache()
+    return changed
+
+def load_programs():
+    """ Loads the programs, from the cache where it can.  Call at startup, instead of
+    wsp_proc.read_programs."""
+    _load_cache()
+    scan()
+    proc.set_programs([entry[3] for entry in entries.values()])
+    print("Number of loaded WSP Scripts: %d." % len(proc.programs))
+
+def _post():
+    """ Hands a new table of programs to the conductor's task.  Called on the watcher
+    thread."""
+    global posted
+    posted = (posted[0] + 1, [entry[3] for entry in entries.values()])
+    scheduler.wake("wsp_cache")
+
+def _watch():
+    """ The watcher thread: scans the folder every poll_period, or when asked to."""
+    while True:
+        scan_now.wait(poll_period / 1000)
+        scan_now.clear()
+        if scan(): _post()
+
+def start():
+    """ Starts the watcher thread.  Call after load_programs."""
+    global watcher_thread
+    if watcher_thread is not None: return
+    watcher_thread = threading.Thread(name="wsp_cache", daemon=True, target=_watch)
+    watcher_thread.start()
+
+def reload():
+    """ Has the watcher thread scan the script folder at once.  Doesn't wait for it;
+    any changes are swapped in by heartbeat."""
+    scan_now.set()
+
+def heartbeat(t):
+    """ Swaps in the table of programs posted by the watcher thread, if there is a
+    new one.  Runs when the thread wakes it, so never needs to be called back."""
+    global applied
+    count, programs = posted
+    if count != applied:
+        applied = count
+        proc.set_programs(programs)
+        print("wsp: Reloaded the scripts.  Number of WSP Scripts: %d." % len(proc.programs))
+    return None
@@ -2,23 +2,87 @@
 # dlb, Aug 2024
 
 # Please see the "documentation.md" file.
+#
+# Each program is compiled once, when it is read, into a list of instructions
+# (see compile_program).  Instructions are tuples that start with an opcode, and
+# hold pre-parsed arguments, so running a statement is a table lookup rather than
+# a chain of string compares.
+#
+# Programs run on tracks.  Each track has its own line number, timers and variables,
+# so several programs can run at once -- for example, the gate spouts held on while
+# a show plays on the field.  A spout belongs to the track that turned it on until
+# that track turns it off; another track that tries to turn it on meanwhile is
+# refused (and the refusal is counted as a conflict).  Likewise, the flow belongs to
+# the first track that sets it, until that track ends.  The tracks that are waiting
+# to run are kept in a heap by deadline, so a heartbeat only looks at the tracks
+# that are due.  The conductor plays programs on the "main" track.
+#
+# A step of a track runs statements back to back until it comes to one that waits:
+# pause, squirt, set-flow or hold.  So "random", "goto" and the like cost no time,
+# and a loop of a squirt and a pause takes exactly as long as they ask for.  A
+# step runs at most statement_budget statements; a loop that never waits then
+# carries on statement_period later, instead of holding up everything else.  The
+# budget also covers the steps of one heartbeat, so a loop whose only wait takes no
+# time (a "pause 0") can't hold up the loop either.
+#
+# The waits are timed from when the statement was due (Track.due_time), not from
+# when the loop got round to it, so lateness in waking up doesn't add up from one
+# pass of a loop to the next.
 
-import time 
+import heapq
+import clock
 import os
 import corehw
+import spout_registry as spouts
 import ball_valve
 import random
 import pad_leds
+import scheduler
 
 scrip_folder = "wsp_scripts"
-programs = []                      # A table of all known programs
-current_program = None             # Points to a map that defines the current program
-current_line_num = 0               # Current line number for execution
-new_statement = True               # Flag that indicates if the current_line_num is a new statement
-variable_table = {}                # Holes the program variables
-pause_time_start = 0               # Used for the pause and squirt statements
-lasttime_check = time.monotonic_ns()
+programs = []                      # A table of all known programs.  Replaced as a whole, never changed in place.
+programs_version = 0               # Goes up by one each time programs is replaced
+statement_period = 2_000_000       # Nanoseconds between steps of a track that is waiting, or over its budget
+statement_budget = 64              # Most statements a track runs in one step
+main_track = "main"                # The track the conductor plays programs on
+tracks = {}                        # Track name -> Track, for the tracks with a running program
+track_heap = []                    # Heap of (deadline, count, track).  Entries whose deadline no longer matches are stale.
+heap_count = 0                     # Breaks ties in track_heap
+refresh_pending = False            # Set by refresh()
+owned_spouts = 0                   # Mask of the spouts owned by any track
+flow_owner = None                  # The track that controls the flow, or None
+trace = None                       # If set, called as trace(event, due, t, mask) -- see set_trace
 
+# Opcodes.  Each instruction is a tuple of (opcode, arg1, arg2, ...).
+OP_NOP = 0              # name, label, and unknown statements
+OP_SET = 1              # (OP_SET, target, value)
+OP_INC = 2              # (OP_INC, target, step)  -- dec uses a negated step
+OP_ALL_OFF = 3          # (OP_ALL_OFF,)
+OP_SET_FLOW = 4         # (OP_SET_FLOW, value)
+OP_CHANGE_FLOW = 5      # (OP_CHANGE_FLOW, value)
+OP_GOTO = 6             # (OP_GOTO, line)  -- line is -1 if the label is missing
+OP_IF_ZERO = 7          # (OP_IF_ZERO, value, line)
+OP_IF_NOT_ZERO = 8      # (OP_IF_NOT_ZERO, value, line)
+OP_PAUSE = 9            # (OP_PAUSE, delay)
+OP_SPOUT_ON = 10        # (OP_SPOUT_ON, spout)
+OP_SPOUT_OFF = 11       # (OP_SPOUT_OFF, spout)
+OP_SQUIRT = 12          # (OP_SQUIRT, spout, duration)
+OP_RANDOM = 13          # (OP_RANDOM, target, low, high)
+OP_HOLD = 14            # (OP_HOLD,)
+OP_EXIT = 15            # (OP_EXIT,)
+OP_RAMP_FLOW = 16       # (OP_RAMP_FLOW, value, duration, easing)  -- easing is a name in ball_valve.easings
+
+# Argument kinds.  Value arguments are tuples of (kind, value).
+ARG_LIT = 0             # (ARG_LIT, integer)
+ARG_VAR = 1             # (ARG_VAR, slot)
+ARG_DURATION = 2        # (ARG_DURATION, 0) -- the global *duration
+ARG_PERIOD = 3          # (ARG_PERIOD, 0)   -- the global *period
+ARG_FLOW = 4            # (ARG_FLOW, 0)     -- the global *flow, read only
+
+# Spout argument kinds.  Spout arguments are tuples of (kind, value).
+SPOUT_MASK = 0          # (SPOUT_MASK, bitmask) -- resolved when compiled
+SPOUT_VAR = 1           # (SPOUT_VAR, arg) -- value is a pattern number
+SPOUT_INDEXED = 2       # (SPOUT_INDEXED, (basename, arg)) -- as in major_row_[*i]
 
 def split_line(line):
     """ Split line into words, while treating quoted text as one word and removing 
@@ -68,6 +132,11 @@ def read_program(filename):
         f.close()
     except:
         return None
+    return parse_program(prg_name, lines)
+
+def parse_program(prg_name, lines):
+    """ Parses and compiles the lines of a program.  prg_name is its name if it has
+    no name statement.  Returns the program map. """
     prg_lines = [] 
     for line in lines:
         words = split_line(line) 
@@ -75,7 +144,9 @@ def read_program(filename):
             prg_lines.append(words)
             if words[0] == "name":
                 if len(words) > 1: prg_name = words[1]
-    return {"program_name": prg_name, "lines": prg_lines }
+    prg = {"program_name": prg_name, "lines": prg_lines }
+    compile_program(prg)
+    return prg
 
 def print_programs():
     "Print the contents of all the programs.  For debugging."
@@ -93,14 +164,22 @@ def print_programs():
 
 def read_programs():
     """ Reads in all the programs in the script folder, and parses them.  Must
-    be called at startup. """
-    progs = os.listdir(scrip_folder)
-    for p in progs:
+    be called at startup, unless the programs come from the cache (see wsp_cache.py). """
+    progs = []
+    for p in sorted(os.listdir(scrip_folder)):
         prg = read_program(p) 
         if prg is not None:
-            programs.append(prg)
+            progs.append(prg)
+    set_programs(progs)
     print("Number of loaded WSP Scripts: %d." % len(programs))
 
+def set_programs(progs):
+    """ Replaces the table of programs.  The programs already running keep the maps
+    they started with, so they carry on as they were; new starts find the new ones."""
+    global programs, programs_version
+    programs = progs
+    programs_version += 1
+
 
 def get_program_names():
     """ Returns a list of program names that can be run. """
@@ -109,34 +188,61 @@ def get_program_names():
         names.append(p["program_name"])
     return names
 
-def get_current_program():
-    """ Returns the name of the currently running program. If no
+def find_program(prog_name):
+    """ Returns the program map with the given name, or None. """
+    for p in programs:
+        if p["program_name"] == prog_name: return p
+    return None
+
+def get_current_program(track=main_track):
+    """ Returns the name of the program running on a track. If no
      program is active, None is returned. """
-    if current_program is None: return None
-    return current_program["program_name"]
+    tr = tracks.get(track)
+    if tr is None or tr.program is None: return None
+    return tr.program["program_name"]
+
+def get_current_line(track=main_track):
+    """ Returns the line number that a track is on, or 0 if nothing is running. """
+    tr = tracks.get(track)
+    if tr is None or tr.program is None: return 0
+    return tr.line_num
 
-def start_program(prog_name):
-    """ Starts program with the given name. """
-    global current_program, current_line_num, new_statement, variable_table
+def get_tracks():
+    """ Returns a tuple of (track name, program name, line number, conflicts) for
+    every track with a running program. """
+    return tuple((name, tr.program["program_name"], tr.line_num, tr.conflicts)
+                 for name, tr in list(tracks.items()) if tr.program is not None)
+
+def start_program(prog_name, track=main_track):
+    """ Starts program with the given name on a track, stopping whatever was
+    running on that track. """
     print("wsp: STARTING PROGRAM: %s" % prog_name)
-    if current_program is not None:
-        corehw.all_off()
-        current_program = None 
-    for p in programs:
-        if p["program_name"] == prog_name:
-            current_program = p 
-            current_line_num = 0 
-            new_statement = True 
-            variable_table = {}
-            return
+    stop_track(track)
+    p = find_program(prog_name)
+    if p is None: return
+    tr = Track(track, p)
+    # Time the program from now, not from when the clock started.
+    tr.lasttime_check = clock.now_ns()
+    tr.due_time = tr.lasttime_check
+    tracks[track] = tr
+    _schedule(tr)
+    scheduler.wake("wsp_proc")
 
-def abort_program():
-    """ Stops (aborts) any running program."""
-    global current_program
+def stop_track(track):
+    """ Stops the program running on a track, if any, and turns off its spouts. """
+    tr = tracks.pop(track, None)
+    if tr is not None: end_track(tr)
+
+def abort_program(track=None):
+    """ Stops (aborts) the program on a track, or, if track is None, the programs
+    on all the tracks."""
     print("wsp: ABORTING PROGRAM")
-    if current_program is not None:
-        corehw.all_off()
-        current_program = None 
+    if track is not None:
+        stop_track(track)
+        return
+    running = len(tracks) > 0
+    for name in list(tracks): stop_track(name)
+    if running: corehw.all_off()
 
 def check_arg_is_var(arg):
     """ Returns true if arg is a variable. """
@@ -173,307 +279,515 @@ def make_int(arg):
     if neg: v = -v
     return v
 
-def get_var_value(arg):
-    """ Given a argument that should be a variable or a literal, return it's value. """
-    if len(arg) <= 0: return 0 
-    if arg[0] == '*':
-        if arg == "*flow": ball_valve.get_current_position() 
-        if arg == "*duration": return corehw.duration
-        if arg == "*period": return corehw.period
-        if arg in variable_table:
-            return variable_table[arg]
-        else:
-            variable_table[arg] = 0
-            return 0
-    return make_int(arg)
-
-def set_var_value(var, value):
-    """ Sets the variable to the given value. var should be string. value can be string or int.
-    If value is string, it can be a variable or a literal."""
-    if not check_arg_is_var(var): return
-    if var == "*flow": return 
-    iv = 0 
-    if type(value) is int: iv = value 
-    else: iv = get_var_value(value)
-    if var == "*duration":
-        #print("wsp:    !! Setting corehw.duration = %d" % iv)
-        corehw.duration = iv 
-        return
-    if var == "*period":
-        #print("wsp:    !! Setting corehw.period = %d" % iv)
-        corehw.period = iv
-        return
-    variable_table[var] = iv
 
-def set_flow(args):
-    """ Helper function to set flow."""
-    v = 0
-    if len(args) >= 1: v = get_var_value(args[0])
-    #print("In set-flow. args[0]=%s, v=%d" % (args[0], v))
-    #print(type(v))
-    if v > 100: v = 100
-    if v < 0: v = 0
-    if v == 0: ball_valve.reset_to_zero()
-    elif v == 100: ball_valve.reset_to_fullon()
-    else: ball_valve.set_position(v)
-    return
-
-def set_spout(spout_name, enable=True):
-    """ Turns on or Off a Spout, given the name as a string. """
-    if "[" in spout_name:
-        indx = spout_name.index("[")
-        basename = spout_name[:indx]
-        extension = spout_name[indx:]
-        if extension[-1] != ']': 
-            advance_line()
-            return
-        v = get_var_value(extension[1:-1])
-        spout_name = basename + str(v)
-    if spout_name in corehw.spout_names:
-        if enable: corehw.turn_pattern_on(spout_name)
-        else:      corehw.turn_pattern_off(spout_name)
-    else:
-        if check_arg_is_var(spout_name):
-            v = get_var_value(spout_name)
-            if enable: corehw.turn_pattern_on(v)
-            else: corehw.turn_pattern_off(v)
-        else:
-            if is_num(spout_name): 
-                if enable: corehw.turn_pattern_on(make_int(spout_name))
-                else: corehw.turn_pattern_off(make_int(spout_name))
-
-def advance_line():
-    """ Helper function to advance line."""
-    global current_program, current_line_num, new_statement
-    current_line_num += 1 
-    new_statement = True
+# ===================  Compiler
 
-def goto_line(label):
-    """ Helper function to jump to a label. """
-    global current_program, current_line_num, new_statement
-    if type(label) is not str: 
-        advance_line()
-        return
-    if current_program is None: return 
-    lines = current_program["lines"]
-    for i, words in enumerate(lines):
-        if len(words) < 2: continue
-        if words[0] == "label" and words[1] == label:
-            current_line_num = i 
-            new_statement = True
-            current_statement_start_time = time.monotonic_ns()
-            return 
-        
-def print_line_status(cmd, args):
-    # s = "wsp: cmd=%s  nargs=%d:  " % (cmd, len(args))
-    # for a in args:
-    #     s += a + "  "
-    # print(s)
-    pass
-
-def print_wsp_debug(msg):
-    #print("wsp:    %s" % msg)
-    pass
-
-def heartbeat():
-    """ Come here to run the current program. Must be called every few millisconds."""
-    global current_program, current_line_num, new_statement, pause_time_start
-    global lasttime_check
-    t = time.monotonic_ns()
-    elp = (t - lasttime_check) / 1_000_000
-    if elp < 2: return 
-    lasttime_check = t 
-    if current_program is None: return 
-    lines = current_program["lines"]
-    if current_line_num >= len(lines):
-        # Program has come to a end. Shut it down
-        corehw.all_off()
-        current_program  = None 
-        return
-    words = lines[current_line_num]
-    if len(words) <= 0:
-        advance_line() 
-        return 
+def _compile_arg(word, slots):
+    """ Compiles a word that is a variable or a literal into a value argument. New
+    variables are given the next free slot. """
+    if len(word) > 0 and word[0] == '*':
+        if word == "*flow": return (ARG_FLOW, 0)
+        if word == "*duration": return (ARG_DURATION, 0)
+        if word == "*period": return (ARG_PERIOD, 0)
+        if word not in slots: slots[word] = len(slots)
+        return (ARG_VAR, slots[word])
+    return (ARG_LIT, make_int(word))
+
+def _compile_target(word, slots):
+    """ Compiles a word that is to be assigned.  Returns None if the word is not
+    a variable that can be set. """
+    if not check_arg_is_var(word): return None
+    if word == "*flow": return None
+    return _compile_arg(word, slots)
+
+def _static_spout_mask(name):
+    """ Returns the bitmask for a spout name or number, or zero if unknown. """
+    if spouts.is_name(name): return spouts.mask(name)
+    if is_num(name): return spouts.pattern_mask(make_int(name))
+    return 0
+
+def _compile_spout(word, slots):
+    """ Compiles a spout name into a spout argument. """
+    if "[" in word:
+        indx = word.index("[")
+        if word[-1] != ']': return (SPOUT_MASK, 0)
+        return (SPOUT_INDEXED, (word[:indx], _compile_arg(word[indx + 1:-1], slots)))
+    if spouts.is_name(word): return (SPOUT_MASK, spouts.mask(word))
+    if check_arg_is_var(word): return (SPOUT_VAR, _compile_arg(word, slots))
+    return (SPOUT_MASK, _static_spout_mask(word))
+
+def _compile_jump(label, labels, warnings, line_num):
+    """ Resolves a label to the line number to jump to.  Missing labels are
+    reported, and give -1 so that the jump falls through to the next line. """
+    if label in labels: return labels[label]
+    warnings.append("statement %d: label '%s' not found" % (line_num, label))
+    return -1
+
+def _compile_statement(words, slots, labels, warnings, line_num):
+    """ Compiles one statement (a list of words) into an instruction. """
     cmd = words[0]
     args = words[1:]
-    # ===================  Process Statement Below.  
-    # Note, that the statement might be already "in process" or it might be
-    # a "new_statement" as indicated by the new_statement variable.
-    if cmd == "name":
-        print_line_status(cmd, args)
-        advance_line()
-        return
+    n = len(args)
     if cmd == "set":
-        print_line_status(cmd, args)
-        if len(args) >= 2: 
-            set_var_value(args[0], args[1])
-            print_wsp_debug("%s = %s" % (args[0], args[1]))
-        advance_line()
-        return
-    if cmd == "inc":
-        print_line_status(cmd, args)
-        step = 1 
-        if len(args) > 1: 
-            step = get_var_value(args[1])
-            print_wsp_debug("step = %d" % step)
-        v = get_var_value(args[0])
-        v = v + step 
-        set_var_value(args[0], v)
-        print_wsp_debug("%s = %s" % (args[0], v))
-        advance_line()
-        return 
-    if cmd == "dec":
-        print_line_status(cmd, args)
-        step = 1 
-        if len(args) > 1: 
-            step = get_var_value(args[1])
-            print_wsp_debug("step = %d" % step)
-        v = get_var_value(args[0])
-        v = v - step 
-        set_var_value(args[0], v)
-        print_wsp_debug("%s = %s" % (args[0], v))
-        advance_line()
-        return 
-    if cmd == "all-off":
-        print_line_status(cmd, args)
-        corehw.all_off()
-        advance_line()
-        return
-    if cmd == "set-flow":
-        if new_statement:
-            print_line_status(cmd, args)
-            set_flow(args)
-            new_statement = False
-            pause_time_start = time.monotonic_ns()
-            return
-        t = time.monotonic_ns()
-        elp = (t - pause_time_start) / 1_000_000 
-        if elp > 10000:
-            print_wsp_debug("!!! Timeout while waiting for ball valve.")
-            advance_line() 
-            return
-        if ball_valve.in_motion(): return
-        advance_line()
-        return 
-    if cmd == "change-flow":
-        print_line_status(cmd, args)
-        set_flow(args)
-        advance_line()
-        return
-    if cmd == "label":
-        print_line_status(cmd, args)
-        advance_line()
-        return
+        if n < 2: return (OP_NOP,)
+        target = _compile_target(args[0], slots)
+        if target is None: return (OP_NOP,)
+        return (OP_SET, target, _compile_arg(args[1], slots))
+    if cmd == "inc" or cmd == "dec":
+        if n < 1: return (OP_NOP,)
+        step = (ARG_LIT, 1)
+        if n > 1: step = _compile_arg(args[1], slots)
+        target = _compile_target(args[0], slots)
+        if target is None: return (OP_NOP,)
+        if cmd == "dec":
+            if step[0] == ARG_LIT: step = (ARG_LIT, -step[1])
+            else: return (OP_INC, target, step, -1)
+        return (OP_INC, target, step, 1)
+    if cmd == "all-off": return (OP_ALL_OFF,)
+    if cmd == "set-flow" or cmd == "change-flow":
+        value = (ARG_LIT, 0)
+        if n >= 1: value = _compile_arg(args[0], slots)
+        if cmd == "set-flow": return (OP_SET_FLOW, value)
+        return (OP_CHANGE_FLOW, value)
+    if cmd == "ramp-flow":
+        if n < 1: return (OP_NOP,)
+        duration = (ARG_PERIOD, 0)
+        if n >= 2: duration = _compile_arg(args[1], slots)
+        easing = "linear"
+        if n >= 3:
+            if args[2] in ball_valve.easings: easing = args[2]
+            else: warnings.append("statement %d: unknown easing '%s'" % (line_num, args[2]))
+        return (OP_RAMP_FLOW, _compile_arg(args[0], slots), duration, easing)
     if cmd == "goto":
-        print_line_status(cmd, args)
-        if len(args) >= 1:
-            goto_line(args[0])
-        else: advance_line()
-        return
-    if cmd == "if-zero":
-        print_line_status(cmd, args)
-        if len(args) < 2:
-            advance_line()
-            return
-        label = args[1]
-        v = 0 
-        if len(args) >= 2:
-            v = get_var_value(args[0])
-            print_wsp_debug("%s=%d" % (args[0], v))
-        if v == 0: goto_line(label)
-        else: advance_line()
-    if cmd == "if-not-zero":
-        print_line_status(cmd, args)
-        if len(args) < 2:
-            advance_line()
-            return
-        label = args[1]
-        v = 0 
-        if len(args) >= 2:
-            v = get_var_value(args[0])
-            print_wsp_debug("%s=%d" % (args[0], v))
-        if v != 0: goto_line(label)
-        else: advance_line()
+        if n < 1: return (OP_NOP,)
+        return (OP_GOTO, _compile_jump(args[0], labels, warnings, line_num))
+    if cmd == "if-zero" or cmd == "if-not-zero":
+        if n < 2: return (OP_NOP,)
+        op = OP_IF_ZERO
+        if cmd == "if-not-zero": op = OP_IF_NOT_ZERO
+        return (op, _compile_arg(args[0], slots), _compile_jump(args[1], labels, warnings, line_num))
     if cmd == "pause":
-        if new_statement:
-            print_line_status(cmd, args)
-            pause_time_start = time.monotonic_ns() 
-            new_statement = False 
-            if len(args) <= 0: v = corehw.period
-            else: v = get_var_value(args[0])
-            print_wsp_debug("delay=%d" % v)
-            return 
-        if len(args) <= 0: v = corehw.period
-        else: v = get_var_value(args[0])
-        t = time.monotonic_ns()
-        elp = (t - pause_time_start) / 1_000_000 
-        if elp > v: advance_line()
-        return
-    if cmd == "spout-on":
-        print_line_status(cmd, args)
-        if len(args) > 0:
-            set_spout(args[0], True)
-        advance_line()
-        return
-    if cmd == "spout-off":
-        print_line_status(cmd, args)
-        if len(args) > 0:
-            set_spout(args[0], False)
-        advance_line()
-        return
+        if n <= 0: return (OP_PAUSE, (ARG_PERIOD, 0))
+        return (OP_PAUSE, _compile_arg(args[0], slots))
+    if cmd == "spout-on" or cmd == "spout-off":
+        if n <= 0: return (OP_NOP,)
+        if cmd == "spout-on": return (OP_SPOUT_ON, _compile_spout(args[0], slots))
+        return (OP_SPOUT_OFF, _compile_spout(args[0], slots))
     if cmd == "squirt":
-        if len(args) <= 0:
-            print_line_status(cmd, args)
-            print_wsp_debug("no args.")
-            advance_line()
-            return 
-        if new_statement:
-            print_line_status(cmd, args)
-            duration = corehw.duration 
-            if len(args) >= 2: 
-                print_wsp_debug("Using Duration from args. duration=%d" % duration)
-                duration = get_var_value(args[1])
-            else:
-                print_wsp_debug("Using Duration from global. duration=%d" % duration)
-            pause_time_start = time.monotonic_ns()
-            set_spout(args[0], True)
-            new_statement = False 
-            return
-        else:
-            t = time.monotonic_ns()
-            elp = (t - pause_time_start) / 1_000_000
-            duration = corehw.duration 
-            if len(args) >= 2: duration = get_var_value(args[1])
-            if elp > duration:
-                set_spout(args[0], False)
-                advance_line() 
-            return
+        if n <= 0: return (OP_NOP,)
+        duration = (ARG_DURATION, 0)
+        if n >= 2: duration = _compile_arg(args[1], slots)
+        return (OP_SQUIRT, _compile_spout(args[0], slots), duration)
     if cmd == "random":
-        print_line_status(cmd, args)
-        if len(args) >= 1:
-            if check_arg_is_var(args[0]):
-                i1 = 0
-                i2 = 13
-                if len(args) >= 2: i1 = get_var_value(args[1])
-                if len(args) >= 3: i2 = get_var_value(args[2])
-                v = random.randint(i1, i2)
-                set_var_value(args[0], v)
-                print_wsp_debug("%s = %d" % (args[0], v))
-        advance_line()
+        if n < 1: return (OP_NOP,)
+        target = _compile_target(args[0], slots)
+        if target is None: return (OP_NOP,)
+        low, high = (ARG_LIT, 0), (ARG_LIT, 13)
+        if n >= 2: low = _compile_arg(args[1], slots)
+        if n >= 3: high = _compile_arg(args[2], slots)
+        return (OP_RANDOM, target, low, high)
+    if cmd == "hold": return (OP_HOLD,)
+    if cmd == "exit": return (OP_EXIT,)
+    return (OP_NOP,)          # name, label, and unknown statements
+
+def find_labels(lines, warnings):
+    """ Returns a map of label name to line number for the given lines.  Duplicate
+    labels are reported in warnings; the first one is used. """
+    labels = {}
+    for i, words in enumerate(lines):
+        if len(words) < 2 or words[0] != "label": continue
+        if words[1] in labels:
+            warnings.append("statement %d: duplicate label '%s' (first at statement %d)" % (i, words[1], labels[words[1]]))
+            continue
+        labels[words[1]] = i
+    return labels
+
+def _reads_flow(code):
+    """ Returns True if any instruction reads *flow, the actual valve position. """
+    def has_flow(arg):
+        if type(arg) is not tuple: return False
+        if arg == (ARG_FLOW, 0): return True
+        for a in arg:
+            if has_flow(a): return True
+        return False
+    for ins in code:
+        for arg in ins[1:]:
+            if has_flow(arg): return True
+    return False
+
+def compile_program(prg):
+    """ Compiles the lines of a program (as made by read_program) into instructions.
+    Adds "code", a list of instructions with one per line, "reads_flow", True if
+    the program reads *flow, "variables", the names of the variables in slot 
+    order, "labels", a map of label to line number, and "warnings", a list of 
+    problems found, to the program map. Warnings are printed. """
+    slots = {}
+    code = []
+    warnings = []
+    labels = find_labels(prg["lines"], warnings)
+    for i, words in enumerate(prg["lines"]):
+        code.append(_compile_statement(words, slots, labels, warnings, i))
+    variables = [""] * len(slots)
+    for name, slot in slots.items(): variables[slot] = name
+    prg["code"] = code
+    prg["reads_flow"] = _reads_flow(code)
+    prg["variables"] = variables
+    prg["labels"] = labels
+    prg["warnings"] = warnings
+    for w in warnings:
+        print("wsp: %s: %s" % (prg["program_name"], w))
+    return prg
+
+# ===================  Executor
+
+class LiveOutput:
+    """ Where a track's spout and flow changes go: to the hardware.  A timeline
+    renderer (see wsp_timeline.py) gives its track a stand-in that records them."""
+
+    def spouts_on(self, mask):
+        corehw.turn_mask_on(mask)
+
+    def spouts_off(self, mask):
+        corehw.turn_mask_off(mask)
+
+    def move_valve(self, v):
+        if v == 0: ball_valve.reset_to_zero()
+        elif v == 100: ball_valve.reset_to_fullon()
+        else: ball_valve.set_position(v)
+
+    def ramp_valve(self, v, duration, easing):
+        ball_valve.ramp(v, duration, easing=easing)
+
+    def valve_settled(self):
+        return not ball_valve.in_motion()
+
+live_output = LiveOutput()
+
+class Track:
+    """ The state of one program running on one track."""
+
+    def __init__(self, name, program):
+        self.name = name
+        self.program = program             # The program map, or None once it has ended
+        self.line_num = 0                  # Current line number for execution
+        self.new_statement = True          # Flag that indicates if line_num is a new statement
+        self.variables = [0] * len(program["variables"])   # The program variables, indexed by slot
+        self.pause_time_start = 0          # Used for the pause, squirt and set-flow statements
+        self.lasttime_check = 0            # When the track last ran, in ns
+        self.due_time = 0                  # When the statement being run was due to run, in ns
+        self.deadline = None               # When the track next needs to run (see next_step_time)
+        self.owned = 0                     # Mask of the spouts this track has turned on
+        self.conflicts = 0                 # Spout or flow changes refused because another track had them
+        self.out = live_output             # Where the spout and flow changes go
+        self.live = True                   # False for a track being rendered: it doesn't take part in
+                                           # arbitration, and isn't traced
+        self.args = None                   # None to use the global *duration and *period, or a private [duration, period]
+        self.rng = random                  # The random number generator for the random statement
+
+def get_value(tr, arg):
+    """ Returns the value of a compiled value argument. """
+    kind = arg[0]
+    if kind == ARG_LIT: return arg[1]
+    if kind == ARG_VAR: return tr.variables[arg[1]]
+    if kind == ARG_DURATION:
+        if tr.args is None: return corehw.duration
+        return tr.args[0]
+    if kind == ARG_PERIOD:
+        if tr.args is None: return corehw.period
+        return tr.args[1]
+    return ball_valve.get_current_position()
+
+def set_value(tr, target, value):
+    """ Sets a compiled target argument to the given value. """
+    kind = target[0]
+    if kind == ARG_VAR: tr.variables[target[1]] = value
+    elif kind == ARG_DURATION:
+        if tr.args is None: corehw.duration = value
+        else: tr.args[0] = value
+    elif kind == ARG_PERIOD:
+        if tr.args is None: corehw.period = value
+        else: tr.args[1] = value
+
+def get_spout_mask(tr, spout):
+    """ Returns the bitmask for a compiled spout argument. """
+    kind = spout[0]
+    if kind == SPOUT_MASK: return spout[1]
+    if kind == SPOUT_VAR:
+        return spouts.pattern_mask(get_value(tr, spout[1]))
+    basename, arg = spout[1]
+    return _static_spout_mask(basename + str(get_value(tr, arg)))
+
+def claim_spouts(tr, mask):
+    """ Returns the part of mask that the track may turn on: the spouts that no other
+    track has on.  The track owns those spouts until it turns them off."""
+    global owned_spouts
+    if not tr.live:
+        tr.owned |= mask
+        return mask
+    taken = mask & owned_spouts & ~tr.owned
+    if taken != 0: tr.conflicts += 1
+    mask &= ~taken
+    tr.owned |= mask
+    owned_spouts |= mask
+    return mask
+
+def release_spouts(tr, mask):
+    """ Returns the part of mask that the track owns, and gives up ownership of it."""
+    global owned_spouts
+    mask &= tr.owned
+    tr.owned &= ~mask
+    if tr.live: owned_spouts &= ~mask
+    return mask
+
+def set_flow(tr, v, duration=0, easing="linear"):
+    """ Helper function to set flow, at once or (given a duration in ms) in a ramp.
+    Only one track controls the flow at a time: the first one to set it, until it
+    ends.  Returns False if the track may not."""
+    global flow_owner
+    if tr.live:
+        if flow_owner is not None and flow_owner is not tr:
+            tr.conflicts += 1
+            return False
+        flow_owner = tr
+    if v > 100: v = 100
+    if v < 0: v = 0
+    if duration > 0: tr.out.ramp_valve(v, duration, easing)
+    else: tr.out.move_valve(v)
+    return True
+
+def advance_line(tr):
+    """ Helper function to advance line."""
+    tr.line_num += 1 
+    tr.new_statement = True
+
+def jump_to(tr, line_num):
+    """ Helper function to jump to a line.  A line of -1 (a missing label) advances
+    to the next line instead. """
+    if line_num < 0:
+        advance_line(tr)
         return
-    if cmd == "hold":
-        if new_statement:
-            print_line_status(cmd, args)
-            new_statement = False
-        return 
-    if cmd == "exit":
-        print_line_status(cmd, args)
-        corehw.all_off()
-        current_program  = None 
+    tr.line_num = line_num
+    tr.new_statement = True
+
+def goto_line(tr, label):
+    """ Helper function to jump to a label. """
+    if tr.program is None: return 
+    jump_to(tr, tr.program["labels"].get(label, -1))
+
+def end_track(tr):
+    """ Stops a track: turns off its spouts and gives up the flow."""
+    global flow_owner
+    tr.out.spouts_off(release_spouts(tr, tr.owned))
+    if flow_owner is tr: flow_owner = None
+    tr.program = None
+    tr.deadline = None
+    if tracks.get(tr.name) is tr: del tracks[tr.name]
+
+def _op_nop(tr, ins, t):
+    advance_line(tr)
+
+def _op_set(tr, ins, t):
+    set_value(tr, ins[1], get_value(tr, ins[2]))
+    advance_line(tr)
+
+def _op_inc(tr, ins, t):
+    set_value(tr, ins[1], get_value(tr, ins[1]) + ins[3] * get_value(tr, ins[2]))
+    advance_line(tr)
+
+def _op_all_off(tr, ins, t):
+    tr.out.spouts_off(release_spouts(tr, tr.owned))
+    advance_line(tr)
+
+def _op_set_flow(tr, ins, t):
+    if tr.new_statement:
+        if not set_flow(tr, get_value(tr, ins[1])):
+            advance_line(tr)
+            return
+        tr.new_statement = False
+        tr.pause_time_start = tr.due_time
         return
-    
+    if t - tr.pause_time_start > 10_000_000_000 or tr.out.valve_settled():
+        advance_line(tr)
 
+def _op_change_flow(tr, ins, t):
+    set_flow(tr, get_value(tr, ins[1]))
+    advance_line(tr)
 
+def _op_ramp_flow(tr, ins, t):
+    set_flow(tr, get_value(tr, ins[1]), get_value(tr, ins[2]), ins[3])
+    advance_line(tr)
 
-    
+def _op_goto(tr, ins, t):
+    jump_to(tr, ins[1])
+
+def _op_if_zero(tr, ins, t):
+    if get_value(tr, ins[1]) == 0: jump_to(tr, ins[2])
+    else: advance_line(tr)
+
+def _op_if_not_zero(tr, ins, t):
+    if get_value(tr, ins[1]) != 0: jump_to(tr, ins[2])
+    else: advance_line(tr)
+
+def _op_pause(tr, ins, t):
+    if tr.new_statement:
+        tr.pause_time_start = tr.due_time
+        tr.new_statement = False
+        return
+    if t - tr.pause_time_start >= get_value(tr, ins[1]) * 1_000_000:
+        if trace is not None and tr.live: trace("pause", tr.pause_time_start + get_value(tr, ins[1]) * 1_000_000, t, 0)
+        advance_line(tr)
+
+def _op_spout_on(tr, ins, t):
+    mask = claim_spouts(tr, get_spout_mask(tr, ins[1]))
+    if trace is not None and tr.live: trace("on", tr.due_time, t, mask)
+    tr.out.spouts_on(mask)
+    advance_line(tr)
+
+def _op_spout_off(tr, ins, t):
+    mask = release_spouts(tr, get_spout_mask(tr, ins[1]))
+    if trace is not None and tr.live: trace("off", tr.due_time, t, mask)
+    tr.out.spouts_off(mask)
+    advance_line(tr)
+
+def _op_squirt(tr, ins, t):
+    if tr.new_statement:
+        tr.pause_time_start = tr.due_time
+        mask = claim_spouts(tr, get_spout_mask(tr, ins[1]))
+        if trace is not None and tr.live: trace("squirt", tr.due_time, t, mask)
+        tr.out.spouts_on(mask)
+        tr.new_statement = False
+        return
+    if t - tr.pause_time_start >= get_value(tr, ins[2]) * 1_000_000:
+        mask = release_spouts(tr, get_spout_mask(tr, ins[1]))
+        if trace is not None and tr.live: trace("squirt_end", tr.pause_time_start + get_value(tr, ins[2]) * 1_000_000, t, mask)
+        tr.out.spouts_off(mask)
+        advance_line(tr)
+
+def _op_random(tr, ins, t):
+    i1 = get_value(tr, ins[2])
+    i2 = get_value(tr, ins[3])
+    if i1 > i2: i1, i2 = i2, i1
+    set_value(tr, ins[1], tr.rng.randint(i1, i2))
+    advance_line(tr)
+
+def _op_hold(tr, ins, t):
+    tr.new_statement = False
+
+def _op_exit(tr, ins, t):
+    end_track(tr)
+
+# The dispatch table, indexed by opcode.
+_dispatch = (_op_nop, _op_set, _op_inc, _op_all_off, _op_set_flow, _op_change_flow,
+             _op_goto, _op_if_zero, _op_if_not_zero, _op_pause, _op_spout_on,
+             _op_spout_off, _op_squirt, _op_random, _op_hold, _op_exit, _op_ramp_flow)
+
+def step_track(tr, t):
+    """ Runs (or continues) the statement a track is on, and the statements after
+    it, up to one that waits or statement_budget of them.  t is the current time in
+    nanoseconds.  Returns the number of statements run."""
+    count = 0
+    while count < statement_budget:
+        if tr.program is None: break
+        code = tr.program["code"]
+        if tr.line_num >= len(code):
+            # Program has come to a end. Shut it down
+            end_track(tr)
+            break
+        ins = code[tr.line_num]
+        _dispatch[ins[0]](tr, ins, t)
+        count += 1
+        if not tr.new_statement: break          # Waiting
+    return count
+
+def next_step_time(tr):
+    """ Returns the time (in ns) that the track next needs to run, or None if its
+    program has ended or is holding."""
+    if tr.program is None: return None
+    if tr.new_statement: return tr.lasttime_check + statement_period
+    ins = tr.program["code"][tr.line_num]
+    op = ins[0]
+    if op == OP_PAUSE: return tr.pause_time_start + get_value(tr, ins[1]) * 1_000_000
+    if op == OP_SQUIRT: return tr.pause_time_start + get_value(tr, ins[2]) * 1_000_000
+    if op == OP_HOLD: return None
+    return tr.lasttime_check + statement_period
+
+def _schedule(tr, not_before=None):
+    """ Works out when the track next needs to run, but not before not_before (if
+    given), and puts it on the heap."""
+    global heap_count
+    tr.deadline = next_step_time(tr)
+    if tr.deadline is None: return
+    if not_before is not None and tr.deadline < not_before: tr.deadline = not_before
+    heap_count += 1
+    heapq.heappush(track_heap, (tr.deadline, heap_count, tr))
+
+def adopt_track(tr, shift, track=main_track):
+    """ Makes a track that was being rendered (see wsp_timeline.py) live, running on
+    the given track from where it is now.  shift is added to its times to turn them
+    into real times.  The spouts it has on become owned by it. """
+    global owned_spouts, flow_owner
+    stop_track(track)
+    tr.name = track
+    tr.pause_time_start += shift
+    tr.lasttime_check += shift
+    tr.due_time += shift
+    tr.out = live_output
+    tr.live = True
+    tr.owned &= ~owned_spouts
+    owned_spouts |= tr.owned
+    if flow_owner is None: flow_owner = tr
+    tracks[track] = tr
+    _schedule(tr)
+    scheduler.wake("wsp_proc")
+
+def set_trace(fn):
+    """ Sets (or, with None, clears) a function that is called for every spout change
+    and the end of every pause, as fn(event, due, t, mask).  event is "on", "off",
+    "squirt", "squirt_end" or "pause", due is when it should have happened and t is
+    when it did (both in ns), and mask is the spouts.  Used by bench_squirts.py."""
+    global trace
+    trace = fn
+
+def refresh():
+    """ Has every track work out again when it next needs to run, on the next 
+    heartbeat.  Call after changing *duration or *period from the outside."""
+    global refresh_pending
+    refresh_pending = True
+    scheduler.wake("wsp_proc")
+
+def heartbeat(t=None):
+    """ Come here to run the tracks. Runs every track that is due, and returns the
+    time (in ns) that it next needs to be called, or None if there is nothing to do."""
+    global refresh_pending
+    if t is None: t = clock.now_ns()
+    if refresh_pending:
+        refresh_pending = False
+        for tr in tracks.values(): _schedule(tr)
+    counts = {}                    # Track name -> statements run in this heartbeat
+    while len(track_heap) > 0 and track_heap[0][0] <= t:
+        deadline, n, tr = heapq.heappop(track_heap)
+        if tr.deadline != deadline or tr.program is None: continue     # Stale
+        tr.lasttime_check = t
+        tr.due_time = deadline
+        count = counts.get(tr.name, 0) + step_track(tr, t)
+        counts[tr.name] = count
+        # A track that catches up on its waits runs again at once, but no more than
+        # statement_budget statements in all: a loop of waits of no time goes on later.
+        if count >= statement_budget: _schedule(tr, t + statement_period)
+        else: _schedule(tr)
+    while len(track_heap) > 0:
+        deadline, n, tr = track_heap[0]
+        if tr.deadline == deadline and tr.program is not None: return deadline
+        heapq.heappop(track_heap)
+    return None
+
+# ===================  The main track, as used by the conductor
 
+def step(t):
+    """ Runs (or continues) the program on the main track, as step_track does.
+    Returns the number of statements run."""
+    tr = tracks.get(main_track)
+    if tr is None: return 0
+    tr.lasttime_check = t
+    tr.due_time = t
+    return step_track(tr, t)
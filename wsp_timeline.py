@@ -0,0 +1,268 @@
+# wsp_timeline.py -- Renders a WSP program into a timeline of spout events, and plays it.
+# dlb, Oct 2026
+
+# Most programs do the same thing every time they run, apart from the random
+# statement.  With the random numbers seeded, the whole show is known in advance: a
+# list of events, each with a time, the spouts to turn on, the spouts to turn off,
+# the flow to set, and the ramp to set it with.  render() works that list out by
+# running the program on a track of its own in simulated time, with its outputs
+# recorded instead of sent to the hardware.  Loops are bounded by the length of time
+# rendered.
+#
+# Playback renders one event ahead, and fires each event at its time.  It takes part
+# in the same ownership of the spouts and the flow as the tracks of the live
+# interpreter (see wsp_proc.claim_spouts and set_flow), through a track of its own
+# (owner), so a timeline played next to other tracks leaves their spouts and flow
+# alone.  By default the playback task is woken at the time of each event.  If
+# spin_time is set, it is woken that much early instead, and waits out the rest in
+# a tight loop, so the spouts switch within a few microseconds of the right time --
+# but nothing else in the conductor's loop runs meanwhile, so keep it short.
+#
+# A few things can't be known in advance:
+#
+#   - How long the valve takes to move.  "set-flow" waits for the valve, so the
+#     timeline has a wait event there: playback watches the real valve, and moves
+#     the rest of the timeline later by however long it took.
+#   - The *flow variable, which is the valve's actual position.  Programs that read
+#     it aren't rendered at all (see renderable()); they run live.
+#   - *duration and *period, when the user changes them from the web page.  Then
+#     playback hands the program over to the live interpreter (wsp_proc.adopt_track)
+#     right after the next event, and it carries on from there.
+
+import array
+import random
+import clock
+import corehw
+import ball_valve
+import wsp_proc as proc
+import scheduler
+
+spin_time = 0                  # Nanoseconds before an event to stop sleeping and start spinning, or 0 not to spin
+max_statements = 100_000       # Statements to run looking for the next event before giving up
+valve_timeout = 10_000_000_000 # Longest wait for the valve, in ns, as in the set-flow statement
+
+NO_FLOW = -1                   # The flow of an event that doesn't set the flow
+easing_names = tuple(ball_valve.easings)   # The easings of the ramps, by their index in a timeline
+
+# What render_next() returns when there are no more events.
+END = "end"                    # The program has ended
+HOLD = "hold"                  # The program is holding, or is looping without doing anything
+
+class _RecordingOutput:
+    """ Stands in for the hardware while rendering.  Records the changes as events of
+    (time, on_mask, off_mask, flow, wait, ramp), where ramp is None, or the duration
+    (in ms) and easing of a ramp to the flow."""
+
+    def __init__(self):
+        self.t = 0
+        self.events = []
+
+    def _add(self, on, off, flow=NO_FLOW, wait=False, ramp=None):
+        if len(self.events) > 0 and flow == NO_FLOW and not wait:
+            t, last_on, last_off, last_flow, last_wait, last_ramp = self.events[-1]
+            if t == self.t and not last_wait:
+                # Merge with the event at the same time.
+                self.events[-1] = (t, (last_on & ~off) | on, (last_off & ~on) | off, last_flow, False, last_ramp)
+                return
+        self.events.append((self.t, on, off, flow, wait, ramp))
+
+    def spouts_on(self, mask):
+        if mask != 0: self._add(mask, 0)
+
+    def spouts_off(self, mask):
+        if mask != 0: self._add(0, mask)
+
+    def move_valve(self, v):
+        self._add(0, 0, v)
+
+    def ramp_valve(self, v, duration, easing):
+        self._add(0, 0, v, False, (duration, easing))
+
+    def valve_settled(self):
+        self._add(0, 0, NO_FLOW, True)
+        return True
+
+class Renderer:
+    """ Runs a program in simulated time, one event at a time.  Times are in ns from
+    the start of the program."""
+
+    def __init__(self, prg, seed=None, private_args=True):
+        self.out = _RecordingOutput()
+        self.track = proc.Track("render", prg)
+        self.track.out = self.out
+        self.track.live = False
+        self.track.rng = random.Random(seed)
+        if private_args: self.track.args = [corehw.duration, corehw.period]
+        self.t = 0
+
+    def render_next(self):
+        """ Runs the program up to its next event(s).  Returns a list of events, or END
+        or HOLD."""
+        tr = self.track
+        count = 0
+        while count < max_statements:
+            if tr.program is None: break
+            due = proc.next_step_time(tr)
+            if due is None: return HOLD
+            if due > self.t: self.t = due
+            tr.lasttime_check = self.t
+            tr.due_time = due
+            self.out.t = self.t
+            count += proc.step_track(tr, self.t)
+            if len(self.out.events) > 0:
+                events = self.out.events
+                self.out.events = []
+                return events
+        if tr.program is None: return END
+        return HOLD
+
+def renderable(prg):
+    """ Returns True if the program can be rendered ahead of time."""
+    return not prg.get("reads_flow", True)
+
+def render(prg, seed=None, seconds=60.0):
+    """ Renders up to the given number of seconds of a program.  Returns a dict of
+    arrays, one entry per event: "time" (ns from the start), "on" and "off" (spout
+    masks), "flow" (percent, or NO_FLOW), "wait" (1 where playback waits for the
+    valve), "ramp" (the duration in ms of a ramp to the flow, or 0) and "easing" (the
+    ramp's, as an index into easing_names), and "end", what stopped the rendering:
+    END, HOLD or "time"."""
+    r = Renderer(prg, seed)
+    timeline = {"time": array.array("q"), "on": array.array("l"), "off": array.array("l"),
+                "flow": array.array("h"), "wait": array.array("b"), "ramp": array.array("l"),
+                "easing": array.array("b"), "end": "time"}
+    limit = int(seconds * 1_000_000_000)
+    while True:
+        events = r.render_next()
+        if events == END or events == HOLD:
+            timeline["end"] = events
+            break
+        if events[0][0] > limit: break
+        for t, on, off, flow, wait, ramp in events:
+            timeline["time"].append(t)
+            timeline["on"].append(on)
+            timeline["off"].append(off)
+            timeline["flow"].append(flow)
+            timeline["wait"].append(1 if wait else 0)
+            if ramp is None: ramp = (0, "linear")
+            timeline["ramp"].append(int(ramp[0]))
+            timeline["easing"].append(easing_names.index(ramp[1]))
+    return timeline
+
+# ===================  Playback
+
+renderer = None                # The Renderer of the program being played, or None
+pending = []                   # Events rendered but not yet fired
+offset = 0                     # Real time minus simulated time, in ns
+wait_start = 0                 # When playback started waiting for the valve, or 0
+handover = False               # Set when the program must be handed over to the live interpreter
+owner = None                   # The track that owns playback's spouts and flow (never run itself)
+
+def get_current_program():
+    """ Returns the name of the program being played, or None."""
+    if renderer is None: return None
+    return renderer.track.program["program_name"]
+
+def get_current_line():
+    """ Returns the line number of the program being played (the rendering of it,
+    which is up to one event ahead), or 0."""
+    if renderer is None: return 0
+    return renderer.track.line_num
+
+def start(prog_name, seed=None):
+    """ Plays a program from its timeline, on the main track.  Returns False (and
+    does nothing) if the program doesn't exist or can't be rendered, in which case
+    it should be played live."""
+    global renderer, pending, offset, wait_start, handover, owner
+    prg = proc.find_program(prog_name)
+    if prg is None or not renderable(prg): return False
+    stop()
+    proc.stop_track(proc.main_track)
+    print("wsp: PLAYING TIMELINE: %s" % prog_name)
+    renderer = Renderer(prg, seed, private_args=False)
+    owner = proc.Track("timeline", prg)
+    pending = []
+    offset = clock.now_ns()
+    wait_start = 0
+    handover = False
+    scheduler.wake("wsp_timeline")
+    return True
+
+def stop():
+    """ Stops playback, turns off the spouts it turned on, and gives up the flow."""
+    global renderer, pending
+    if renderer is None: return
+    renderer = None
+    pending = []
+    proc.end_track(owner)
+
+def arguments_changed():
+    """ Call when *duration or *period are changed from the outside.  Playback hands
+    the program over to the live interpreter after the next event."""
+    global handover
+    if renderer is None: return
+    handover = True
+    scheduler.wake("wsp_timeline")
+
+def _hand_over():
+    """ Gives the program to the live interpreter, from where the rendering is."""
+    global renderer, pending
+    tr = renderer.track
+    # The spouts and the flow go over to the track, without being turned off.
+    tr.owned = proc.release_spouts(owner, owner.owned)
+    proc.end_track(owner)
+    renderer = None
+    pending = []
+    print("wsp: HANDING TIMELINE OVER TO THE INTERPRETER")
+    proc.adopt_track(tr, offset)
+
+def _fire(event, due):
+    """ Sends one event to the hardware, as far as playback owns the spouts and flow."""
+    t, on, off, flow, wait, ramp = event
+    if ramp is not None: proc.set_flow(owner, flow, ramp[0], ramp[1])
+    elif flow != NO_FLOW: proc.set_flow(owner, flow)
+    if on == 0 and off == 0: return
+    off = proc.release_spouts(owner, off)
+    on = proc.claim_spouts(owner, on)
+    if on == 0 and off == 0: return
+    now = clock.now_ns()
+    corehw.set_spouts(on, off)
+    if proc.trace is not None:
+        if on != 0: proc.trace("on", due, now, on)
+        if off != 0: proc.trace("off", due, now, off)
+
+def heartbeat(t=None):
+    """ Fires the events that are due.  Returns the time (in ns) that it next needs
+    to be called, or None if nothing is playing."""
+    global pending, offset, wait_start
+    if renderer is None: return None
+    if t is None: t = clock.now_ns()
+    if wait_start != 0:
+        # Waiting for the valve, as the set-flow statement does.
+        if t - wait_start < valve_timeout and ball_valve.in_motion(): return t + proc.statement_period
+        offset = t - pending[0][0]
+        wait_start = 0
+        pending = pending[1:]
+    while True:
+        if len(pending) == 0:
+            if handover:
+                _hand_over()
+                return None
+            events = renderer.render_next()
+            if events == END:
+                stop()
+                return None
+            if events == HOLD: return None
+            pending = events
+        event = pending[0]
+        due = event[0] + offset
+        if event[4]:
+            # A wait for the valve.
+            if t < due: return due
+            wait_start = t
+            return t + proc.statement_period
+        if t < due - spin_time: return due - spin_time
+        clock.wait_until(due)
+        _fire(event, due)
+        pending = pending[1:]
+        t = clock.now_ns()